@@ -0,0 +1,90 @@
+"""
+Import-time regression benchmark: each module is imported in a fresh interpreter
+run with -X importtime, and its cumulative import time, the best of several runs,
+must stay under its budget. Exits with status 1 when a budget is exceeded.
+
+    python benchmarks/import_time.py [--runs 5] [--scale 1.0] [--top 5] [modules...]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# cold start budgets in milliseconds, with headroom for noisy machines. The concurrency utilities
+# are imported by every subprocess, the recording and color modules must not load cv2, mss or matplotlib,
+# and the color module not even numpy
+BUDGETS_MS = {
+    'utils': 10,
+    'utils.concurrent': 10,
+    'utils.concurrent.threading_utils': 35,
+    'utils.concurrent.metrics_utils': 60,
+    'utils.concurrent.multiprocessing_utils': 90,
+    'utils.fps_tracker': 10,
+    'utils.profiling_utils': 25,
+    'utils.logging_utils': 50,
+    'utils.recording_utils': 250,
+    'utils.mpl_color_utils': 30,
+}
+
+
+def parse_importtime(stderr):
+    """
+    Parse the -X importtime report into a list of (module, self us, cumulative us, depth)
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def measure(module, runs=5):
+    """
+    Best cumulative import time of <module> in milliseconds over <runs> fresh interpreters,
+    with the imports of the fastest run
+    """
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                cwd=ROOT_DIR, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'importing {module} failed:\n{result.stderr}')
+        imports = parse_importtime(result.stderr)
+        # the module and its parent packages are imported at the top level, their dependencies below them
+        cumulative_ms = sum(cumulative_us for name, _, cumulative_us, depth in imports
+                            if depth == 0 and (name == module or module.startswith(name + '.'))) / 1e3
+        if best is None or cumulative_ms < best[0]:
+            best = (cumulative_ms, imports)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', help='modules to measure, all the budgeted ones by default')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per module, the best run counts')
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='multiplier of the budgets, for slower machines')
+    parser.add_argument('--top', type=int, default=5, help='number of slowest imports listed for each module')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules or BUDGETS_MS:
+        cumulative_ms, imports = measure(module, args.runs)
+        budget_ms = BUDGETS_MS.get(module)
+        over_budget = budget_ms is not None and cumulative_ms > budget_ms * args.scale
+        failed |= over_budget
+        print(f'{module:<45} {cumulative_ms:8.1f} ms'
+              + (f' / {budget_ms * args.scale:.1f} ms' if budget_ms is not None else '')
+              + ('  OVER BUDGET' if over_budget else ''))
+        for name, self_us, _, _ in sorted(imports, key=lambda i: -i[1])[:args.top]:
+            print(f'    {name:<41} {self_us / 1e3:8.1f} ms self')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
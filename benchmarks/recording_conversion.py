@@ -0,0 +1,48 @@
+"""
+Per-frame cost of the BGRA to BGR conversion of captured frames: the former
+PIL path against the copy-free frombuffer view converted into a reused buffer.
+
+    python benchmarks/recording_conversion.py [--width 1920] [--height 1080] [--repeat 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from utils.recording_utils import _bgra_to_bgr, _bgra_view  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    width, height = args.width, args.height
+    raw = bytearray(np.random.randint(0, 256, width * height * 4, dtype=np.uint8).tobytes())
+
+    def _pil_convert():
+        img = Image.frombytes('RGB', (width, height), bytes(raw), 'raw', 'BGRX')
+        img = np.asarray(img, dtype=np.uint8)
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    assert (_pil_convert() == _bgra_to_bgr(_bgra_view(raw, width, height), out)).all()
+    for name, convert in [('PIL frombytes + asarray + cvtColor', _pil_convert),
+                          ('frombuffer view + cvtColor into dst',
+                           lambda: _bgra_to_bgr(_bgra_view(raw, width, height), out))]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            convert()
+        print(f'{name}: {(time.perf_counter() - start) / args.repeat * 1000:.3f} ms/frame')
+
+
+if __name__ == '__main__':
+    main()
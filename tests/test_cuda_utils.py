@@ -0,0 +1,60 @@
+import subprocess
+
+import pytest
+
+from utils import cuda_utils
+from utils.cuda_utils import GPUReading, get_gpu_usage, parse_gpu_query_csv, parse_nvidia_smi
+
+# outputs recorded on a machine with two GPUs, the second one reporting neither temperature nor power
+RECORDED_QUERY = '0, 1093, 24576, 37, 12, 54, 88.21\n1, 0, 16384, 0, 0, [N/A], [Not Supported]\n'
+RECORDED_TABLE = '''
+|   0  NVIDIA GeForce RTX 3090    Off | 00000000:01:00.0  On |                  N/A |
+| 30%   54C    P2    88W / 350W |   1093MiB / 24576MiB |     37%      Default |
+|   1  Tesla T4            Off  | 00000000:02:00.0 Off |                    0 |
+| N/A   40C    P8     9W /  70W |      0MiB / 16384MiB |      0%      Default |
+'''
+
+
+def test_parse_gpu_query_csv():
+    readings = parse_gpu_query_csv(RECORDED_QUERY, timestamp=12.5)
+    assert readings == [GPUReading(0, 12.5, 1093, 24576, 37, 12, 54, 88.21),
+                        GPUReading(1, 12.5, 0, 16384, 0, 0, None, None)]
+    # whole numbers are ints, the others floats
+    assert type(readings[0].memory_used) is int
+    assert type(readings[0].power_draw) is float
+
+
+def test_parse_gpu_query_csv_bytes_and_blank_lines():
+    readings = parse_gpu_query_csv(('\n' + RECORDED_QUERY + '\n').encode(), timestamp=0.)
+    assert [r.gpu_id for r in readings] == [0, 1]
+
+
+def test_parse_gpu_query_csv_wrong_field_count():
+    with pytest.raises(ValueError):
+        parse_gpu_query_csv('0, 1093, 24576\n')
+
+
+def test_parse_nvidia_smi():
+    assert parse_nvidia_smi(RECORDED_TABLE) == {0: (1093, 24576), 1: (0, 16384)}
+    assert parse_nvidia_smi(RECORDED_TABLE.encode()) == {0: (1093, 24576), 1: (0, 16384)}
+
+
+def test_get_gpu_usage_query(monkeypatch):
+    monkeypatch.setattr(cuda_utils.subprocess, 'check_output', lambda command: RECORDED_QUERY.encode())
+    assert get_gpu_usage() == {0: (1093, 24576), 1: (0, 16384)}
+    assert get_gpu_usage(1) == (0, 16384)
+
+
+def test_get_gpu_usage_falls_back_to_table(monkeypatch):
+    commands = []
+
+    def check_output(command):
+        commands.append(command)
+        if command != 'nvidia-smi':
+            # drivers without structured queries
+            raise subprocess.CalledProcessError(6, command)
+        return RECORDED_TABLE.encode()
+
+    monkeypatch.setattr(cuda_utils.subprocess, 'check_output', check_output)
+    assert get_gpu_usage(0) == (1093, 24576)
+    assert commands[-1] == 'nvidia-smi' and len(commands) == 2
@@ -0,0 +1,92 @@
+import math
+import pickle
+import time
+
+import pytest
+
+from utils.fps_tracker import LatencyHistogram, LatencyTracker
+
+
+def _histogram(values, **kwargs):
+    histogram = LatencyHistogram(**kwargs)
+    [histogram.record(value) for value in values]
+    return histogram
+
+
+def test_percentiles_within_bucket_precision():
+    histogram = _histogram(range(1, 100001))
+    assert histogram.count == 100000
+    assert (histogram.min, histogram.max) == (1, 100000)
+    assert histogram.mean == 50000.5
+    assert histogram.stddev == pytest.approx(28867.5, rel=1e-4)
+    # buckets are 2 ** -6 wide relative to their values with the default 7 bits of precision
+    for percent in (1, 50, 90, 99, 99.9):
+        assert histogram.percentile(percent) == pytest.approx(percent * 1000, rel=2 ** -6)
+    assert histogram.percentile(100) == 100000
+    # values below 2 ** 7 are counted exactly
+    assert _histogram(range(100)).percentile(50) == 49
+
+
+def test_percentiles_clamped_to_the_recorded_range():
+    assert LatencyHistogram().percentile(50) is None
+    histogram = _histogram([1 << 40, 1 << 41], max_value=1 << 20)
+    assert histogram.bucket_index(1 << 41) == histogram.bucket_count - 1
+    assert histogram.percentile(50) == 1 << 40
+    assert histogram.percentile(100) == 1 << 41
+
+
+def test_merge_leaves_the_other_histogram_as_is():
+    first, second = _histogram(range(0, 5000, 2)), _histogram(range(1, 5000, 2))
+    counts = bytes(second._counts)
+    merged = first.merge(second)
+    assert merged is first
+    assert bytes(second._counts) == counts and second.count == 2500
+    everything = _histogram(range(5000))
+    assert bytes(merged._counts) == bytes(everything._counts)
+    assert (merged.count, merged.total, merged.min, merged.max) == (5000, everything.total, 0, 4999)
+    assert merged.percentile(95) == everything.percentile(95)
+
+
+def test_merge_rejects_other_parameters():
+    with pytest.raises(ValueError):
+        LatencyHistogram().merge(LatencyHistogram(precision_bits=5))
+
+
+def test_histogram_pickles():
+    histogram = pickle.loads(pickle.dumps(_histogram([10, 1000, 1000000])))
+    assert histogram.count == 3
+    assert histogram.percentile(50) == pytest.approx(1000, rel=2 ** -6)
+
+
+def _tracker(intervals_ns, end_ns):
+    # events spaced by <intervals_ns>, the last one at <end_ns>
+    tracker = LatencyTracker()
+    now_ns = end_ns - sum(intervals_ns)
+    for interval_ns in intervals_ns:
+        now_ns += interval_ns
+        tracker.update(interval_ns, now_ns)
+    return tracker
+
+
+def test_tracker_percentiles_and_fps():
+    tracker = _tracker([10_000_000] * 50, time.perf_counter_ns())
+    summary = tracker.summary()
+    assert summary['count'] == 50
+    assert summary['p50'] == summary['p99'] == summary['max'] == pytest.approx(0.01, rel=2 ** -6)
+    assert summary['jitter'] == 0.
+    # 50 events over the last 0.49 s
+    assert summary['fps_1s'] == pytest.approx(100, rel=0.1)
+    assert math.isnan(LatencyTracker().p50)
+
+
+def test_tracker_merge_leaves_the_other_tracker_as_is():
+    end_ns = time.perf_counter_ns()
+    first, second = _tracker([10_000_000] * 50, end_ns), _tracker([20_000_000] * 25, end_ns)
+    slot_counts, last_slot = list(second._rate._slot_counts), second._rate._last_slot
+    time.sleep(0.2)
+    first.merge(second)
+    assert (second._rate._slot_counts, second._rate._last_slot) == (slot_counts, last_slot)
+    assert second.histogram.count == 25
+    assert first.histogram.count == 75
+    assert first.max == pytest.approx(0.02, rel=2 ** -6)
+    assert first.fps(1.) == pytest.approx(75 / 0.69, rel=0.1)
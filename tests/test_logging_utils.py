@@ -0,0 +1,185 @@
+import io
+import logging
+import multiprocessing as mp
+import os
+import queue
+import subprocess
+import sys
+
+import pytest
+
+from utils import logging_utils
+from utils.logging_utils import (AsyncLogHandler, RateLimitFilter, _ColorizedLogFormatter, get_logger, log_at_most,
+                                 log_every_n, stop_async_logging)
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def logger_name(request):
+    yield request.node.name
+    stop_async_logging(request.node.name)
+    logger = logging.getLogger(request.node.name)
+    [logger.removeHandler(handler) for handler in list(logger.handlers)]
+
+
+def _record(msg, *args, level=logging.INFO, exc_info=None, lineno=1):
+    return logging.LogRecord('test', level, __file__, lineno, msg, args, exc_info)
+
+
+def test_async_logger_writes_queued_records_on_stop(logger_name):
+    stream = io.StringIO()
+    logger = get_logger(logger_name, console_stream=stream, async_mode=True, batch_size=16)
+    [logger.info('record %d', i) for i in range(1000)]
+    stop_async_logging(logger_name)
+    lines = stream.getvalue().splitlines()
+    assert [line.split('] ')[-1].split('\033')[0] for line in lines] == [f'record {i}' for i in range(1000)]
+    assert all(f'[{logger_name}] [INFO]' in line for line in lines)
+    # later records do not go to the stopped listener
+    logger.info('late')
+    assert 'late' not in stream.getvalue()
+
+
+def test_queued_records_are_written_at_exit(tmp_path):
+    script = ('from utils.logging_utils import get_logger\n'
+              f'logger = get_logger("exit", console_stream=None, log_dir={str(tmp_path)!r}, async_mode=True)\n'
+              '[logger.info("record %d", i) for i in range(5000)]\n')
+    subprocess.run([sys.executable, '-c', script], cwd=_ROOT_DIR, check=True, timeout=60)
+    [log_file] = os.listdir(tmp_path)
+    with open(tmp_path / log_file) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 5000
+    assert lines[-1].endswith('record 4999')
+
+
+@pytest.mark.parametrize('overflow_policy, kept, message', [
+    ('drop_newest', ['0', '1'], '3 log records dropped'),
+    ('drop_oldest', ['3', '4'], '3 log records dropped'),
+])
+def test_overflow_policies(overflow_policy, kept, message):
+    log_queue = queue.Queue(2)
+    handler = AsyncLogHandler(log_queue, overflow_policy)
+    [handler.handle(_record(str(i))) for i in range(5)]
+    assert handler.dropped_count == 3
+    assert [log_queue.get_nowait().msg for _ in range(2)] == kept
+    # the drops are reported with the next record queued
+    handler.handle(_record('next'))
+    assert log_queue.get_nowait().msg == 'next'
+    report = log_queue.get_nowait()
+    assert report.levelno == logging.WARNING and report.msg.startswith(message)
+    handler.handle(_record('after'))
+    assert log_queue.qsize() == 1
+
+
+def test_prepared_records_are_self_contained():
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        record = _record('value %s of %r', 1, [2], level=logging.ERROR, exc_info=sys.exc_info())
+    prepared = AsyncLogHandler.prepare(record)
+    assert (prepared.msg, prepared.args, prepared.exc_info) == ('value 1 of [2]', None, None)
+    assert prepared.exc_text.endswith('ValueError: boom')
+    # the other handlers of the record get it unchanged
+    assert (record.msg, record.args) == ('value %s of %r', (1, [2]))
+    assert record.exc_info is not None
+
+
+def _log_from_child(name):
+    logging.getLogger(name).warning('from the child')
+
+
+def test_multiprocess_logger(logger_name):
+    stream = io.StringIO()
+    get_logger(logger_name, console_stream=stream, async_mode=True, multiprocess=True)
+    # forked, the child logs through the queue of the logger it inherits
+    proc = mp.get_context('fork').Process(target=_log_from_child, args=(logger_name,))
+    proc.start()
+    proc.join(10)
+    assert proc.exitcode == 0
+    stop_async_logging(logger_name)
+    assert '[WARNING] from the child' in stream.getvalue()
+
+
+class _BaselineFormatter(logging.Formatter):
+    # the formatter setting the color codes on each record, before the templates per level
+    def __init__(self, color=False, *args, **kwargs):
+        super(_BaselineFormatter, self).__init__(*args, **kwargs)
+        self.color = color
+
+    def format(self, record, *args, **kwargs):
+        if self.color and record.levelno in _ColorizedLogFormatter.COLOR_CODES:
+            record.color_on = _ColorizedLogFormatter.COLOR_CODES[record.levelno]
+            record.color_off = _ColorizedLogFormatter.RESET_CODE
+        else:
+            record.color_on = record.color_off = ''
+        return super(_BaselineFormatter, self).format(record, *args, **kwargs)
+
+
+@pytest.mark.parametrize('color', [False, True])
+@pytest.mark.parametrize('datefmt', [None, '%m/%d/%Y %H:%M:%S'])
+def test_formatter_matches_the_baseline(color, datefmt):
+    fmt = '%(color_on)s%(asctime)s [%(threadName)s] [%(name)s] [%(levelname)s] %(message)s%(color_off)s'
+    formatter = _ColorizedLogFormatter(fmt=fmt, datefmt=datefmt, color=color)
+    baseline = _BaselineFormatter(fmt=fmt, datefmt=datefmt, color=color)
+    try:
+        raise KeyError('key')
+    except KeyError:
+        exc_info = sys.exc_info()
+    records = [_record('message %d', i, level=level) for i, level in enumerate([logging.DEBUG, logging.INFO,
+                                                                               logging.WARNING, logging.ERROR,
+                                                                               logging.CRITICAL, 25])]
+    records.append(_record('failed', level=logging.ERROR, exc_info=exc_info))
+    # records of the same second reuse the cached time, the others format it again
+    for i, created in enumerate([1000.25, 1000.75, 1001.5, 1000.5, 1001.5, 2000., 2000.999]):
+        records[i].created, records[i].msecs = created, (created % 1) * 1000
+    for record in records:
+        expected = baseline.format(logging.makeLogRecord(record.__dict__))
+        assert formatter.format(logging.makeLogRecord(record.__dict__)) == expected
+    assert ('\033[1;31m' in formatter.format(records[3])) == color
+
+
+def test_rate_limit_filter_samples_each_call_site(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(logging_utils.time, 'monotonic', lambda: now[0])
+    every_third = RateLimitFilter(every_n=3)
+    assert [every_third.filter(_record('a', lineno=1)) for _ in range(10)].count(True) == 4
+    assert [every_third.filter(_record('b', lineno=2)) for _ in range(2)] == [True, False]
+    twice_a_second = RateLimitFilter(max_per_second=2)
+    assert [twice_a_second.filter(_record('a')) for _ in range(10)] == [True, True] + [False] * 8
+    now[0] = 101.2
+    assert [twice_a_second.filter(_record('a')) for _ in range(3)] == [True, True, False]
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super(_ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_sampled_logging_counts_and_call_sites(logger_name, monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(logging_utils.time, 'monotonic', lambda: now[0])
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(logging.DEBUG)
+    handler = _ListHandler()
+    logger.addHandler(handler)
+    for i in range(25):
+        log_every_n(logger, logging.INFO, 10, 'every %d', i)
+        log_every_n(logger, logging.INFO, 10, 'other site %d', i)
+        log_at_most(logger, logging.INFO, 3, 'at most %d', i)
+    now[0] = 101.
+    log_at_most(logger, logging.INFO, 3, 'at most %d', 25)
+    messages = [record.getMessage() for record in handler.records]
+    assert [m for m in messages if m.startswith('every')] == ['every 0', 'every 10', 'every 20']
+    assert len([m for m in messages if m.startswith('other site')]) == 3
+    assert [m for m in messages if m.startswith('at most')] == ['at most 0', 'at most 1', 'at most 2', 'at most 25']
+    # the records point at the caller, not at the sampling helpers
+    assert {record.funcName for record in handler.records} == {'test_sampled_logging_counts_and_call_sites'}
+    assert {record.pathname for record in handler.records} == {__file__}
+    # disabled levels log nothing
+    logger.setLevel(logging.WARNING)
+    log_every_n(logger, logging.INFO, 2, 'disabled')
+    assert len(handler.records) == 10
@@ -0,0 +1,59 @@
+import multiprocessing as mp
+
+import pytest
+
+from utils.concurrent.metrics_utils import MetricsLayout, SharedMetrics
+from utils.fps_tracker import LatencyHistogram
+
+
+@pytest.fixture
+def metrics():
+    metrics = SharedMetrics(MetricsLayout(num_writers=3)
+                            .counter('frames')
+                            .gauge('queue_depth')
+                            .histogram('latency_ns'))
+    yield metrics
+    metrics.close()
+
+
+def _write(metrics, writer_index, values):
+    # attaches the block of <metrics> by name in the child process
+    writer = metrics.writer(writer_index)
+    for value in values:
+        writer.inc('frames')
+        writer.observe('latency_ns', value)
+    writer.set('queue_depth', writer_index + 0.5)
+
+
+def test_snapshot_sums_the_writers_of_other_processes(metrics):
+    values = {0: [100, 200, 300], 1: [1000, 50000], 2: []}
+    # spawned, the workers get the metrics pickled
+    procs = [mp.get_context('spawn').Process(target=_write, args=(metrics, index, values[index]))
+             for index in values]
+    [proc.start() for proc in procs]
+    [proc.join(10) for proc in procs]
+    assert [proc.exitcode for proc in procs] == [0, 0, 0]
+
+    snapshot = metrics.snapshot()
+    assert snapshot['frames'] == 5
+    assert snapshot['queue_depth'] == 0.5 + 1.5 + 2.5
+    latency = snapshot['latency_ns']
+    expected = LatencyHistogram(3, 1 << 40)
+    [expected.record(value) for value in values[0] + values[1]]
+    assert (latency.count, latency.total, latency.total_squares) == (5, 51600, expected.total_squares)
+    assert (latency.min, latency.max) == (100, 50000)
+    assert bytes(latency._counts) == bytes(expected._counts)
+    assert latency.percentile(50) == expected.percentile(50)
+
+    first = metrics.snapshot(writer_indices=[1])
+    assert (first['frames'], first['queue_depth']) == (2, 1.5)
+    assert (first['latency_ns'].min, first['latency_ns'].count) == (1000, 2)
+    empty = metrics.snapshot(writer_indices=[2])['latency_ns']
+    assert (empty.count, empty.min, empty.percentile(50)) == (0, None, None)
+
+
+def test_layout_errors(metrics):
+    with pytest.raises(ValueError):
+        MetricsLayout().counter('frames').gauge('frames')
+    with pytest.raises(IndexError):
+        metrics.writer(3)
@@ -0,0 +1,74 @@
+import copy
+import multiprocessing as mp
+import pickle
+
+import matplotlib
+import numpy as np
+import pytest
+
+from utils.mpl_color_utils import get_cmap
+
+_VALUES = np.array([[0., 0.25, 0.5, 1.], [np.nan, -0.5, 1.5, 0.999]])
+
+
+def _matplotlib_colors(name, values, lut=None, scale=1.0):
+    cmap = matplotlib.colormaps[name]
+    cmap = cmap.resampled(lut) if lut is not None else cmap
+    return np.asarray(cmap(values))[..., :3] * scale
+
+
+@pytest.mark.parametrize('name, lut', [('viridis', None), ('tab10', None), ('viridis', 16)])
+def test_float_values_match_matplotlib(name, lut):
+    cmap = get_cmap(name, lut)
+    # nan takes the bad color, out of range values the under and over colors
+    assert np.allclose(cmap.map(_VALUES), _matplotlib_colors(name, _VALUES, lut))
+    assert np.allclose(cmap(0.25), _matplotlib_colors(name, 0.25, lut))
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int8, np.int32])
+def test_class_ids_match_matplotlib(dtype):
+    cmap = get_cmap('tab20')
+    info = np.iinfo(dtype)
+    ids = np.array([[0, 1, 19], [20, info.max, info.min]], dtype)
+    assert np.allclose(cmap.map(ids), _matplotlib_colors('tab20', ids))
+
+
+def test_scaled_integer_images():
+    cmap = get_cmap('viridis', scale=255)
+    ids = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    expected = np.rint(_matplotlib_colors('viridis', ids, scale=255)).astype(np.uint8)
+    assert np.array_equal(cmap.map(ids, np.uint8), expected)
+    out = np.empty((2, 4, 3), np.uint16)
+    assert cmap.map(_VALUES, out=out) is out
+    assert np.array_equal(out, np.rint(_matplotlib_colors('viridis', _VALUES, scale=255)))
+
+
+def test_cached_colormaps_are_shared():
+    cmap = get_cmap('magma', scale=2.)
+    assert get_cmap('magma', scale=2.) is cmap
+    assert get_cmap('magma') is not cmap
+    assert not cmap.lut().flags.writeable
+    modified = copy.copy(cmap)
+    modified.scale = 3.
+    assert np.allclose(modified.map(_VALUES), cmap.map(_VALUES) * 1.5)
+    assert pickle.loads(pickle.dumps(modified)) is not modified
+
+
+def _map_in_child(data):
+    cmap = pickle.loads(data)
+    table = cmap._scaled_luts[(np.dtype(np.uint16), np.dtype(np.uint8))]
+    return len(cmap._attached_blocks), table.base is not None, cmap.map(np.arange(1000, dtype=np.uint16), np.uint8)
+
+
+def test_tables_shared_with_spawned_workers():
+    cmap = get_cmap('plasma', scale=255)
+    ids = np.arange(1000, dtype=np.uint16)
+    expected = cmap.map(ids, np.uint8)
+    data = pickle.dumps(cmap)
+    # the tables travel in shared memory, not in the pickle
+    assert len(data) < cmap._expanded_lut(ids.dtype, np.dtype(np.uint8)).nbytes
+    assert pickle.loads(data) is cmap
+    with mp.get_context('spawn').Pool(1) as pool:
+        attached_blocks, viewed, colors = pool.apply(_map_in_child, (data,))
+    assert attached_blocks == 1 and viewed
+    assert np.array_equal(colors, expected)
@@ -0,0 +1,418 @@
+import asyncio
+import ctypes
+import functools
+import gc
+import os
+import signal
+import time
+
+import numpy as np
+import pytest
+
+from utils.concurrent.multiprocessing_utils import (AsyncSubprocessExecutor, BrokenSubprocessError,
+                                                    ExecutorOverloadedError, SubprocessExecutor, TaskTimeoutError)
+
+# results of 128 KiB, each one leases a shared memory block in the subprocess
+_RESULT_SIZE = 1 << 14
+
+
+def _make_array(i):
+    return np.full(_RESULT_SIZE, i, dtype=np.float64)
+
+
+@pytest.fixture
+def shared_memory_executor():
+    executor = SubprocessExecutor(shared_memory=True, shared_memory_threshold=1 << 10)
+    executor.start()
+    yield executor
+    executor.terminate()
+    executor.join()
+
+
+def test_shared_memory_results_burst(shared_memory_executor):
+    # far more results than the pipes can buffer, their blocks are released while the tasks keep coming
+    futures = [shared_memory_executor.call(_make_array, (i,)) for i in range(3000)]
+    for i, f in enumerate(futures):
+        assert f.result(timeout=60)[-1] == i
+
+
+def test_shared_memory_submit_many_burst(shared_memory_executor):
+    futures = shared_memory_executor.submit_many(_make_array, [(i,) for i in range(5000)])
+    for i, f in enumerate(futures):
+        assert f.result(timeout=60)[0] == i
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+
+
+def test_broadcast_rejected_as_a_whole():
+    executor = SubprocessExecutor(num_processes=2, max_in_flight=2, overflow_policy='raise')
+    executor.start()
+    try:
+        busy = executor.call(_sleep, (1.,))
+        # a slot is left, not enough for both processes: neither of them gets the variable
+        with pytest.raises(ExecutorOverloadedError):
+            executor.init_variable('x', 1)
+        assert 'x' not in executor._variable_owners
+        assert not any('x' in variable_tasks for variable_tasks in executor._variable_tasks)
+        assert executor.in_flight == 1
+        busy.result(timeout=10)
+        # with nothing else in flight a broadcast may exceed the limit
+        executor.init_variable('x', 1).result(timeout=10)
+        assert executor.get_variable('x').result(timeout=10) == 1
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def _add(a, b):
+    return a + b
+
+
+def test_unpicklable_argument_fails_alone():
+    executor = SubprocessExecutor(batch_size=8, batch_window=0.05)
+    executor.start()
+    try:
+        args = [(i, 1) for i in range(8)]
+        args[3] = (lambda: None, 1)
+        futures = executor.submit_many(_add, args, chunksize=8)
+        for i, f in enumerate(futures):
+            if i == 3:
+                assert f.exception(timeout=10) is not None
+            else:
+                assert f.result(timeout=10) == i + 1
+        # the dispatcher is still running
+        assert executor.call(_add, (1, 2)).result(timeout=10) == 3
+        assert executor.in_flight == 0
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+class _Counter:
+    def __init__(self, value=0):
+        self.value = value
+
+    def add(self, n):
+        self.value += n
+        return self.value
+
+
+def test_variable_handle_proxies_methods_only():
+    executor = SubprocessExecutor()
+    executor.start()
+    try:
+        counter = executor.init_variable('counter', variable_class=_Counter)
+        assert counter.add(2).result(timeout=10) == 2
+        with pytest.raises(AttributeError):
+            counter.ad
+        with pytest.raises(AttributeError):
+            counter.value
+        stored = executor.call(_Counter, (5,), store_as='stored')
+        assert stored.add(1).result(timeout=10) == 6
+        with pytest.raises(AttributeError):
+            stored.missing
+        assert stored.result(timeout=10) is None
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def test_partials_sent_once_and_forgotten():
+    executor = SubprocessExecutor()
+    executor.start()
+    try:
+        add_one = functools.partial(_add, 1)
+        assert [f.result(timeout=10) for f in [executor.call(add_one, (i,)) for i in range(4)]] == [1, 2, 3, 4]
+        assert len(executor._sent_functions[0]) == 1
+        del add_one
+        add_two = functools.partial(_add, 2)
+        # the dispatcher holds its last batch until the next one
+        for i in range(2):
+            assert executor.call(add_two, (i,)).result(timeout=10) == i + 2
+            gc.collect()
+        assert executor.call(add_two, (2,)).result(timeout=10) == 4
+        # the collected partial is dropped, its id goes with the next reference
+        assert len(executor._sent_functions[0]) == 1
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def _hang_ignoring_sigterm(seconds):
+    # a hung native call: the watchdog cannot interrupt it and the restart has to wait <hang_grace>
+    ctypes.CDLL(None).signal(signal.SIGTERM, ctypes.c_void_p(1))
+    time.sleep(seconds)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='ignores SIGTERM through libc')
+def test_async_calls_submitted_during_restart():
+    async def main():
+        executor = AsyncSubprocessExecutor(hang_grace=1.)
+        executor.start()
+        try:
+            hung = asyncio.ensure_future(executor.call(_hang_ignoring_sigterm, (30,), timeout=0.2))
+            calls = []
+            end = time.monotonic() + 3.
+            while time.monotonic() < end:
+                calls.append(asyncio.ensure_future(executor.call(_add, (1, 2))))
+                await asyncio.sleep(0.01)
+            results = await asyncio.wait_for(asyncio.gather(*calls, return_exceptions=True), 10)
+            with pytest.raises(TaskTimeoutError):
+                await hung
+            # the calls dispatched to the hung process fail with it, every other one completes
+            assert all(r == 3 or isinstance(r, BrokenSubprocessError) for r in results)
+            assert results[-1] == 3
+            assert await asyncio.wait_for(executor.call(_add, (1, 1)), 5) == 2
+        finally:
+            executor.terminate()
+
+    asyncio.run(main())
+
+
+def _spin(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def test_timeout_interrupts_running_call():
+    executor = SubprocessExecutor()
+    executor.start()
+    try:
+        start = time.monotonic()
+        with pytest.raises(TaskTimeoutError):
+            executor.call(_spin, (30,), timeout=0.3).result(timeout=10)
+        assert time.monotonic() - start < 5
+        assert executor.in_flight == 0
+        # the executor thread was interrupted, the process kept running
+        assert executor.call(_add, (1, 2)).result(timeout=10) == 3
+        assert executor.restart_count == 0
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def _wait_for_restart(executor, count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while executor.restart_count < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_variables_replayed_after_crash():
+    executor = SubprocessExecutor(num_processes=2)
+    executor.start()
+    try:
+        executor.init_variable('pinned', _Counter(5), proc_index=1).result(timeout=10)
+        executor.init_variable('broadcast', 7).result(timeout=10)
+        stored = executor.call(_Counter, (10,), store_as='stored')
+        stored.result(timeout=10)
+        stored_owner = executor._variable_owners['stored']
+        for proc_index in {1, stored_owner}:
+            os.kill(executor._procs[proc_index].pid, signal.SIGKILL)
+        _wait_for_restart(executor, len({1, stored_owner}))
+        assert executor.get_variable('pinned').result(timeout=10).value == 5
+        assert executor.call(_add, (executor.variable_arg('broadcast'), 1)).result(timeout=10) == 8
+        assert stored.add(1).result(timeout=10) == 11
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def test_terminated_executor_threads_stay_idle():
+    executor = SubprocessExecutor(num_processes=2)
+    executor.start()
+    assert executor.call(_add, (1, 2)).result(timeout=10) == 3
+    executor.terminate()
+    executor.join()
+    # the sentinels of the exited subprocesses must not keep waking the result thread up
+    start = time.process_time()
+    time.sleep(0.5)
+    assert time.process_time() - start < 0.2
+
+
+def _touch(path):
+    open(path, 'w').close()
+
+
+def test_cancelled_call_does_not_run(tmp_path):
+    executor = SubprocessExecutor()
+    executor.start()
+    try:
+        busy = executor.call(_sleep, (0.5,))
+        cancelled = executor.call(_touch, (str(tmp_path / 'ran'),))
+        assert cancelled.cancel()
+        busy.result(timeout=10)
+        assert executor.call(_add, (1, 2)).result(timeout=10) == 3
+        assert not (tmp_path / 'ran').exists()
+        assert executor.in_flight == 0
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def _pid_after(seconds, *variables):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+@pytest.fixture
+def pool_executor():
+    executor = SubprocessExecutor(num_processes=3)
+    executor.start()
+    yield executor
+    executor.terminate()
+    executor.join()
+
+
+def test_least_loaded_dispatch(pool_executor):
+    pids = {proc.pid for proc in pool_executor._procs}
+    # each call goes to an idle process while the others are busy
+    futures = [pool_executor.call(_pid_after, (0.5,)) for _ in range(3)]
+    assert {f.result(timeout=10) for f in futures} == pids
+    assert pool_executor._proc_loads == [0, 0, 0]
+
+
+def test_pinned_and_broadcast_variables(pool_executor):
+    pool_executor.init_variable('broadcast', 1).result(timeout=10)
+    pool_executor.init_variable('pinned', 2, proc_index=2).result(timeout=10)
+    pinned = pool_executor.variable_arg('pinned')
+    broadcast = pool_executor.variable_arg('broadcast')
+    # calls using the pinned variable all run in its process, even while it is busy
+    futures = [pool_executor.call(_pid_after, (0.1, pinned)) for _ in range(4)]
+    assert {f.result(timeout=10) for f in futures} == {pool_executor._procs[2].pid}
+    # the broadcast variable is usable from every process
+    futures = [pool_executor.call(_pid_after, (0.3, broadcast)) for _ in range(3)]
+    assert len({f.result(timeout=10) for f in futures}) == 3
+    # a task cannot use variables pinned to different processes
+    pool_executor.init_variable('other', 3, proc_index=0).result(timeout=10)
+    with pytest.raises(ValueError):
+        pool_executor.call(_pid_after, (0., pinned, pool_executor.variable_arg('other'))).result(timeout=10)
+
+
+def test_overflow_block():
+    executor = SubprocessExecutor(num_processes=2, max_in_flight=2, overflow_policy='block')
+    executor.start()
+    try:
+        busy = [executor.call(_sleep, (0.5,)) for _ in range(2)]
+        start = time.monotonic()
+        # waits for a slot
+        f = executor.call(_add, (1, 2))
+        assert time.monotonic() - start > 0.3
+        assert f.result(timeout=10) == 3
+        assert [b.result(timeout=10) for b in busy] == [None, None]
+        assert executor.rejected_count == executor.dropped_count == 0
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def test_overflow_raise_in_submit_many():
+    executor = SubprocessExecutor(max_in_flight=4, overflow_policy='raise')
+    executor.start()
+    try:
+        with pytest.raises(ExecutorOverloadedError) as e:
+            executor.submit_many(_sleep, [(0.1,)] * 10)
+        # the calls submitted before the limit run to completion
+        assert len(e.value.futures) == 4
+        assert [f.result(timeout=10) for f in e.value.futures] == [None] * 4
+        assert executor.rejected_count == 1
+        assert executor.in_flight == 0
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def test_overflow_drop_oldest():
+    # calls wait for the batch window before being dispatched, so they can still be dropped
+    executor = SubprocessExecutor(max_in_flight=2, overflow_policy='drop_oldest', batch_size=16, batch_window=0.5)
+    executor.start()
+    try:
+        futures = [executor.call(_add, (i, 1)) for i in range(4)]
+        assert futures[0].cancelled() and futures[1].cancelled()
+        assert [f.result(timeout=10) for f in futures[2:]] == [3, 4]
+        assert executor.dropped_count == 2
+        assert executor.in_flight == 0
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def test_cancel_broadcast():
+    executor = SubprocessExecutor(num_processes=2)
+    executor.start()
+    try:
+        busy = [executor.call(_sleep, (0.5,)) for _ in range(2)]
+        f = executor.init_variable('x', 1)
+        assert f.cancel()
+        [b.result(timeout=10) for b in busy]
+        # neither process ran the initialization
+        with pytest.raises(NameError):
+            executor.call(_add, (executor.variable_arg('x'), 1)).result(timeout=10)
+        assert executor.in_flight == 0
+    finally:
+        executor.terminate()
+        executor.join()
+
+
+def _run_async(executor, coroutine_function):
+    async def main():
+        executor.start()
+        try:
+            await coroutine_function(executor)
+        finally:
+            executor.terminate()
+
+    asyncio.run(main())
+
+
+def test_async_calls_and_map():
+    async def check(executor):
+        assert await executor.call(_add, (1, 2)) == 3
+        futures = await executor.submit_many(_add, [(i, 1) for i in range(100)], chunksize=8)
+        assert await asyncio.gather(*futures) == list(range(1, 101))
+        assert [r async for r in executor.map(_add, range(10), range(10))] == list(range(0, 20, 2))
+        unordered = [r async for r in executor.map(_pid_after, [0.3, 0.], ordered=False)]
+        assert len(unordered) == 2
+        with pytest.raises(TaskTimeoutError):
+            await executor.call(_spin, (30,), timeout=0.2)
+        assert executor.in_flight == 0
+
+    _run_async(AsyncSubprocessExecutor(num_processes=2), check)
+
+
+def test_async_variables():
+    async def check(executor):
+        counter = await executor.init_variable('counter', variable_class=_Counter, init_args=(1,))
+        assert await counter.add(2) == 3
+        assert (await executor.get_variable('counter')).value == 3
+        await executor.init_variable('pinned', 5, proc_index=1)
+        assert await executor.call(_pid_after, (0., executor.variable_arg('pinned'))) == executor._procs[1].pid
+        stored = await executor.call(_Counter, (10,), store_as='stored')
+        assert await stored.add(1) == 11
+        await executor.delete_variable('counter')
+        with pytest.raises(NameError):
+            await executor.get_variable('counter')
+
+    _run_async(AsyncSubprocessExecutor(num_processes=2), check)
+
+
+def test_async_overflow_and_cancel(tmp_path):
+    async def check(executor):
+        busy = asyncio.ensure_future(executor.call(_sleep, (0.5,)))
+        await asyncio.sleep(0.1)
+        queued = asyncio.ensure_future(executor.call(_touch, (str(tmp_path / 'ran'),)))
+        await asyncio.sleep(0.1)
+        with pytest.raises(ExecutorOverloadedError):
+            await executor.call(_add, (1, 2))
+        assert executor.rejected_count == 1
+        # cancelling the awaitable cancels the queued call
+        queued.cancel()
+        await busy
+        assert await executor.call(_add, (1, 2)) == 3
+        assert not (tmp_path / 'ran').exists()
+        assert executor.in_flight == 0
+
+    _run_async(AsyncSubprocessExecutor(max_in_flight=2, overflow_policy='raise'), check)
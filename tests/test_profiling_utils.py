@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+import pytest
+
+from utils import profiling_utils
+from utils.profiling_utils import (disable_profiling, enable_profiling, export_chrome_trace, profile_report,
+                                   profile_scope, profile_stats, reset_profiling, start_trace, stop_trace)
+
+
+@pytest.fixture(autouse=True)
+def profiling():
+    reset_profiling()
+    enable_profiling()
+    yield
+    stop_trace()
+    disable_profiling()
+    reset_profiling()
+
+
+@profile_scope('capture')
+def _capture():
+    time.sleep(0.002)
+
+
+def _frame():
+    with profile_scope('frame'):
+        _capture()
+        with profile_scope('encode'):
+            time.sleep(0.001)
+
+
+def test_nested_scopes_build_a_tree():
+    [_frame() for _ in range(5)]
+    _capture()
+    stats = profile_stats()
+    assert sorted(stats) == ['capture', 'frame', 'frame/capture', 'frame/encode']
+    assert [stats[path].histogram.count for path in sorted(stats)] == [1, 5, 5, 5]
+    assert stats['frame/capture'].p50 >= 0.002
+    assert stats['frame'].p50 >= stats['frame/capture'].p50 + stats['frame/encode'].p50
+    lines = profile_report().splitlines()
+    assert [line.split()[0] for line in lines] == ['scope', 'capture', 'frame', 'capture', 'encode']
+    assert lines[3].startswith('  capture')
+
+
+def test_disabled_scopes_record_nothing():
+    disable_profiling()
+    _frame()
+    assert profile_stats() == {}
+
+
+def test_threads_are_merged_and_retired(tmp_path):
+    start_trace()
+    threads = [threading.Thread(target=_frame) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    # each new thread folds the statistics of the exited ones, only the last worker is left
+    _frame()
+    assert len(profiling_utils._thread_states) <= 2
+    stats = profile_stats()
+    assert stats['frame'].histogram.count == 21
+    assert stats['frame/encode'].histogram.count == 21
+    # their trace events are kept
+    export_chrome_trace(str(tmp_path / 'trace.json'))
+    with open(tmp_path / 'trace.json') as f:
+        events = json.load(f)['traceEvents']
+    assert sum(event.get('cat') == 'frame' for event in events) == 21
+
+
+def test_chrome_trace(tmp_path):
+    start_trace()
+    thread = threading.Thread(target=_frame, name='worker')
+    thread.start()
+    thread.join()
+    _frame()
+    stop_trace()
+    _frame()
+    path = tmp_path / 'trace.json'
+    export_chrome_trace(str(path))
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    assert {event['args']['name'] for event in events if event['ph'] == 'M'} >= {'worker', 'MainThread'}
+    scopes = [event for event in events if event['ph'] == 'X']
+    assert sorted(event['cat'] for event in scopes) == ['frame', 'frame', 'frame/capture', 'frame/capture',
+                                                        'frame/encode', 'frame/encode']
+    frame = next(event for event in scopes if event['cat'] == 'frame')
+    children = [event for event in scopes if event['cat'].startswith('frame/') and event['tid'] == frame['tid']]
+    assert all(frame['ts'] <= event['ts'] and event['ts'] + event['dur'] <= frame['ts'] + frame['dur']
+               for event in children)
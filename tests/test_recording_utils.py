@@ -0,0 +1,304 @@
+import os
+import pickle
+import stat
+import sys
+import threading
+import time
+
+import mss
+import numpy as np
+import pytest
+
+from utils.recording_utils import FFmpegEncoder, RawEncoder, ScreenRecorder, VideoEncoder
+
+
+class _FakeShot:
+    def __init__(self, raw):
+        self.raw = raw
+
+
+class _FakeScreen:
+    """
+    Stand-in for mss: a black 640x480 screen whose rectangle <changing> (x, y, width, height)
+    holds the number of the grab divided by <period>, modulo 256. With <tiled> the screen is
+    made of 64 pixel tiles whose blue, green and red are the column, the row and 200.
+    """
+
+    monitors = [None, {'left': 0, 'top': 0, 'width': 640, 'height': 480}]
+    changing = (0, 0, 640, 480)
+    period = 1
+    tiled = False
+    grab_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def grab(self, bbox):
+        _FakeScreen.grab_count += 1
+        screen = np.zeros((480, 640, 4), np.uint8)
+        if self.tiled:
+            screen[..., 0] = np.arange(640)[None] // 64
+            screen[..., 1] = np.arange(480)[:, None] // 64
+            screen[..., 2] = 200
+        x, y, width, height = self.changing
+        screen[y:y + height, x:x + width] = (self.grab_count // self.period) % 256
+        left, top = bbox['left'], bbox['top']
+        return _FakeShot(bytearray(screen[top:top + bbox['height'], left:left + bbox['width']].tobytes()))
+
+
+@pytest.fixture
+def recorder(request, monkeypatch):
+    # the recording process is forked after the patches and grabs from the fake screen
+    monkeypatch.setattr(mss, 'mss', _FakeScreen)
+    for name, value in getattr(request, 'param', {}).items():
+        monkeypatch.setattr(_FakeScreen, name, value)
+    recorder = ScreenRecorder()
+    recorder.wait_until_subprocess_started(10)
+    yield recorder
+    recorder.terminate()
+    recorder.join(10)
+
+
+def _fake_ffmpeg(tmp_path, exit_code):
+    # reads the frames while writing far more than a pipe buffer to stderr, then fails with <exit_code>
+    script = tmp_path / 'ffmpeg'
+    script.write_text(f'#!{sys.executable}\n'
+                      'import sys\n'
+                      'for i in range(20000):\n'
+                      '    sys.stderr.write(f"line {i}\\n")\n'
+                      'sys.stdin.buffer.read()\n'
+                      f'sys.exit({exit_code})\n')
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return str(script)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='the fake ffmpeg is a script')
+def test_ffmpeg_stderr_is_drained(tmp_path):
+    encoder = FFmpegEncoder(ffmpeg=_fake_ffmpeg(tmp_path, 0))
+    encoder.open(str(tmp_path / 'out.mp4'), 30, 64, 48)
+    for _ in range(10):
+        encoder.write(np.zeros((48, 64, 3), np.uint8))
+    encoder.close()
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='the fake ffmpeg is a script')
+def test_ffmpeg_error_has_stderr_tail(tmp_path):
+    encoder = FFmpegEncoder(ffmpeg=_fake_ffmpeg(tmp_path, 3))
+    encoder.open(str(tmp_path / 'out.mp4'), 30, 64, 48)
+    encoder.write(np.zeros((48, 64, 3), np.uint8))
+    with pytest.raises(RuntimeError, match='code 3') as e:
+        encoder.close()
+    assert 'line 19999' in str(e.value)
+    assert 'line 0\n' not in str(e.value)
+
+
+def test_killed_recorder_stops_tap_readers(recorder):
+    session = recorder.start_replay(seconds=1, fps=30, memory_cap=8 << 20)
+    received = []
+    session.subscribe(callback=lambda timestamp, frame: received.append(timestamp))
+    tap = session.subscribe('lossless')
+    iterated = []
+    reader = threading.Thread(target=lambda: iterated.extend(tap), daemon=True)
+    reader.start()
+    time.sleep(0.5)
+    assert received and iterated
+    # a killed recording process never closes the rings of the taps
+    recorder._record_process.kill()
+    reader.join(5)
+    assert not reader.is_alive()
+    start = time.monotonic()
+    recorder.terminate()
+    assert time.monotonic() - start < 5
+    assert tap.get(timeout=0.1) is None
+
+
+class _ListEncoder(VideoEncoder):
+    """
+    Keep the first pixel, the shape, the timestamp and the dirty rectangles of each frame,
+    pickled into <path> on close. Each write takes <write_time> seconds.
+    """
+
+    def __init__(self, path, write_time=0.):
+        self.path = path
+        self.write_time = write_time
+        self.frames = []
+
+    def open(self, record_file, fps, width, height):
+        self.size = (width, height)
+
+    def write(self, img):
+        raise AssertionError('the recorder writes frames with write_frame')
+
+    def write_frame(self, img, timestamp, dirty_rects=None):
+        self.frames.append((img[0, 0].tolist(), img.shape, timestamp, dirty_rects))
+        time.sleep(self.write_time)
+
+    def close(self):
+        with open(self.path, 'wb') as f:
+            pickle.dump((self.size, self.frames), f)
+
+
+def _record(recorder, tmp_path, seconds, write_time=0., **kwargs):
+    path = tmp_path / 'frames.pkl'
+    session = recorder.start_record(None, encoder=_ListEncoder(str(path), write_time), **kwargs)
+    time.sleep(seconds)
+    session.stop(wait=True, timeout=10)
+    with open(path, 'rb') as f:
+        return session, pickle.load(f)
+
+
+@pytest.mark.parametrize('recorder', [{'changing': (64, 40, 40, 20), 'period': 2}], indirect=True)
+def test_dirty_rects_reach_the_encoder(recorder, tmp_path):
+    session, (size, frames) = _record(recorder, tmp_path, 1., fps=20, detect_changes=True)
+    assert size == (640, 480)
+    dirty_rects = [rects for _, _, _, rects in frames]
+    # the whole first frame, then the 32 pixel blocks covering the changing rectangle every other frame
+    assert dirty_rects[0] == [(0, 0, 640, 480)]
+    assert [(64, 32, 64, 32)] in dirty_rects
+    assert [] in dirty_rects
+    assert all(rects in ([], [(64, 32, 64, 32)]) for rects in dirty_rects[1:])
+    # duplicates of late captures change nothing either
+    assert 0 < session.stats['unchanged'] <= dirty_rects.count([])
+
+
+def test_encoder_open_error_reaches_the_parent(recorder, tmp_path):
+    session = recorder.start_record(str(tmp_path / 'out.mp4'),
+                                    encoder=FFmpegEncoder(ffmpeg=str(tmp_path / 'missing')))
+    with pytest.raises(RuntimeError, match='FileNotFoundError'):
+        session.stop(wait=True, timeout=10)
+    assert 'FileNotFoundError' in session.stats['error']
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='the fake ffmpeg is a script')
+def test_encoder_close_error_reaches_the_parent(recorder, tmp_path):
+    session = recorder.start_record(str(tmp_path / 'out.mp4'), fps=10,
+                                    encoder=FFmpegEncoder(ffmpeg=_fake_ffmpeg(tmp_path, 3)))
+    time.sleep(0.3)
+    assert session.error is None
+    with pytest.raises(RuntimeError, match='code 3(.|\\n)*line 19999'):
+        session.stop(wait=True, timeout=10)
+    assert session.stats['error'].startswith('RuntimeError: ffmpeg exited with code 3')
+
+
+def test_session_without_error_stops(recorder, tmp_path):
+    session, (size, frames) = _record(recorder, tmp_path, 0.3, fps=10)
+    assert session.error is None
+    assert len(frames) == session.stats['written']
+
+
+def test_frames_go_through_the_stages(recorder, tmp_path):
+    session, (size, frames) = _record(recorder, tmp_path, 1., fps=20)
+    stats = session.stats
+    assert size == (640, 480)
+    assert all(shape == (480, 640, 3) for _, shape, _, _ in frames)
+    # every grab fills the screen with its number, the frames are encoded in capture order
+    values = [pixel[0] for pixel, _, _, _ in frames]
+    assert values == sorted(values) and values[-1] > values[0]
+    assert stats['captured'] >= 10
+    assert len(frames) == stats['written'] == stats['captured'] + stats['duplicated'] - stats['dropped']
+    metrics = recorder.metrics()
+    assert metrics['frames_captured'] == metrics['frames_converted'] == metrics['frames_encoded'] == stats['captured']
+
+
+@pytest.mark.parametrize('recorder', [{'changing': (0, 0, 0, 0), 'tiled': True}], indirect=True)
+def test_raw_encoder_writes_bgr_crops(recorder, tmp_path):
+    path = tmp_path / 'out.raw'
+    session = recorder.start_record(str(path), bbox=(96, 64, 224, 192), fps=20, encoder=RawEncoder())
+    time.sleep(0.5)
+    session.stop(wait=True, timeout=10)
+    frames = np.fromfile(path, np.uint8).reshape(-1, 128, 128, 3)
+    assert len(frames) == session.stats['written'] > 0
+    expected = np.empty((128, 128, 3), np.uint8)
+    expected[..., 0] = np.arange(96, 224)[None] // 64
+    expected[..., 1] = np.arange(64, 192)[:, None] // 64
+    expected[..., 2] = 200
+    assert (frames == expected).all()
+
+
+def test_captures_keep_their_schedule_with_a_slow_encoder(recorder, tmp_path):
+    session, (size, frames) = _record(recorder, tmp_path, 1.5, write_time=0.25, fps=10, buffer_size=2)
+    stats = session.stats
+    # captures are due every 0.1 s whatever the pace of the encoder, which drops the oldest frames
+    assert abs(stats['captured'] - stats['elapsed_time'] * 10) <= 2
+    assert stats['dropped'] > 0
+    assert len(frames) == stats['written'] < stats['captured']
+    # the frames carry the time of their capture, a whole number of intervals apart
+    timestamps = [timestamp for _, _, timestamp, _ in frames]
+    intervals = np.diff(timestamps) / 0.1
+    assert (intervals > 0.5).all()
+    assert np.abs(intervals - np.round(intervals)).max() < 0.3
+
+
+@pytest.mark.parametrize('recorder', [{'changing': (0, 0, 0, 0)}], indirect=True)
+def test_unchanged_frames_are_not_converted(recorder, tmp_path):
+    session, (size, frames) = _record(recorder, tmp_path, 0.5, fps=20, detect_changes=True)
+    stats = session.stats
+    # only the first frame of a still screen is converted, the encoder writes it again for the others
+    assert stats['unchanged'] == stats['written'] - 1 > 0
+    assert [rects for _, _, _, rects in frames] == [[(0, 0, 640, 480)]] + [[]] * (len(frames) - 1)
+    assert recorder.metrics()['frames_converted'] == 1
+
+
+def _assert_capture_timestamps(timestamps, interval):
+    intervals = np.diff(timestamps) / interval
+    assert (intervals > 0.5).all()
+    assert np.abs(intervals - np.round(intervals)).max() < 0.3
+    # perf_counter of the recording process, the same clock as this one
+    assert 0 < time.perf_counter() - timestamps[-1] < 1.
+
+
+def test_replay_keeps_the_last_frames_downscaled(recorder, tmp_path):
+    session = recorder.start_replay(seconds=1, fps=10, scale=0.5, memory_cap=8 << 20)
+    time.sleep(1.5)
+    path = tmp_path / 'frames.pkl'
+    count = session.save_last(0.5, str(path), _ListEncoder(str(path)))
+    with open(path, 'rb') as f:
+        size, frames = pickle.load(f)
+    assert size == (320, 240)
+    assert 4 <= count == len(frames) <= 6
+    assert all(shape == (240, 320, 3) for _, shape, _, _ in frames)
+    values = [pixel[0] for pixel, _, _, _ in frames]
+    assert values == sorted(values)
+    _assert_capture_timestamps([timestamp for _, _, timestamp, _ in frames], 0.1)
+    # the whole ring holds the last second only
+    assert session.save_last(10, str(path), _ListEncoder(str(path))) <= 11
+    session.close()
+
+
+@pytest.mark.parametrize('recorder', [{'changing': (0, 0, 0, 0), 'tiled': True}], indirect=True)
+def test_sessions_share_the_grab_of_their_union(recorder, tmp_path):
+    paths = [tmp_path / 'first.pkl', tmp_path / 'second.pkl']
+    sessions = [recorder.start_record(None, bbox=(0, 0, 128, 128), fps=10, encoder=_ListEncoder(str(paths[0]))),
+                recorder.start_record(None, bbox=(256, 192, 448, 320), fps=10, encoder=_ListEncoder(str(paths[1])))]
+    time.sleep(1.)
+    [session.stop(wait=True, timeout=10) for session in sessions]
+    results = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            results.append(pickle.load(f))
+    assert [size for size, _ in results] == [(128, 128), (192, 128)]
+    # each session gets its own crop of the grab
+    assert all(pixel == [0, 0, 200] and shape == (128, 128, 3) for pixel, shape, _, _ in results[0][1])
+    assert all(pixel == [4, 3, 200] and shape == (128, 192, 3) for pixel, shape, _, _ in results[1][1])
+    # the sessions are due on the same ticks, each tick grabs the screen once for both
+    captured = [session.stats['captured'] for session in sessions]
+    assert min(captured) >= 5
+    assert recorder.metrics()['screenshots'] <= max(captured) + 1 < sum(captured)
+
+
+def test_taps_get_the_capture_timestamps(recorder, tmp_path):
+    session = recorder.start_record(None, fps=10, encoder=_ListEncoder(str(tmp_path / 'frames.pkl')))
+    tap = session.subscribe('lossless', capacity=8)
+    received = []
+    for timestamp, frame in tap:
+        received.append((timestamp, frame[0, 0, 0]))
+        if len(received) == 8:
+            break
+    _assert_capture_timestamps([timestamp for timestamp, _ in received], 0.1)
+    values = [value for _, value in received]
+    assert values == sorted(values)
+    session.stop(wait=True, timeout=10)
+    tap.close()
@@ -0,0 +1,57 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from utils.concurrent.shared_memory_utils import SharedMemoryAttachments, SharedMemoryPool, share_arrays, \
+    unlink_pool_blocks
+
+
+@pytest.fixture
+def pool():
+    pool = SharedMemoryPool(min_block_size=1 << 12)
+    yield pool
+    pool.close()
+
+
+def _share(pool, array):
+    values = [array]
+    share_arrays(pool, [values])
+    return values[0]
+
+
+def test_attachments_evict_least_recently_used(pool):
+    attachments = SharedMemoryAttachments(max_blocks=2)
+    for i in range(4):
+        assert attachments.array(_share(pool, np.full(16, i)))[0] == i
+    assert len(attachments) == 2
+    attachments.close()
+    assert len(attachments) == 0
+
+
+def test_attachments_keep_viewed_blocks(pool):
+    attachments = SharedMemoryAttachments(max_blocks=1)
+    first = attachments.array(_share(pool, np.arange(16)))
+    second = attachments.array(_share(pool, np.arange(16) + 1))
+    # the first block is still viewed, it cannot be closed yet
+    assert len(attachments) == 2
+    assert (first == np.arange(16)).all() and (second == np.arange(16) + 1).all()
+    attachments.close()
+    assert len(attachments) == 2
+    del first, second
+    attachments.close()
+    assert len(attachments) == 0
+
+
+def test_unlink_pool_blocks():
+    created_count = mp.RawValue('Q', 0)
+    pool = SharedMemoryPool(min_block_size=1 << 12, name_prefix='psm_test_', created_count=created_count)
+    blocks = [pool.lease(16) for _ in range(3)]
+    assert [block.name for block in blocks] == ['psm_test_0', 'psm_test_1', 'psm_test_2']
+    # the process of the pool is gone without closing it
+    [block.close() for block in blocks]
+    unlink_pool_blocks('psm_test_', created_count)
+    for i in range(3):
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=f'psm_test_{i}')
@@ -0,0 +1,17 @@
+import pytest
+
+from utils.concurrent.threading_utils import PeriodicTask
+
+
+@pytest.mark.parametrize('overrun_policy, deadline, coalesced, skipped', [
+    ('catch_up', 1., 0, 0),
+    ('skip', 4., 0, 3),
+    ('coalesce', 3., 2, 0),
+])
+def test_next_deadline_after_overrun(overrun_policy, deadline, coalesced, skipped):
+    task = PeriodicTask(lambda: None, 1., overrun_policy=overrun_policy)
+    task.start_time = 0.
+    # the first run ended during tick 3
+    assert task._next_deadline(3.5) == deadline
+    assert task.coalesced_count == coalesced
+    assert task.skipped_count == skipped
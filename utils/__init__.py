@@ -1 +1,74 @@
+import importlib
+
 from ._windows_application_taskbar_icon_fix import _taskbar_icon_fixed
+
+# Public names are loaded lazily (PEP 562): <from utils import get_logger> only imports
+# logging_utils, and heavy dependencies such as cv2 or matplotlib load on first use.
+_LAZY_ATTRIBUTES = {
+    'get_gpu_usage': 'cuda_utils',
+    'GPUReading': 'cuda_utils',
+    'GPUSampler': 'cuda_utils',
+    'parse_nvidia_smi': 'cuda_utils',
+    'parse_gpu_query_csv': 'cuda_utils',
+    'DeveloperWarning': 'exception_utils',
+    'warn_developers': 'exception_utils',
+    'try_catch_exception': 'exception_utils',
+    'FPSTracker': 'fps_tracker',
+    'LatencyHistogram': 'fps_tracker',
+    'LatencyTracker': 'fps_tracker',
+    'get_current_time_format': 'logging_utils',
+    'get_logger': 'logging_utils',
+    'get_log_queue': 'logging_utils',
+    'attach_log_queue': 'logging_utils',
+    'stop_async_logging': 'logging_utils',
+    'AsyncLogHandler': 'logging_utils',
+    'AsyncLogListener': 'logging_utils',
+    'RateLimitFilter': 'logging_utils',
+    'log_every_n': 'logging_utils',
+    'log_at_most': 'logging_utils',
+    'COLOR_MAPS': 'mpl_color_utils',
+    'BASE_COLORS': 'mpl_color_utils',
+    'TABLEAU_COLORS': 'mpl_color_utils',
+    'XKCD_COLORS': 'mpl_color_utils',
+    'CSS4_COLORS': 'mpl_color_utils',
+    'ColorMap': 'mpl_color_utils',
+    'get_cmap': 'mpl_color_utils',
+    'to_rgb': 'mpl_color_utils',
+    'profile_scope': 'profiling_utils',
+    'enable_profiling': 'profiling_utils',
+    'disable_profiling': 'profiling_utils',
+    'is_profiling_enabled': 'profiling_utils',
+    'start_trace': 'profiling_utils',
+    'stop_trace': 'profiling_utils',
+    'export_chrome_trace': 'profiling_utils',
+    'profile_stats': 'profiling_utils',
+    'profile_report': 'profiling_utils',
+    'reset_profiling': 'profiling_utils',
+    'ScreenRecorder': 'recording_utils',
+    'RecordSession': 'recording_utils',
+    'FrameTap': 'recording_utils',
+    'VideoEncoder': 'recording_utils',
+    'OpenCVEncoder': 'recording_utils',
+    'FFmpegEncoder': 'recording_utils',
+    'RawEncoder': 'recording_utils',
+}
+_SUBMODULES = {'concurrent', 'cuda_utils', 'exception_utils', 'fps_tracker', 'logging_utils',
+               'mpl_color_utils', 'profiling_utils', 'recording_utils'}
+
+__all__ = ['_taskbar_icon_fixed', *_LAZY_ATTRIBUTES]
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{module_name}', __name__), name)
+    # cached, the next lookups do not go through __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | _SUBMODULES)
@@ -0,0 +1,48 @@
+import importlib
+
+# Public names are loaded lazily (PEP 562), so that subprocesses only import the modules they use
+_LAZY_ATTRIBUTES = {
+    'MetricsLayout': 'metrics_utils',
+    'SharedMetrics': 'metrics_utils',
+    'MetricsWriter': 'metrics_utils',
+    'Subprocess': 'multiprocessing_utils',
+    'SubprocessExecutor': 'multiprocessing_utils',
+    'AsyncSubprocessExecutor': 'multiprocessing_utils',
+    'VariableHandle': 'multiprocessing_utils',
+    'ExecutorOverloadedError': 'multiprocessing_utils',
+    'TaskTimeoutError': 'multiprocessing_utils',
+    'BrokenSubprocessError': 'multiprocessing_utils',
+    'SharedArray': 'shared_memory_utils',
+    'SharedMemoryPool': 'shared_memory_utils',
+    'SharedMemoryAttachments': 'shared_memory_utils',
+    'SharedFrameRing': 'shared_memory_utils',
+    'share_arrays': 'shared_memory_utils',
+    'resolve_shared_arrays': 'shared_memory_utils',
+    'sleep': 'threading_utils',
+    'sleep_until': 'threading_utils',
+    'timeit': 'threading_utils',
+    'execute_for': 'threading_utils',
+    'PeriodicScheduler': 'threading_utils',
+    'PeriodicTask': 'threading_utils',
+    'TerminateableThread': 'threading_utils',
+    'ThreadTerminatedError': 'threading_utils',
+}
+_SUBMODULES = {'metrics_utils', 'multiprocessing_utils', 'shared_memory_utils', 'threading_utils'}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{module_name}', __name__), name)
+    # cached, the next lookups do not go through __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | _SUBMODULES)
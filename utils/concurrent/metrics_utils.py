@@ -0,0 +1,149 @@
+from multiprocessing import shared_memory
+
+from ..fps_tracker import LatencyHistogram
+
+__all__ = ['MetricsLayout', 'SharedMetrics', 'MetricsWriter']
+
+_COUNTER = 'counter'
+_GAUGE = 'gauge'
+_HISTOGRAM = 'histogram'
+# count, total, total of squares (float64), min + 1 (0 while empty), max
+_HISTOGRAM_HEADER_CELLS = 5
+
+
+class MetricsLayout:
+    """
+    Picklable declaration of the metrics of a SharedMetrics region. Every one of the
+    <num_writers> writers has its own copy of each metric, so that each 64-bit cell
+    only has a single writer and no lock is needed on either side.
+    """
+
+    def __init__(self, num_writers=1):
+        self.num_writers = num_writers
+        self.metrics = {}
+        self.writer_cells = 0
+
+    def _add(self, name, kind, cells, histogram_params=None):
+        if name in self.metrics:
+            raise ValueError(f'metric {name} is already declared')
+        self.metrics[name] = (kind, self.writer_cells, histogram_params)
+        self.writer_cells += cells
+        return self
+
+    def counter(self, name):
+        return self._add(name, _COUNTER, 1)
+
+    def gauge(self, name):
+        return self._add(name, _GAUGE, 1)
+
+    def histogram(self, name, precision_bits=3, max_value=1 << 40):
+        """
+        Log-linear histogram of integer values, nanoseconds for latencies, see LatencyHistogram
+        """
+        bucket_count = LatencyHistogram(precision_bits, max_value).bucket_count
+        return self._add(name, _HISTOGRAM, _HISTOGRAM_HEADER_CELLS + bucket_count, (precision_bits, max_value))
+
+    @property
+    def nbytes(self):
+        return self.num_writers * self.writer_cells * 8
+
+
+class SharedMetrics:
+    """
+    Metrics region in shared memory, created by the parent process with <layout>
+    and attached by name in the worker processes
+    """
+
+    def __init__(self, layout: MetricsLayout, name=None):
+        self.layout = layout
+        self._owner = name is None
+        self._block = shared_memory.SharedMemory(name=name, create=self._owner, size=max(layout.nbytes, 8))
+        self._buffer = self._block.buf[:layout.nbytes]
+        self._cells = self._buffer.cast('Q')
+        self._float_cells = self._buffer.cast('d')
+        self._histograms = {name: LatencyHistogram(*params) for name, (kind, _, params) in layout.metrics.items()
+                            if kind == _HISTOGRAM}
+
+    @property
+    def name(self):
+        return self._block.name
+
+    def writer(self, index) -> 'MetricsWriter':
+        if not 0 <= index < self.layout.num_writers:
+            raise IndexError(f'writer index {index} out of range [0, {self.layout.num_writers})')
+        return MetricsWriter(self, index * self.layout.writer_cells)
+
+    def _read(self, name, kind, offset, params, writer_indices):
+        cells, float_cells = self._cells, self._float_cells
+        offsets = [i * self.layout.writer_cells + offset for i in writer_indices]
+        if kind == _COUNTER:
+            return sum(cells[o] for o in offsets)
+        elif kind == _GAUGE:
+            return sum(float_cells[o] for o in offsets)
+        histogram = LatencyHistogram(*params)
+        bucket_count = self._histograms[name].bucket_count
+        for o in offsets:
+            if cells[o]:
+                histogram.add_counts(cells[o + _HISTOGRAM_HEADER_CELLS:o + _HISTOGRAM_HEADER_CELLS + bucket_count],
+                                     cells[o + 1],
+                                     float_cells[o + 2],
+                                     cells[o + 3] - 1,
+                                     cells[o + 4])
+        return histogram
+
+    def snapshot(self, writer_indices=None):
+        """
+        Read the metrics without lock, summed over the writers of <writer_indices> or
+        all of them: counters and gauges as numbers, histograms as LatencyHistogram.
+        The values of a metric being written may be a single update apart.
+        """
+        writer_indices = range(self.layout.num_writers) if writer_indices is None else writer_indices
+        return {name: self._read(name, kind, offset, params, writer_indices)
+                for name, (kind, offset, params) in self.layout.metrics.items()}
+
+    def close(self):
+        # the memoryview casts export the buffer of the block, which cannot be closed while they are alive.
+        # The writers share these casts, they cannot be used anymore once released
+        self._cells.release()
+        self._float_cells.release()
+        self._buffer.release()
+        self._block.close()
+        if self._owner:
+            self._block.unlink()
+
+    def __reduce__(self):
+        # sent to a worker process, it attaches the same block
+        return SharedMetrics, (self.layout, self.name)
+
+
+class MetricsWriter:
+    """
+    Writer of the metrics of a single thread or process, owning its cells of the region
+    """
+
+    def __init__(self, metrics: SharedMetrics, base_offset):
+        self._metrics = metrics
+        self._cells = metrics._cells
+        self._float_cells = metrics._float_cells
+        self._offsets = {name: base_offset + offset for name, (_, offset, _) in metrics.layout.metrics.items()}
+        self._histograms = metrics._histograms
+
+    def inc(self, name, value=1):
+        self._cells[self._offsets[name]] += value
+
+    def set(self, name, value):
+        self._float_cells[self._offsets[name]] = value
+
+    def observe(self, name, value):
+        value = int(value)
+        offset = self._offsets[name]
+        cells = self._cells
+        cells[offset + _HISTOGRAM_HEADER_CELLS + self._histograms[name].bucket_index(value)] += 1
+        cells[offset + 1] += value
+        self._float_cells[offset + 2] += float(value) * value
+        if not cells[offset + 3] or value + 1 < cells[offset + 3]:
+            cells[offset + 3] = value + 1
+        if value > cells[offset + 4]:
+            cells[offset + 4] = value
+        # the count is written last, readers skip the histograms of writers with no count
+        cells[offset] += 1
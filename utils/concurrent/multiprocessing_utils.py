@@ -1,14 +1,53 @@
+import collections
+import copy
+import functools
+import itertools
 import multiprocessing as mp
+import multiprocessing.connection
+import os
 import queue
+import secrets
 import threading
+import time
+import weakref
 from collections import UserDict
-from concurrent.futures import as_completed, wait, Future
+from concurrent.futures import as_completed, wait, Future, BrokenExecutor, CancelledError, InvalidStateError
+from multiprocessing import resource_tracker
+from typing import TYPE_CHECKING
 
 from .threading_utils import TerminateableThread, ThreadTerminatedError
 
-__all__ = ['Subprocess', 'SubprocessExecutor',
+if TYPE_CHECKING:
+    # imported by the AsyncSubprocessExecutor methods only, for the callers of the sync executor
+    import asyncio
+
+__all__ = ['Subprocess', 'SubprocessExecutor', 'AsyncSubprocessExecutor', 'VariableHandle',
+           'ExecutorOverloadedError', 'TaskTimeoutError', 'BrokenSubprocessError',
            'as_completed', 'wait', 'Future']
 
+_OVERFLOW_POLICIES = ('block', 'raise', 'drop_oldest')
+_SUPERVISE_INTERVAL = 0.1
+_CANCELLED_WORK_SLOTS = 4096
+
+
+class ExecutorOverloadedError(queue.Full):
+    """
+    Raised by a submission beyond max_in_flight works with the 'raise' overflow policy,
+    <futures> are those of the calls submit_many submitted before it was raised
+    """
+
+    def __init__(self, *args, futures=()):
+        super(ExecutorOverloadedError, self).__init__(*args)
+        self.futures = list(futures)
+
+
+class TaskTimeoutError(TimeoutError):
+    pass
+
+
+class BrokenSubprocessError(BrokenExecutor):
+    pass
+
 
 class VariableArg:
     def __init__(self, variable_name):
@@ -55,17 +94,184 @@ class _DeleteVariableTask(_Task):
 
 
 class _CallTask(_Task):
-    def __init__(self, work_id, fn, args=(), kwargs={}):
+    def __init__(self, work_id, fn, args=(), kwargs={}, deadline=None, store_as=None):
         super(_CallTask, self).__init__(work_id)
         self.fn = fn
         self.args = list(args)
-        self.kwargs = kwargs
+        self.kwargs = dict(kwargs)
+        # time.monotonic() deadline, the clock is system-wide so it is valid in the subprocess too
+        self.deadline = deadline
+        # name of the variable the result is stored in instead of being sent back
+        self.store_as = store_as
+        # name of the shared memory block holding the ndarray arguments
+        self.shared_memory_block = None
+        # time.perf_counter_ns() of the submission, the clock is system-wide as well
+        self.submit_time = None
+
+
+class _VariableMember:
+    """
+    Method or attribute of a variable living in the subprocess, used in place of a call target
+    """
+
+    def __init__(self, variable_name, member_name, is_attribute=False):
+        self.variable_name = variable_name
+        self.member_name = member_name
+        self.is_attribute = is_attribute
+
+    def resolve(self, variable_dict):
+        member = getattr(variable_dict[self.variable_name], self.member_name)
+        return (lambda: member) if self.is_attribute else member
+
+
+class _FunctionRef:
+    """
+    Call target sent by id, the function itself is only pickled the first time
+    it is sent to a subprocess, which caches it until its id is in <forgotten_ids>
+    """
+
+    def __init__(self, fn_id, fn=None, forgotten_ids=()):
+        self.fn_id = fn_id
+        self.fn = fn
+        self.forgotten_ids = forgotten_ids
+
+
+class _FunctionCache:
+    def __init__(self, timeout=10.):
+        self.timeout = timeout
+        self._functions = {}
+        self._condition = threading.Condition()
+
+    def resolve(self, function_ref):
+        if function_ref.forgotten_ids:
+            with self._condition:
+                for fn_id in function_ref.forgotten_ids:
+                    self._functions.pop(fn_id, None)
+        if function_ref.fn is not None:
+            with self._condition:
+                self._functions[function_ref.fn_id] = function_ref.fn
+                self._condition.notify_all()
+            return function_ref.fn
+        fn = self._functions.get(function_ref.fn_id)
+        if fn is None:
+            # another executor thread may still be unpickling the task carrying the function
+            with self._condition:
+                if not self._condition.wait_for(lambda: function_ref.fn_id in self._functions, self.timeout):
+                    raise LookupError(f'function {function_ref.fn_id} was never sent to this subprocess')
+                fn = self._functions[function_ref.fn_id]
+        return fn
+
+
+def _method_names(variable_type):
+    return frozenset(name for name in dir(variable_type)
+                     if not name.startswith('_') and callable(getattr(variable_type, name, None)))
+
+
+class VariableHandle(Future):
+    """
+    Proxy of a variable living in the subprocesses of an executor, also the future
+    of the task creating it. handle.method(*args, **kwargs) calls a method of the
+    resident object and returns the future of its result, without sending the object.
+    Only the public methods of the type of the variable, known once it is created,
+    are proxied. Handles can be passed as call arguments in place of variable_arg(name).
+    Use call_method for methods whose name is an attribute of Future, or for callable
+    instance attributes.
+    """
+
+    def __init__(self, executor, variable_name, method_names=None):
+        super(VariableHandle, self).__init__()
+        self._executor = executor
+        self._method_names = method_names
+        self.variable_name = variable_name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._method_names is None:
+            # the methods of a stored call result are known once it is stored
+            self.result()
+        if name not in self._method_names:
+            raise AttributeError(f'variable {self.variable_name!r} has no method {name!r}')
+        return lambda *args, **kwargs: self.call_method(name, args, kwargs)
+
+    def _on_stored(self, f):
+        if self.done():
+            # cancelled by its owner
+            return
+        if f.cancelled():
+            self.cancel()
+        elif f.exception() is not None:
+            self.set_exception(f.exception())
+        else:
+            # the task storing the variable returns the names of its methods
+            self._method_names = f.result()
+            self.set_result(None)
+
+    def call_method(self, method_name, args=(), kwargs={}, timeout=None, store_as=None):
+        return self._executor._call_member(_VariableMember(self.variable_name, method_name),
+                                           args, kwargs, timeout, store_as)
+
+    def get_attribute(self, attribute_name):
+        return self._executor._call_member(_VariableMember(self.variable_name, attribute_name, is_attribute=True))
+
+    def variable_arg(self):
+        return VariableArg(self.variable_name)
+
+    def get_value(self):
+        return self._executor.get_variable(self.variable_name)
+
+    def delete(self):
+        return self._executor.delete_variable(self.variable_name)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.variable_name!r} {super(VariableHandle, self).__repr__()[1:-1]}>'
+
+
+def _copy_future_state(source, destination):
+    """
+    Copy the outcome of the done future <source> into <destination>, concurrent or asyncio,
+    unless <destination> is already done, e.g. cancelled by its awaiter
+    """
+    if destination.done():
+        return
+    if source.cancelled():
+        destination.cancel()
+    elif source.exception() is not None:
+        destination.set_exception(source.exception())
+    else:
+        destination.set_result(source.result())
+
+
+def _chain_future(source: Future, destination: Future):
+    source.add_done_callback(functools.partial(_copy_future_state, destination=destination))
+    # cancelling the destination cancels the work behind it
+    destination.add_done_callback(lambda d: source.cancel() if d.cancelled() else None)
+    return destination
+
+
+class _WorkFuture(Future):
+    """
+    Future notifying its executor when it is cancelled
+    """
+
+    def __init__(self, executor, work_id):
+        super(_WorkFuture, self).__init__()
+        self._executor = executor
+        self._work_id = work_id
+
+    def cancel(self):
+        if not super(_WorkFuture, self).cancel():
+            return False
+        self._executor._on_work_cancelled(self._work_id)
+        return True
 
 
 class _WorkItem(object):
-    def __init__(self, future: Future, task: _Task):
+    def __init__(self, future: Future, task: _Task, proc_index=None):
         self.future = future
         self.task = task
+        self.proc_index = proc_index
+        self.dispatched = False
 
     @property
     def id(self):
@@ -77,6 +283,33 @@ class _ResultItem(object):
         self.work_id = work_id
         self.exception = exception
         self.result = result
+        # name of the shared memory block holding the ndarray results
+        self.shared_memory_block = None
+
+
+def _result_containers(result):
+    # ndarrays are detected in the result itself or in the items of a tuple or list result
+    return list(result) if type(result) in (tuple, list) else [result]
+
+
+def _share_result(result_item, shared_memory_pool, threshold):
+    from .shared_memory_utils import share_arrays
+
+    values = _result_containers(result_item.result)
+    result_item.shared_memory_block = share_arrays(shared_memory_pool, [values], threshold)
+    if result_item.shared_memory_block is not None:
+        result_item.result = type(result_item.result)(values) \
+            if type(result_item.result) in (tuple, list) else values[0]
+
+
+def _resolve_result(result_item, shared_memory_attachments):
+    from .shared_memory_utils import resolve_shared_arrays
+
+    # results are copied out so the block can be handed back to the subprocess pool
+    values = _result_containers(result_item.result)
+    resolve_shared_arrays(shared_memory_attachments, [values], copy=True)
+    result_item.result = type(result_item.result)(values) \
+        if type(result_item.result) in (tuple, list) else values[0]
 
 
 class _VariableDict(UserDict):
@@ -87,67 +320,299 @@ class _VariableDict(UserDict):
             raise NameError(f'variable {item} is not defined')
 
 
-def _task_execution_worker(variable_dict,
+class _TaskWatchdog:
+    """
+    Interrupts the executor threads still running a call past its deadline
+    """
+
+    def __init__(self, executor_threads):
+        self._executor_threads = executor_threads
+        self._deadlines = {}
+        self._condition = threading.Condition()
+
+    def start_task(self, deadline):
+        with self._condition:
+            self._deadlines[threading.get_ident()] = deadline
+            self._condition.notify()
+
+    def finish_task(self):
+        # the interruption is raised while holding the lock, so once this returns
+        # the pending exception (if any) is raised before leaving the task
+        with self._condition:
+            self._deadlines.pop(threading.get_ident(), None)
+
+    def run(self):
+        threads = {thread.ident: thread for thread in self._executor_threads}
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                for thread_id, deadline in list(self._deadlines.items()):
+                    if deadline <= now:
+                        del self._deadlines[thread_id]
+                        threads[thread_id].raise_exception(TaskTimeoutError)
+                next_deadline = min(self._deadlines.values(), default=None)
+                self._condition.wait(next_deadline - now if next_deadline is not None else None)
+
+
+class _CancelledWorks:
+    """
+    Works cancelled by the parent after being dispatched, flagged in an array shared with it:
+    work w is cancelled while its slot w % len(<slots>) holds w + 1. The array never grows,
+    a cancellation sharing the slot of an earlier one replaces it, and the earlier work then
+    runs and its result is discarded by the parent.
+    """
+
+    def __init__(self, slots):
+        self._slots = slots
+
+    def pop(self, work_id):
+        """
+        Whether <work_id> is cancelled, clearing its flag
+        """
+        slot = work_id % len(self._slots)
+        if self._slots[slot] != work_id + 1:
+            return False
+        self._slots[slot] = 0
+        return True
+
+
+class _WorkerContext:
+    """
+    State shared by the executor threads of a subprocess
+    """
+
+    def __init__(self,
+                 variable_dict,
+                 shared_memory_pool=None,
+                 shared_memory_attachments=None,
+                 shared_memory_threshold=0,
+                 watchdog=None,
+                 cancelled_works=None):
+        self.variable_dict = variable_dict
+        self.shared_memory_pool = shared_memory_pool
+        self.shared_memory_attachments = shared_memory_attachments
+        self.shared_memory_threshold = shared_memory_threshold
+        self.watchdog = watchdog
+        self.cancelled_works = cancelled_works
+        self.functions = _FunctionCache()
+
+
+def _execute_task(result_item, task, context: _WorkerContext):
+    try:
+        if isinstance(task, _CallTask):
+            if task.deadline is not None:
+                if task.deadline <= time.monotonic():
+                    raise TaskTimeoutError('deadline expired before the call started')
+                context.watchdog.start_task(task.deadline)
+                try:
+                    _execute_call_task(result_item, task, context)
+                finally:
+                    context.watchdog.finish_task()
+            else:
+                _execute_call_task(result_item, task, context)
+            if task.store_as is not None:
+                context.variable_dict[task.store_as] = result_item.result
+                result_item.result = _method_names(type(result_item.result))
+            elif context.shared_memory_pool is not None and result_item.work_id is not None:
+                _share_result(result_item, context.shared_memory_pool, context.shared_memory_threshold)
+        elif isinstance(task, _InitVariableTask):
+            context.variable_dict[task.variable_name] = task()
+        elif isinstance(task, _GetVariableTask):
+            result_item.result = context.variable_dict[task.variable_name]
+        elif isinstance(task, _DeleteVariableTask):
+            context.variable_dict.pop(task.variable_name)
+    except ThreadTerminatedError as e:
+        result_item.exception = e
+        raise e
+    except Exception as e:
+        result_item.exception = e
+
+
+def _execute_call_task(result_item, task, context: _WorkerContext):
+    variable_dict = context.variable_dict
+    for i, v in enumerate(task.args):
+        if isinstance(v, VariableArg):
+            task.args[i] = variable_dict[v.variable_name]
+    for k, v in task.kwargs.items():
+        if isinstance(v, VariableArg):
+            task.kwargs[k] = variable_dict[v.variable_name]
+    if task.shared_memory_block is not None:
+        from .shared_memory_utils import resolve_shared_arrays
+
+        # the arguments are views on the shared memory, only valid during the call
+        resolve_shared_arrays(context.shared_memory_attachments, [task.args, task.kwargs])
+    fn = task.fn.resolve(variable_dict) if isinstance(task.fn, _VariableMember) else task.fn
+    result_item.result = fn(*task.args, **task.kwargs)
+
+
+def _release_shared_memory_worker(release_reader, shared_memory_pool):
+    """
+    Release the result blocks the parent has copied out, on a pipe of their own so that
+    the parent never waits on the task queue, which may be full, to hand them back
+    """
+    while True:
+        try:
+            block_names = release_reader.recv()
+        except EOFError:
+            return
+        for block_name in block_names:
+            try:
+                shared_memory_pool.release(block_name)
+            except KeyError:
+                # result of the process this one replaced, read just before the restart
+                pass
+
+
+def _executor_metrics_layout(num_writers):
+    from .metrics_utils import MetricsLayout
+
+    return (MetricsLayout(num_writers)
+            .counter('tasks_completed')
+            .counter('tasks_failed')
+            .counter('busy_ns')
+            .histogram('task_latency_ns')
+            .histogram('queue_wait_ns'))
+
+
+def _observe_call_task(metrics_writer, task, start, end, failed):
+    if task.submit_time is not None:
+        metrics_writer.observe('queue_wait_ns', start - task.submit_time)
+    metrics_writer.observe('task_latency_ns', end - start)
+    metrics_writer.inc('busy_ns', end - start)
+    metrics_writer.inc('tasks_failed' if failed else 'tasks_completed')
+
+
+def _task_execution_worker(context: _WorkerContext,
                            task_queue,
-                           result_queue):
+                           result_queue,
+                           metrics_writer=None):
     while True:
-        task = task_queue.get()
-        result_item = _ResultItem(task.work_id)
+        # a list of tasks is a batch, its results are sent back together in one list
+        tasks = task_queue.get()
+        is_batch = isinstance(tasks, list)
+        result_items = []
         try:
-            if isinstance(task, _CallTask):
-                for i, v in enumerate(task.args):
-                    if isinstance(v, VariableArg):
-                        task.args[i] = variable_dict[v.variable_name]
-                for k, v in task.kwargs.items():
-                    if isinstance(v, VariableArg):
-                        task.kwargs[k] = variable_dict[v.variable_name]
-                result_item.result = task.fn(*task.args, **task.kwargs)
-            elif isinstance(task, _InitVariableTask):
-                variable_dict[task.variable_name] = task()
-            elif isinstance(task, _GetVariableTask):
-                result_item.result = variable_dict[task.variable_name]
-            elif isinstance(task, _DeleteVariableTask):
-                variable_dict.pop(task.variable_name)
-        except ThreadTerminatedError as e:
-            result_item.exception = e
-            raise e
-        except Exception as e:
-            result_item.exception = e
+            for task in (tasks if is_batch else [tasks]):
+                result_item = _ResultItem(task.work_id)
+                if result_item.work_id is not None:
+                    result_items.append(result_item)
+                if isinstance(task, _CallTask) and isinstance(task.fn, _FunctionRef):
+                    # functions sent with the task are cached even if the work is then skipped
+                    try:
+                        task.fn = context.functions.resolve(task.fn)
+                    except LookupError as e:
+                        result_item.exception = e
+                        continue
+                if result_item.work_id is not None:
+                    if context.cancelled_works is not None and context.cancelled_works.pop(task.work_id):
+                        result_item.exception = CancelledError()
+                        continue
+                start = time.perf_counter_ns()
+                try:
+                    _execute_task(result_item, task, context)
+                except TaskTimeoutError as e:
+                    # interruption delivered right after the call has finished
+                    result_item.exception = e
+                finally:
+                    if result_item.work_id is not None and context.cancelled_works is not None:
+                        # cancelled while running, the flag goes with the result
+                        context.cancelled_works.pop(task.work_id)
+                    if metrics_writer is not None and isinstance(task, _CallTask):
+                        _observe_call_task(metrics_writer, task, start, time.perf_counter_ns(),
+                                           result_item.exception is not None)
         finally:
-            if result_item.work_id is not None:
-                result_queue.put(result_item)
+            if len(result_items):
+                result_queue.put(result_items if is_batch else result_items[0])
 
 
 class Subprocess(mp.Process):
     def __init__(self,
                  task_queue: mp.SimpleQueue = None,
                  result_queue: mp.SimpleQueue = None,
-                 group=None, name=None, *, max_workers=1, daemon=None):
+                 group=None, name=None, *, max_workers=1,
+                 shared_memory=False, shared_memory_threshold=1 << 16,
+                 metrics=None, metrics_writer_offset=0, daemon=None):
+        """
+        With <metrics>, a SharedMetrics of _executor_metrics_layout, executor thread i
+        publishes the metrics of its calls as writer <metrics_writer_offset> + i
+        """
         super(Subprocess, self).__init__(group=group, name=name, daemon=daemon)
         self._task_queue = task_queue if task_queue is not None else mp.SimpleQueue()
         self._result_queue = result_queue if result_queue is not None else mp.SimpleQueue()
         self.max_workers = max_workers
+        self.shared_memory = shared_memory
+        self.shared_memory_threshold = shared_memory_threshold
+        self.metrics = metrics
+        self.metrics_writer_offset = metrics_writer_offset
+        # flags of the works cancelled after being dispatched, see _CancelledWorks
+        self._cancelled_slots = mp.RawArray('Q', _CANCELLED_WORK_SLOTS)
+        # names of the result blocks to release, written by the parent only
+        self._release_reader, self._release_writer = mp.Pipe(duplex=False) if shared_memory else (None, None)
+        # the blocks of the subprocess pool are named after the prefix and counted,
+        # so the parent can unlink them if the subprocess is killed
+        self._shared_memory_prefix = f'psm_{secrets.token_hex(4)}_'
+        self._shared_memory_count = mp.RawValue('Q', 0) if shared_memory else None
 
         self._variables = _VariableDict()
         self._task_executor_threads = []
 
     def run(self):
-        self._task_executor_threads = [
+        shared_memory_pool = shared_memory_attachments = None
+        if self.shared_memory:
+            from .shared_memory_utils import SharedMemoryPool, SharedMemoryAttachments
+
+            shared_memory_pool = SharedMemoryPool(name_prefix=self._shared_memory_prefix,
+                                                  created_count=self._shared_memory_count)
+            shared_memory_attachments = SharedMemoryAttachments()
+        self._task_executor_threads = []
+        context = _WorkerContext(self._variables,
+                                 shared_memory_pool,
+                                 shared_memory_attachments,
+                                 self.shared_memory_threshold,
+                                 _TaskWatchdog(self._task_executor_threads),
+                                 _CancelledWorks(self._cancelled_slots))
+        self._task_executor_threads.extend(
             TerminateableThread(target=_task_execution_worker,
-                                args=(self._variables,
+                                args=(context,
                                       self._task_queue,
-                                      self._result_queue),
+                                      self._result_queue,
+                                      self.metrics.writer(self.metrics_writer_offset + i)
+                                      if self.metrics is not None else None),
                                 raise_exception=True,
                                 daemon=True)
-            for _ in range(self.max_workers)
-        ]
+            for i in range(self.max_workers)
+        )
         [thread.start() for thread in self._task_executor_threads]
-        [thread.join() for thread in self._task_executor_threads]
+        threading.Thread(target=context.watchdog.run, daemon=True).start()
+        if shared_memory_pool is not None:
+            threading.Thread(target=_release_shared_memory_worker,
+                             args=(self._release_reader, shared_memory_pool),
+                             daemon=True).start()
+        try:
+            [thread.join() for thread in self._task_executor_threads]
+        finally:
+            if shared_memory_pool is not None:
+                shared_memory_pool.close()
+
+    def start(self):
+        super(Subprocess, self).start()
+        if self._release_reader is not None:
+            # once the subprocess is gone, releasing fails at once instead of filling the pipe
+            self._release_reader.close()
 
     def terminate(self):
         super(Subprocess, self).terminate()
         [thread.terminate() for thread in self._task_executor_threads]
 
+    def _unlink_shared_memory(self):
+        """
+        Unlink the blocks of the subprocess pool, once it has exited without closing them
+        """
+        if self._shared_memory_count is not None:
+            from .shared_memory_utils import unlink_pool_blocks
+
+            unlink_pool_blocks(self._shared_memory_prefix, self._shared_memory_count)
+
     @staticmethod
     def variable_arg(variable_name):
         return VariableArg(variable_name)
@@ -175,151 +640,1143 @@ class Subprocess(mp.Process):
                                        kwargs))
 
 
-def _add_call_item_to_queue(pending_work_items,
-                            work_ids_queue,
-                            task_queue):
-    while True:
-        if task_queue.full():
-            return
+def _task_variable_names(task):
+    if isinstance(task, _CallTask):
+        variable_names = [v.variable_name for v in [*task.args, *task.kwargs.values()]
+                          if isinstance(v, VariableArg)]
+        if isinstance(task.fn, _VariableMember):
+            variable_names.append(task.fn.variable_name)
+        return variable_names
+    elif isinstance(task, (_GetVariableTask, _DeleteVariableTask)):
+        return [task.variable_name]
+    return []
+
+
+def _select_process(work_item, proc_loads, variable_owners):
+    if work_item.proc_index is not None:
+        return work_item.proc_index
+    # variables pinned to a single process force the task onto that process
+    owners = {variable_owners[variable_name]
+              for variable_name in _task_variable_names(work_item.task)
+              if variable_owners.get(variable_name) is not None}
+    if len(owners) > 1:
+        raise ValueError(f'task uses variables pinned to different processes {sorted(owners)}')
+    elif len(owners) == 1:
+        return owners.pop()
+    # least-loaded dispatch, ties are broken by the lowest process index
+    return min(range(len(proc_loads)), key=proc_loads.__getitem__)
+
+
+def _get_work_ids(work_ids_queue, batch_size=1, batch_window=0.):
+    """
+    Block for the next submitted work ids, then coalesce following submissions
+    until <batch_size> ids are collected or <batch_window> seconds have passed
+    """
+    # an entry of the queue is either a single work id or a chunk of them
+    entry = work_ids_queue.get()
+    work_ids = entry if isinstance(entry, list) else [entry]
+    deadline = time.monotonic() + batch_window
+    while len(work_ids) < batch_size:
+        timeout = deadline - time.monotonic()
         try:
-            work_id = work_ids_queue.get(block=False)
+            entry = work_ids_queue.get(timeout=timeout) if timeout > 0 else work_ids_queue.get(block=False)
         except queue.Empty:
-            return
-        else:
-            work_item = pending_work_items[work_id]
+            break
+        work_ids.extend(entry if isinstance(entry, list) else [entry])
+    return work_ids
 
-            if work_item.future.set_running_or_notify_cancel():
-                task_queue.put(work_item.task, block=True)
-            else:
-                del pending_work_items[work_id]
-                continue
+
+def _abandon_work_item(work_item,
+                       in_flight_limiter,
+                       shared_memory_pool=None,
+                       exception=None):
+    """
+    Finish a work item removed from the pending works without a result
+    """
+    in_flight_limiter.release()
+    if getattr(work_item.task, 'shared_memory_block', None) is not None:
+        shared_memory_pool.release(work_item.task.shared_memory_block)
+    if work_item.future.cancelled():
+        return
+    if exception is not None:
+        work_item.future.set_exception(exception)
+    else:
+        work_item.future.cancel()
+
+
+def _fail_dispatched_work_item(work_item,
+                               pending_work_items,
+                               proc_loads,
+                               dispatch_lock,
+                               in_flight_limiter,
+                               shared_memory_pool,
+                               exception):
+    with dispatch_lock:
+        if pending_work_items.pop(work_item.id, None) is None:
+            # already failed by a restart of its subprocess
+            return
+        proc_loads[work_item.proc_index] -= 1
+    _abandon_work_item(work_item, in_flight_limiter, shared_memory_pool, exception)
 
 
 def _work_management_worker(pending_work_items,
                             work_ids_queue,
-                            task_queue):
+                            task_queues,
+                            proc_loads,
+                            variable_owners,
+                            dispatch_lock,
+                            in_flight_limiter,
+                            shared_memory_pool=None,
+                            batch_size=1,
+                            batch_window=0.,
+                            on_dispatch=None,
+                            on_dispatch_failed=None):
     while True:
-        work_id = work_ids_queue.get()
-        task_queue.put(pending_work_items[work_id].task)
+        batches = {}
+        for work_id in _get_work_ids(work_ids_queue, batch_size, batch_window):
+            exception = None
+            with dispatch_lock:
+                work_item = pending_work_items.get(work_id)
+                # work_item can be None if it was dropped by the overflow policy
+                if work_item is None:
+                    continue
+                if work_item.future.cancelled():
+                    # cancelled before being dispatched, it never reaches the subprocess
+                    del pending_work_items[work_id]
+                elif getattr(work_item.task, 'deadline', None) is not None \
+                        and work_item.task.deadline <= time.monotonic():
+                    del pending_work_items[work_id]
+                    exception = TaskTimeoutError('deadline expired before the call was dispatched')
+                else:
+                    try:
+                        work_item.proc_index = _select_process(work_item, proc_loads, variable_owners)
+                    except Exception as e:
+                        del pending_work_items[work_id]
+                        exception = e
+                    else:
+                        proc_loads[work_item.proc_index] += 1
+                        work_item.dispatched = True
+                        # on_dispatch returns the task actually sent, called under the dispatch lock
+                        batches.setdefault(work_item.proc_index, []).append(
+                            (work_item, on_dispatch(work_item) if on_dispatch is not None else work_item.task))
+                        continue
+            _abandon_work_item(work_item, in_flight_limiter, shared_memory_pool, exception)
+        for proc_index, batch in batches.items():
+            tasks = [task for _, task in batch]
+            try:
+                task_queues[proc_index].put(tasks if len(tasks) > 1 else tasks[0])
+                continue
+            except OSError:
+                # the queue was closed by a restart of the subprocess, which already failed these works
+                continue
+            except Exception:
+                # a task could not be pickled, nothing of the batch was written
+                pass
+            if on_dispatch_failed is not None:
+                on_dispatch_failed(proc_index, tasks)
+            # the submitted tasks are sent one by one, with their functions by value,
+            # so that only those which cannot be pickled fail
+            for work_item, _ in batch:
+                try:
+                    task_queues[proc_index].put(work_item.task)
+                except OSError:
+                    break
+                except Exception as e:
+                    _fail_dispatched_work_item(work_item, pending_work_items, proc_loads, dispatch_lock,
+                                               in_flight_limiter, shared_memory_pool, e)
 
 
-def _result_management_worker(pending_work_items,
-                              result_queue: mp.SimpleQueue):
-    # result_reader = result_queue._reader
-    while True:
-        # _add_call_item_to_queue(pending_work_items, work_ids_queue, task_queue)
+def _drain_result_queue(result_queue, max_items=1024):
+    """
+    Read every result that is already waiting in the queue, flattening result batches
+    """
+    result_items = []
+    while len(result_items) < max_items:
+        result = result_queue.get()
+        result_items.extend(result if isinstance(result, list) else [result])
+        if result_queue.empty():
+            break
+    return result_items
+
 
-        # ready = mp.connection.wait([result_reader])
-        # if result_reader in ready:
-        #     result_item = result_reader.recv()
-        result_item = result_queue.get()
+def _handle_result_items(result_items,
+                         proc_index,
+                         pending_work_items,
+                         procs,
+                         proc_loads,
+                         dispatch_lock,
+                         in_flight_limiter,
+                         shared_memory_pool=None,
+                         shared_memory_attachments=None):
+    block_names = [result_item.shared_memory_block
+                   for result_item in result_items if result_item.shared_memory_block is not None]
+    for result_item in result_items:
+        if result_item.shared_memory_block is not None:
+            _resolve_result(result_item, shared_memory_attachments)
+    if len(block_names):
+        try:
+            procs[proc_index]._release_writer.send(block_names)
+        except OSError:
+            # the subprocess exited or was restarted, its pool went with it
+            pass
 
+    for result_item in result_items:
         work_item = pending_work_items.pop(result_item.work_id, None)
         # work_item can be None if another process terminated (see above)
         if work_item is not None:
-            if result_item.exception:
-                work_item.future.set_exception(result_item.exception)
-            else:
-                work_item.future.set_result(result_item.result)
+            with dispatch_lock:
+                proc_loads[work_item.proc_index] -= 1
+            in_flight_limiter.release()
+            if getattr(work_item.task, 'shared_memory_block', None) is not None:
+                shared_memory_pool.release(work_item.task.shared_memory_block)
+            try:
+                if result_item.exception:
+                    work_item.future.set_exception(result_item.exception)
+                else:
+                    work_item.future.set_result(result_item.result)
+            except InvalidStateError:
+                # the future was cancelled after its work had been dispatched
+                pass
             del work_item
-        del result_item
+
+
+def _result_management_worker(pending_work_items,
+                              procs,
+                              result_queues,
+                              proc_loads,
+                              dispatch_lock,
+                              in_flight_limiter,
+                              shared_memory_pool=None,
+                              shared_memory_attachments=None,
+                              supervise=None):
+    next_supervise_time = time.monotonic()
+    while True:
+        # queues and processes are replaced in place when a subprocess is restarted
+        result_readers = {result_queue._reader: proc_index for proc_index, result_queue in enumerate(result_queues)}
+        # sentinels wake the thread up as soon as a subprocess dies, once: the sentinel of an exited
+        # subprocess stays ready, the thread would spin on it after terminate or until the restart
+        sentinels = [proc.sentinel for proc in procs
+                     if proc.pid is not None and proc.exitcode is None] if supervise is not None else []
+        ready = mp.connection.wait([*result_readers.keys(), *sentinels],
+                                   _SUPERVISE_INTERVAL if supervise is not None else None)
+        process_exited = False
+        for result_reader in ready:
+            if result_reader not in result_readers:
+                process_exited = True
+                continue
+            proc_index = result_readers[result_reader]
+            result_items = _drain_result_queue(result_queues[proc_index])
+            _handle_result_items(result_items,
+                                 proc_index,
+                                 pending_work_items,
+                                 procs,
+                                 proc_loads,
+                                 dispatch_lock,
+                                 in_flight_limiter,
+                                 shared_memory_pool,
+                                 shared_memory_attachments)
+            del result_items
+        if supervise is not None and (process_exited or time.monotonic() >= next_supervise_time):
+            supervise()
+            next_supervise_time = time.monotonic() + _SUPERVISE_INTERVAL
+
+
+class _InFlightLimiter:
+    """
+    Counter of the submitted but unfinished works, bounded by <max_in_flight> if given
+    """
+
+    def __init__(self, max_in_flight=None):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, count, reserved=0):
+        # more slots than the limit are granted once nothing else is in flight
+        return self.in_flight + reserved + count <= max(self.max_in_flight, count)
+
+    def acquire(self, block=True, timeout=None, count=1):
+        """
+        Take <count> slots at once, or none of them
+        """
+        with self._condition:
+            if self.max_in_flight is not None and \
+                    not self._condition.wait_for(lambda: self._fits(count), timeout if block else 0):
+                return False
+            self.in_flight += count
+            return True
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            # waiters may need several slots, each one checks if it fits now
+            self._condition.notify_all()
+
+
+class _AsyncInFlightLimiter(_InFlightLimiter):
+    """
+    In-flight counter whose waiters are coroutines of the event loop the results are handled in
+    """
+
+    def __init__(self, max_in_flight=None):
+        super(_AsyncInFlightLimiter, self).__init__(max_in_flight)
+        self.loop = None
+        self.loop_thread_id = None
+        self._waiters = collections.deque()
+
+    def bind(self, loop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+
+    async def acquire_async(self, count=1):
+        while not self.acquire(block=False, count=count):
+            entry = (self.loop.create_future(), count)
+            self._waiters.append(entry)
+            try:
+                await entry[0]
+            finally:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+
+    def release(self):
+        super(_AsyncInFlightLimiter, self).release()
+        if len(self._waiters):
+            # works failing in the dispatcher thread are released outside the event loop
+            if threading.get_ident() == self.loop_thread_id:
+                self._wakeup_waiter()
+            else:
+                self.loop.call_soon_threadsafe(self._wakeup_waiter)
+
+    def _wakeup_waiter(self):
+        # waiters are woken in order as long as their slots fit, the woken ones take them when they resume
+        reserved = 0
+        while len(self._waiters):
+            waiter, count = self._waiters[0]
+            if not waiter.done():
+                if not self._fits(count, reserved):
+                    return
+                waiter.set_result(None)
+                reserved += count
+            self._waiters.popleft()
+
+
+def _gather_futures(futures):
+    """
+    Combine the futures of a broadcast task, the result is taken from the first process
+    """
+    gathered_future = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def _on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] or gathered_future.done():
+                return
+        try:
+            for f in futures:
+                if f.cancelled():
+                    gathered_future.cancel()
+                    return
+                if f.exception() is not None:
+                    gathered_future.set_exception(f.exception())
+                    return
+            gathered_future.set_result(futures[0].result())
+        except InvalidStateError:
+            # cancelled meanwhile by its owner
+            pass
+
+    def _on_gathered_done(_):
+        if gathered_future.cancelled():
+            [f.cancel() for f in futures]
+
+    for f in futures:
+        f.add_done_callback(_on_done)
+    gathered_future.add_done_callback(_on_gathered_done)
+    return gathered_future
 
 
 class SubprocessExecutor:
-    def __init__(self, group=None, name=None, *, max_workers=1, daemon=None):
+    def __init__(self, group=None, name=None, *, max_workers=1, num_processes=1,
+                 shared_memory=False, shared_memory_threshold=1 << 16,
+                 batch_size=1, batch_window=0.,
+                 max_in_flight=None, overflow_policy='block',
+                 restart_on_failure=True, hang_grace=1., metrics=False, daemon=None):
+        """
+        With <shared_memory>, ndarray call arguments and results of at least
+        <shared_memory_threshold> bytes are moved through pooled shared memory
+        blocks instead of being pickled, only their descriptors cross the queues.
+
+        Submitted tasks are coalesced into batches of up to <batch_size> tasks,
+        waiting at most <batch_window> seconds for a batch to fill up.
+
+        At most <max_in_flight> works can be submitted but unfinished, beyond that
+        <overflow_policy> decides what a submission does: 'block' until a work finishes,
+        'raise' an ExecutorOverloadedError, or 'drop_oldest' call not yet dispatched,
+        cancelling its future (it blocks if every call is already dispatched).
+
+        With <restart_on_failure>, a subprocess that dies, or that still runs a call
+        <hang_grace> seconds after its deadline, is killed and restarted with its
+        variables initialized again, its unfinished works fail with BrokenSubprocessError.
+
+        With <metrics>, the executor threads of the subprocesses publish the latency and
+        queue wait time of the calls in shared memory, read without lock by metrics().
+        """
+        if num_processes < 1:
+            raise ValueError('num_processes must be greater than 0')
+        if batch_size < 1:
+            raise ValueError('batch_size must be greater than 0')
+        if overflow_policy not in _OVERFLOW_POLICIES:
+            raise ValueError(f'overflow_policy must be one of {_OVERFLOW_POLICIES}, got {overflow_policy}')
+        self._in_flight_limiter = _InFlightLimiter(max_in_flight)
+        self._overflow_policy = overflow_policy
+        self._rejected_count = 0
+        self._dropped_count = 0
+        self._batch_size = batch_size
+        self._batch_window = batch_window
         self._pending_works = {}
         self._work_ids_queue = queue.Queue()
         self._work_queue_count = 0
 
-        self._task_queue = mp.SimpleQueue()
-        self._result_queue = mp.SimpleQueue()
+        self._process_kwargs = dict(group=group,
+                                    max_workers=max_workers,
+                                    shared_memory=shared_memory,
+                                    shared_memory_threshold=shared_memory_threshold,
+                                    daemon=daemon)
+        self._metrics = None
+        if metrics:
+            from .metrics_utils import SharedMetrics
 
-        self._proc = Subprocess(self._task_queue,
-                                self._result_queue,
-                                group, name,
-                                max_workers=max_workers,
-                                daemon=daemon)
+            # a writer per executor thread, kept by the process restarted in its place
+            self._metrics = SharedMetrics(_executor_metrics_layout(num_processes * max_workers))
+        self._metrics_start_time = time.perf_counter_ns()
+        self._name = name
+        self._procs = [self._create_process(proc_index, num_processes) for proc_index in range(num_processes)]
+        # queues are kept in lists shared with the manager threads, a restart replaces them in place
+        self._task_queues = [proc._task_queue for proc in self._procs]
+        self._result_queues = [proc._result_queue for proc in self._procs]
+        self._restart_on_failure = restart_on_failure
+        self._hang_grace = hang_grace
+        self._restart_count = 0
+        self._started = False
+        self._shared_memory_pool = self._shared_memory_attachments = None
+        self._shared_memory_threshold = shared_memory_threshold
+        if shared_memory:
+            from .shared_memory_utils import SharedMemoryPool, SharedMemoryAttachments
+
+            self._shared_memory_pool = SharedMemoryPool()
+            self._shared_memory_attachments = SharedMemoryAttachments()
+        # number of dispatched but unfinished tasks of each process
+        self._proc_loads = [0] * num_processes
+        # guards the process loads and the dispatched flags of the pending works
+        self._dispatch_lock = threading.Lock()
+        # maps variable name to the index of the process it is pinned to, None if broadcast
+        self._variable_owners = {}
+        # tasks initializing the variables of each process, replayed when it is restarted
+        self._variable_tasks = [{} for _ in range(num_processes)]
+        # partials sent by reference: a task calling a partial binding a 1 MiB array pickles to
+        # 1 MiB when sent by value, to 234 bytes by reference. Functions pickle by name and are sent as is
+        self._function_ids = weakref.WeakKeyDictionary()
+        self._function_id_count = itertools.count()
+        # ids of the partials garbage collected in this process, appended by their finalizers
+        self._collected_functions = []
+        # ids of the partials each process has already received
+        self._sent_functions = [set() for _ in range(num_processes)]
+        # ids of the collected partials each process has to drop from its cache
+        self._forgotten_functions = [[] for _ in range(num_processes)]
         self._result_manager_thread = None
         self._work_manager_thread = None
 
     @property
     def max_workers(self):
-        return self._proc.max_workers
+        return self._procs[0].max_workers
+
+    @property
+    def num_processes(self):
+        return len(self._procs)
+
+    @property
+    def max_in_flight(self):
+        return self._in_flight_limiter.max_in_flight
+
+    @property
+    def in_flight(self):
+        """Number of submitted but unfinished works"""
+        return self._in_flight_limiter.in_flight
+
+    @property
+    def queue_depth(self):
+        """Number of submitted works not yet dispatched to a subprocess"""
+        return sum(not w.dispatched for w in list(self._pending_works.values()))
+
+    @property
+    def rejected_count(self):
+        """Number of submissions rejected by the 'raise' overflow policy"""
+        return self._rejected_count
+
+    @property
+    def dropped_count(self):
+        """Number of calls dropped by the 'drop_oldest' overflow policy"""
+        return self._dropped_count
+
+    @property
+    def restart_count(self):
+        """Number of subprocesses restarted after crashing or hanging"""
+        return self._restart_count
+
+    def metrics(self, proc_index=None):
+        """
+        Snapshot of the metrics of every executor thread, or of process <proc_index>:
+        tasks_completed, tasks_failed, busy_ns, task_latency_ns and queue_wait_ns histograms,
+        and worker_utilization, the fraction of time the threads ran calls since start.
+        Returns None if the executor was created without <metrics>.
+        """
+        if self._metrics is None:
+            return None
+        max_workers = self.max_workers
+        if proc_index is not None:
+            self._check_process_index(proc_index)
+            writer_indices = range(proc_index * max_workers, (proc_index + 1) * max_workers)
+        else:
+            writer_indices = range(self.num_processes * max_workers)
+        snapshot = self._metrics.snapshot(writer_indices)
+        elapsed = time.perf_counter_ns() - self._metrics_start_time
+        snapshot['worker_utilization'] = snapshot['busy_ns'] / (elapsed * len(writer_indices)) if elapsed > 0 else 0.
+        return snapshot
+
+    def _create_process(self, proc_index, num_processes=None):
+        num_processes = num_processes if num_processes is not None else self.num_processes
+        return Subprocess(mp.SimpleQueue(),
+                          mp.SimpleQueue(),
+                          name=f'{self._name}-{proc_index}' if self._name is not None and num_processes > 1
+                          else self._name,
+                          metrics=self._metrics,
+                          metrics_writer_offset=proc_index * self._process_kwargs['max_workers'],
+                          **self._process_kwargs)
+
+    def _supervise(self):
+        if not self._started:
+            return
+        now = time.monotonic()
+        hung_proc_indices = {w.proc_index for w in list(self._pending_works.values())
+                             if w.dispatched and getattr(w.task, 'deadline', None) is not None
+                             and now > w.task.deadline + self._hang_grace}
+        for proc_index, proc in enumerate(self._procs):
+            if proc_index in hung_proc_indices or not proc.is_alive():
+                self._restart_process(proc_index)
+
+    def _restart_process(self, proc_index):
+        old_proc = self._procs[proc_index]
+        old_proc.terminate()
+        old_proc.join(self._hang_grace)
+        if old_proc.is_alive():
+            old_proc.kill()
+            old_proc.join()
+        old_proc._unlink_shared_memory()
+        if self._shared_memory_attachments is not None:
+            self._shared_memory_attachments.close(old_proc._shared_memory_prefix)
+        now = time.monotonic()
+        with self._dispatch_lock:
+            failed_works = [w for w in list(self._pending_works.values())
+                            if w.dispatched and w.proc_index == proc_index]
+            for w in failed_works:
+                del self._pending_works[w.id]
+            self._proc_loads[proc_index] = 0
+            self._sent_functions[proc_index].clear()
+            self._forgotten_functions[proc_index].clear()
+            # closing the old queues unblocks a dispatcher stuck writing to the dead process
+            old_proc._task_queue.close()
+            old_proc._result_queue.close()
+            if old_proc._release_writer is not None:
+                old_proc._release_writer.close()
+            proc = self._procs[proc_index] = self._create_process(proc_index)
+            self._task_queues[proc_index] = proc._task_queue
+            self._result_queues[proc_index] = proc._result_queue
+            proc.start()
+            for task in self._variable_tasks[proc_index].values():
+                task = copy.copy(task)
+                task.work_id = None
+                proc._task_queue.put(task)
+        self._restart_count += 1
+        for w in failed_works:
+            deadline = getattr(w.task, 'deadline', None)
+            _abandon_work_item(w, self._in_flight_limiter, self._shared_memory_pool,
+                               TaskTimeoutError('subprocess restarted after the call exceeded its deadline')
+                               if deadline is not None and deadline <= now
+                               else BrokenSubprocessError(f'subprocess {old_proc.name} exited with code '
+                                                          f'{old_proc.exitcode} and was restarted'))
 
     def _wakeup_manager_threads(self):
+        self._wakeup_work_manager_thread()
+        if self._result_manager_thread is None:
+            self._result_manager_thread = threading.Thread(target=_result_management_worker,
+                                                           args=(self._pending_works,
+                                                                 self._procs,
+                                                                 self._result_queues,
+                                                                 self._proc_loads,
+                                                                 self._dispatch_lock,
+                                                                 self._in_flight_limiter,
+                                                                 self._shared_memory_pool,
+                                                                 self._shared_memory_attachments,
+                                                                 self._supervise if self._restart_on_failure
+                                                                 else None,
+                                                                 ),
+                                                           daemon=True)
+            self._result_manager_thread.start()
+
+    def _wakeup_work_manager_thread(self):
         if self._work_manager_thread is None:
             self._work_manager_thread = threading.Thread(target=_work_management_worker,
                                                          args=(self._pending_works,
                                                                self._work_ids_queue,
-                                                               self._task_queue,
+                                                               self._task_queues,
+                                                               self._proc_loads,
+                                                               self._variable_owners,
+                                                               self._dispatch_lock,
+                                                               self._in_flight_limiter,
+                                                               self._shared_memory_pool,
+                                                               self._batch_size,
+                                                               self._batch_window,
+                                                               self._on_dispatch,
+                                                               self._on_dispatch_failed,
                                                                ),
                                                          daemon=True)
             self._work_manager_thread.start()
-        if self._result_manager_thread is None:
-            self._result_manager_thread = threading.Thread(target=_result_management_worker,
-                                                           args=(self._pending_works,
-                                                                 # self._work_ids_queue,
-                                                                 # self._task_queue,
-                                                                 self._result_queue,
-                                                                 ),
-                                                           daemon=True)
-            self._result_manager_thread.start()
+
+    def _drop_oldest(self):
+        with self._dispatch_lock:
+            for w in list(self._pending_works.values()):
+                # variable tasks are never dropped, the subprocess state depends on them
+                if not w.dispatched and isinstance(w.task, _CallTask):
+                    del self._pending_works[w.id]
+                    break
+            else:
+                return False
+        _abandon_work_item(w, self._in_flight_limiter, self._shared_memory_pool)
+        self._dropped_count += 1
+        return True
+
+    def _acquire_slot(self, flush=None, count=1):
+        if self._in_flight_limiter.acquire(block=False, count=count):
+            return
+        # works registered by the caller but not yet queued must be queued before blocking
+        if flush is not None:
+            flush()
+        if self._overflow_policy == 'raise':
+            self._rejected_count += 1
+            raise ExecutorOverloadedError(f'{self.max_in_flight} works are already in flight')
+        elif self._overflow_policy == 'drop_oldest':
+            while not self._in_flight_limiter.acquire(block=False, count=count):
+                if not self._drop_oldest():
+                    self._in_flight_limiter.acquire(count=count)
+                    break
+        else:
+            self._in_flight_limiter.acquire(count=count)
+
+    def _register(self, task, proc_index=None):
+        f = _WorkFuture(self, task.work_id)
+        w = _WorkItem(f, task, proc_index)
+        self._pending_works[w.id] = w
+        return f
+
+    def _on_dispatch(self, work_item):
+        task = work_item.task
+        if not isinstance(task, _CallTask):
+            return task
+        proc_index = work_item.proc_index
+        if task.store_as is not None:
+            # the stored variable lives in the process running the call, which is replayed on restart
+            self._variable_owners[task.store_as] = proc_index
+            [variable_tasks.pop(task.store_as, None) for variable_tasks in self._variable_tasks]
+            replay_task = copy.copy(task)
+            replay_task.work_id = None
+            replay_task.deadline = None
+            replay_task.submit_time = None
+            self._variable_tasks[proc_index][task.store_as] = replay_task
+        if isinstance(task.fn, functools.partial):
+            fn_id = self._function_ids.get(task.fn)
+            if fn_id is None:
+                fn_id = self._function_ids[task.fn] = next(self._function_id_count)
+                weakref.finalize(task.fn, self._collected_functions.append, fn_id)
+            while self._collected_functions:
+                collected_id = self._collected_functions.pop()
+                for sent_functions, forgotten_functions in zip(self._sent_functions, self._forgotten_functions):
+                    if collected_id in sent_functions:
+                        sent_functions.remove(collected_id)
+                        forgotten_functions.append(collected_id)
+            sent_functions = self._sent_functions[proc_index]
+            task = copy.copy(task)
+            task.fn = _FunctionRef(fn_id, None if fn_id in sent_functions else task.fn,
+                                   self._forgotten_functions[proc_index])
+            sent_functions.add(fn_id)
+            self._forgotten_functions[proc_index] = []
+        return task
+
+    def _on_dispatch_failed(self, proc_index, tasks):
+        with self._dispatch_lock:
+            # the partials the failed batch carried never reached the subprocess, nor its forgotten ids
+            self._sent_functions[proc_index].clear()
+            for task in tasks:
+                if isinstance(task, _CallTask) and isinstance(task.fn, _FunctionRef):
+                    self._forgotten_functions[proc_index].extend(task.fn.forgotten_ids)
+
+    def _on_work_cancelled(self, work_id):
+        with self._dispatch_lock:
+            work_item = self._pending_works.get(work_id)
+            if work_item is None or not work_item.dispatched:
+                return
+            cancelled_slots = self._procs[work_item.proc_index]._cancelled_slots
+            # dispatched works are skipped by the subprocess if it has not started them yet,
+            # otherwise their result is discarded
+            cancelled_slots[work_id % len(cancelled_slots)] = work_id + 1
+
+    def _submit(self, task, proc_index=None):
+        if isinstance(task, _InitVariableTask):
+            self._variable_tasks[proc_index].pop(task.variable_name, None)
+            self._variable_tasks[proc_index][task.variable_name] = task
+        elif isinstance(task, _DeleteVariableTask):
+            self._variable_tasks[proc_index].pop(task.variable_name, None)
+        f = self._register(task, proc_index)
+        self._work_ids_queue.put(task.work_id)
+        self._wakeup_manager_threads()
+        return f
+
+    def _submit_to_processes(self, task_factory, proc_index=None):
+        proc_indices = self._target_processes(proc_index)
+        # the slots of every process are taken at once, a broadcast reaches all of them or none
+        self._acquire_slot(count=len(proc_indices))
+        futures = []
+        for i in proc_indices:
+            futures.append(self._submit(task_factory(self._work_queue_count), i))
+            self._work_queue_count += 1
+        return futures[0] if len(futures) == 1 else _gather_futures(futures)
+
+    def _target_processes(self, proc_index=None):
+        if proc_index is not None:
+            self._check_process_index(proc_index)
+            return [proc_index]
+        return list(range(self.num_processes))
+
+    def _check_process_index(self, proc_index):
+        if not 0 <= proc_index < self.num_processes:
+            raise IndexError(f'process index {proc_index} out of range [0, {self.num_processes})')
 
     def start(self):
-        self._proc.start()
+        if (self._shared_memory_pool is not None or self._metrics is not None) and os.name == 'posix':
+            # subprocesses must share the parent's tracker, otherwise blocks attached
+            # on both sides are reported as leaked by each of them
+            resource_tracker.ensure_running()
+        [proc.start() for proc in self._procs]
+        self._metrics_start_time = time.perf_counter_ns()
+        self._started = True
 
     def terminate(self):
-        self._proc.terminate()
+        self._started = False
+        [proc.terminate() for proc in self._procs]
+        if self._shared_memory_pool is not None:
+            # killed subprocesses leave their pools behind, the parent unlinks them
+            for proc in self._procs:
+                if proc.pid is not None:
+                    proc.join(self._hang_grace)
+                proc._unlink_shared_memory()
+            self._shared_memory_attachments.close()
+            self._shared_memory_pool.close()
+        if self._metrics is not None:
+            self._metrics.close()
+            self._metrics = None
 
     def join(self, timeout=None):
-        self._proc.join(timeout)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for proc in self._procs:
+            proc.join(max(0., deadline - time.monotonic()) if deadline is not None else None)
 
     @staticmethod
     def variable_arg(variable_name):
         return VariableArg(variable_name)
 
-    def init_variable(self, variable_name, variable_value=None, variable_class=None, init_args=(), init_kwargs={}):
-        f = Future()
-        w = _WorkItem(f, _InitVariableTask(self._work_queue_count,
-                                           variable_name,
-                                           variable_value,
-                                           variable_class,
-                                           init_args,
-                                           init_kwargs))
-        self._pending_works[w.id] = w
-        self._work_ids_queue.put(w.id)
-        self._work_queue_count += 1
-        self._wakeup_manager_threads()
-        return f
+    def init_variable(self, variable_name, variable_value=None, variable_class=None, init_args=(), init_kwargs={},
+                      proc_index=None):
+        """
+        Initialize a variable in every process, or only in process <proc_index> if it is given.
+        Calls using a pinned variable are always dispatched to the process owning it.
+        """
+        if proc_index is not None:
+            self._check_process_index(proc_index)
+        f = self._submit_to_processes(lambda work_id: _InitVariableTask(work_id,
+                                                                        variable_name,
+                                                                        variable_value,
+                                                                        variable_class,
+                                                                        init_args,
+                                                                        init_kwargs),
+                                      proc_index)
+        # only recorded once every target process has accepted the task
+        self._variable_owners[variable_name] = proc_index
+        return _chain_future(f, VariableHandle(self, variable_name,
+                                               _method_names(variable_class or type(variable_value))))
 
     def get_variable(self, variable_name):
-        f = Future()
-        w = _WorkItem(f, _GetVariableTask(self._work_queue_count,
+        self._acquire_slot()
+        f = self._submit(_GetVariableTask(self._work_queue_count,
                                           variable_name))
-        self._pending_works[w.id] = w
-        self._work_ids_queue.put(w.id)
         self._work_queue_count += 1
-        self._wakeup_manager_threads()
         return f
 
     def delete_variable(self, variable_name):
-        f = Future()
-        w = _WorkItem(f, _DeleteVariableTask(self._work_queue_count,
-                                             variable_name))
-        self._pending_works[w.id] = w
-        self._work_ids_queue.put(w.id)
-        self._work_queue_count += 1
-        self._wakeup_manager_threads()
+        proc_index = self._variable_owners.get(variable_name)
+        f = self._submit_to_processes(lambda work_id: _DeleteVariableTask(work_id,
+                                                                          variable_name),
+                                      proc_index)
+        self._variable_owners.pop(variable_name, None)
         return f
 
-    def call(self, target, args=(), kwargs={}):
-        f = Future()
-        w = _WorkItem(f, _CallTask(self._work_queue_count,
-                                   target,
-                                   args,
-                                   kwargs))
-        self._pending_works[w.id] = w
-        self._work_ids_queue.put(w.id)
+    def _call_task(self, target, args=(), kwargs={}, timeout=None, store_as=None):
+        task = _CallTask(self._work_queue_count,
+                         target,
+                         [v.variable_arg() if isinstance(v, VariableHandle) else v for v in args],
+                         {k: v.variable_arg() if isinstance(v, VariableHandle) else v for k, v in kwargs.items()},
+                         time.monotonic() + timeout if timeout is not None else None,
+                         store_as)
         self._work_queue_count += 1
-        self._wakeup_manager_threads()
-        return f
+        task.submit_time = time.perf_counter_ns()
+        # arguments of a stored call are kept to replay it, they cannot live in leased blocks
+        if self._shared_memory_pool is not None and store_as is None:
+            from .shared_memory_utils import share_arrays
+
+            task.shared_memory_block = share_arrays(self._shared_memory_pool,
+                                                    [task.args, task.kwargs],
+                                                    self._shared_memory_threshold)
+        return task
+
+    def _call_member(self, member, args=(), kwargs={}, timeout=None, store_as=None):
+        return self.call(member, args, kwargs, timeout, store_as)
+
+    def call(self, target, args=(), kwargs={}, timeout=None, store_as=None):
+        """
+        Call <target> in a subprocess. If it has not finished <timeout> seconds after
+        submission, its future fails with TaskTimeoutError: a call not yet started is
+        dropped, a running one is interrupted in its executor thread.
+
+        With <store_as>, the result stays in the subprocess as a variable of that name
+        and a VariableHandle of it is returned. The call is run again to restore the
+        variable if the subprocess is restarted.
+        """
+        self._acquire_slot()
+        f = self._submit(self._call_task(target, args, kwargs, timeout, store_as))
+        if store_as is None:
+            return f
+        handle = VariableHandle(self, store_as)
+        f.add_done_callback(handle._on_stored)
+        handle.add_done_callback(lambda h: f.cancel() if h.cancelled() else None)
+        return handle
+
+    def submit_many(self, target, iterable, kwargs={}, chunksize=32, timeout=None):
+        """
+        Call <target> once for each argument tuple of <iterable>, the tasks are
+        sent in chunks of <chunksize> and their results come back in batches.
+        Returns the list of futures. With the 'raise' overflow policy, the calls
+        submitted before the ExecutorOverloadedError keep running, their futures
+        are in its futures attribute.
+        """
+        if chunksize < 1:
+            raise ValueError('chunksize must be greater than 0')
+        futures = []
+        chunk = []
+
+        def flush():
+            if len(chunk):
+                self._work_ids_queue.put(chunk.copy())
+                chunk.clear()
+            self._wakeup_manager_threads()
+
+        for args in iterable:
+            try:
+                self._acquire_slot(flush)
+            except ExecutorOverloadedError as e:
+                e.futures = futures
+                raise
+            task = self._call_task(target, args, kwargs, timeout)
+            futures.append(self._register(task))
+            chunk.append(task.work_id)
+            if len(chunk) == chunksize:
+                flush()
+        flush()
+        return futures
+
+    def map(self, target, *iterables, timeout=None, chunksize=32):
+        """
+        Equivalent to map(target, *iterables) with the calls executed in the subprocesses,
+        results are yielded in order.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        futures = self.submit_many(target, zip(*iterables), chunksize=chunksize)
+
+        def result_iterator():
+            try:
+                futures.reverse()
+                while futures:
+                    f = futures.pop()
+                    yield f.result(max(0., deadline - time.monotonic()) if deadline is not None else None)
+            finally:
+                for f in futures:
+                    f.cancel()
+
+        return result_iterator()
+
+
+class AsyncSubprocessExecutor(SubprocessExecutor):
+    """
+    SubprocessExecutor for asyncio code, the results are read from the result pipes
+    by reader callbacks of the running event loop instead of a result management thread,
+    so awaiting a call costs no thread hop. The event loop must support add_reader,
+    which excludes the proactor event loop of Windows.
+    """
+
+    def __init__(self, group=None, name=None, *, max_workers=1, num_processes=1,
+                 shared_memory=False, shared_memory_threshold=1 << 16,
+                 batch_size=1, batch_window=0.,
+                 max_in_flight=None, overflow_policy='block',
+                 restart_on_failure=True, hang_grace=1., metrics=False, daemon=None):
+        super(AsyncSubprocessExecutor, self).__init__(group, name,
+                                                      max_workers=max_workers,
+                                                      num_processes=num_processes,
+                                                      shared_memory=shared_memory,
+                                                      shared_memory_threshold=shared_memory_threshold,
+                                                      batch_size=batch_size,
+                                                      batch_window=batch_window,
+                                                      max_in_flight=max_in_flight,
+                                                      overflow_policy=overflow_policy,
+                                                      restart_on_failure=restart_on_failure,
+                                                      hang_grace=hang_grace,
+                                                      metrics=metrics,
+                                                      daemon=daemon)
+        self._in_flight_limiter = _AsyncInFlightLimiter(max_in_flight)
+        self._loop = None
+        # file descriptors watched by the event loop for each process
+        self._proc_readers = {}
+        self._readers_started = False
+        self._supervise_handle = None
+        # processes being restarted in a thread of the default executor of the loop
+        self._restarting_procs = set()
+
+    def _bind_loop(self):
+        if self._loop is None:
+            import asyncio
+
+            self._loop = asyncio.get_running_loop()
+            self._in_flight_limiter.bind(self._loop)
+
+    def _wakeup_manager_threads(self):
+        self._wakeup_work_manager_thread()
+        if not self._readers_started:
+            self._readers_started = True
+            # the readers of a process being restarted are added once it is replaced
+            [self._add_proc_readers(proc_index) for proc_index in range(self.num_processes)
+             if proc_index not in self._restarting_procs]
+        if self._restart_on_failure and self._supervise_handle is None:
+            self._supervise_handle = self._loop.call_later(_SUPERVISE_INTERVAL, self._supervise_periodically)
+
+    def _add_proc_readers(self, proc_index):
+        proc = self._procs[proc_index]
+        readers = self._proc_readers[proc_index] = [proc._result_queue._reader.fileno()]
+        self._loop.add_reader(readers[0], self._on_results_ready, proc_index)
+        if self._restart_on_failure and proc.pid is not None:
+            # the sentinel becomes readable as soon as the subprocess dies
+            readers.append(proc.sentinel)
+            self._loop.add_reader(proc.sentinel, self._supervise)
+
+    def _remove_proc_readers(self, proc_index):
+        [self._loop.remove_reader(reader) for reader in self._proc_readers.pop(proc_index, [])]
+
+    def _supervise_periodically(self):
+        self._supervise()
+        self._supervise_handle = self._loop.call_later(_SUPERVISE_INTERVAL, self._supervise_periodically)
+
+    def _restart_process(self, proc_index):
+        if proc_index in self._restarting_procs:
+            return
+        self._restarting_procs.add(proc_index)
+        self._remove_proc_readers(proc_index)
+        # joining the old process may take up to <hang_grace> seconds, which must not block the event loop
+        restarted = self._loop.run_in_executor(None, super(AsyncSubprocessExecutor, self)._restart_process,
+                                               proc_index)
+        restarted.add_done_callback(lambda f: self._on_process_restarted(proc_index, f))
+
+    def _on_process_restarted(self, proc_index, restarted):
+        self._restarting_procs.discard(proc_index)
+        if not self._started:
+            # terminated during the restart
+            self._procs[proc_index].terminate()
+        elif restarted.exception() is None:
+            proc = self._procs[proc_index]
+            # the pipes of the new process may reuse the fd numbers of the old one: if they are still
+            # registered, add_reader only swaps the callback and the selector never watches the new pipe
+            [self._loop.remove_reader(fd) for fd in (proc._result_queue._reader.fileno(), proc.sentinel)]
+            self._add_proc_readers(proc_index)
+        restarted.result()
+
+    def _on_results_ready(self, proc_index):
+        result_items = _drain_result_queue(self._result_queues[proc_index])
+        _handle_result_items(result_items,
+                             proc_index,
+                             self._pending_works,
+                             self._procs,
+                             self._proc_loads,
+                             self._dispatch_lock,
+                             self._in_flight_limiter,
+                             self._shared_memory_pool,
+                             self._shared_memory_attachments)
+
+    def _wrap_future(self, future: Future) -> 'asyncio.Future':
+        loop = self._loop
+        async_future = loop.create_future()
+
+        def _on_done(f):
+            # results are set by the reader callbacks, only dispatch errors come from another thread
+            if threading.get_ident() == self._in_flight_limiter.loop_thread_id:
+                _copy_future_state(f, async_future)
+            else:
+                loop.call_soon_threadsafe(_copy_future_state, f, async_future)
+
+        future.add_done_callback(_on_done)
+        # cancelling the awaitable drops the call if it has not been dispatched yet
+        async_future.add_done_callback(lambda af: future.cancel() if af.cancelled() else None)
+        return async_future
+
+    async def _acquire_slot_async(self, count=1):
+        if self._in_flight_limiter.acquire(block=False, count=count):
+            return
+        if self._overflow_policy == 'raise':
+            self._rejected_count += 1
+            raise ExecutorOverloadedError(f'{self.max_in_flight} works are already in flight')
+        elif self._overflow_policy == 'drop_oldest':
+            while not self._in_flight_limiter.acquire(block=False, count=count):
+                if not self._drop_oldest():
+                    await self._in_flight_limiter.acquire_async(count)
+                    break
+        else:
+            await self._in_flight_limiter.acquire_async(count)
+
+    async def _submit_to_processes_async(self, task_factory, proc_index=None):
+        self._bind_loop()
+        proc_indices = self._target_processes(proc_index)
+        await self._acquire_slot_async(len(proc_indices))
+        futures = []
+        for i in proc_indices:
+            futures.append(self._wrap_future(self._submit(task_factory(self._work_queue_count), i)))
+            self._work_queue_count += 1
+        import asyncio
+
+        return (await asyncio.gather(*futures))[0]
+
+    def terminate(self):
+        if self._loop is not None:
+            [self._remove_proc_readers(proc_index) for proc_index in range(self.num_processes)]
+            self._readers_started = False
+            if self._supervise_handle is not None:
+                self._supervise_handle.cancel()
+                self._supervise_handle = None
+        super(AsyncSubprocessExecutor, self).terminate()
+
+    async def init_variable(self, variable_name, variable_value=None, variable_class=None, init_args=(),
+                            init_kwargs={}, proc_index=None):
+        if proc_index is not None:
+            self._check_process_index(proc_index)
+        await self._submit_to_processes_async(lambda work_id: _InitVariableTask(work_id,
+                                                                                variable_name,
+                                                                                variable_value,
+                                                                                variable_class,
+                                                                                init_args,
+                                                                                init_kwargs),
+                                              proc_index)
+        self._variable_owners[variable_name] = proc_index
+        handle = VariableHandle(self, variable_name, _method_names(variable_class or type(variable_value)))
+        handle.set_result(None)
+        return handle
+
+    async def get_variable(self, variable_name):
+        self._bind_loop()
+        await self._acquire_slot_async()
+        f = self._submit(_GetVariableTask(self._work_queue_count,
+                                          variable_name))
+        self._work_queue_count += 1
+        return await self._wrap_future(f)
+
+    async def delete_variable(self, variable_name):
+        proc_index = self._variable_owners.get(variable_name)
+        result = await self._submit_to_processes_async(lambda work_id: _DeleteVariableTask(work_id,
+                                                                                           variable_name),
+                                                       proc_index)
+        self._variable_owners.pop(variable_name, None)
+        return result
+
+    async def _call_member(self, member, args=(), kwargs={}, timeout=None, store_as=None):
+        return await self.call(member, args, kwargs, timeout, store_as)
+
+    async def call(self, target, args=(), kwargs={}, timeout=None, store_as=None):
+        self._bind_loop()
+        await self._acquire_slot_async()
+        result = await self._wrap_future(self._submit(self._call_task(target, args, kwargs, timeout, store_as)))
+        if store_as is None:
+            return result
+        handle = VariableHandle(self, store_as, result)
+        handle.set_result(None)
+        return handle
+
+    async def submit_many(self, target, iterable, kwargs={}, chunksize=32, timeout=None):
+        """
+        Call <target> once for each argument tuple of <iterable> in chunks of <chunksize>.
+        Returns the list of asyncio futures, see SubprocessExecutor.submit_many.
+        """
+        if chunksize < 1:
+            raise ValueError('chunksize must be greater than 0')
+        self._bind_loop()
+        futures = []
+        chunk = []
+
+        def flush():
+            if len(chunk):
+                self._work_ids_queue.put(chunk.copy())
+                chunk.clear()
+            self._wakeup_manager_threads()
+
+        for args in iterable:
+            if not self._in_flight_limiter.acquire(block=False):
+                # works registered but not yet queued must be queued before waiting for a slot
+                flush()
+                try:
+                    await self._acquire_slot_async()
+                except ExecutorOverloadedError as e:
+                    e.futures = futures
+                    raise
+            task = self._call_task(target, args, kwargs, timeout)
+            futures.append(self._wrap_future(self._register(task)))
+            chunk.append(task.work_id)
+            if len(chunk) == chunksize:
+                flush()
+        flush()
+        return futures
+
+    async def map(self, target, *iterables, chunksize=32, ordered=True):
+        """
+        Asynchronous generator of the results of target(*args) for args in zip(*iterables),
+        yielded in order, or as soon as they complete if not <ordered>.
+        """
+        import asyncio
+
+        futures = await self.submit_many(target, zip(*iterables), chunksize=chunksize)
+        try:
+            for f in (futures if ordered else asyncio.as_completed(futures)):
+                yield await f
+        finally:
+            for f in futures:
+                f.cancel()
+
+    @staticmethod
+    async def as_completed(aws, timeout=None):
+        """
+        Asynchronous generator of the results of the awaitables <aws> as they complete
+        """
+        import asyncio
+
+        for f in asyncio.as_completed(aws, timeout=timeout):
+            yield await f
@@ -0,0 +1,376 @@
+import collections
+import contextlib
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+__all__ = ['SharedArray', 'SharedMemoryPool', 'SharedMemoryAttachments', 'SharedFrameRing',
+           'share_arrays', 'resolve_shared_arrays', 'unlink_pool_blocks']
+
+_ALIGNMENT = 64
+# polling period of the frame ring waits, the processes share no lock or event
+_POLL_INTERVAL = 1e-3
+
+
+def _align(nbytes, alignment=_ALIGNMENT):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+def _items(container):
+    return container.items() if isinstance(container, dict) else enumerate(container)
+
+
+class SharedArray:
+    """
+    Small picklable descriptor of an array living in a shared memory block
+    """
+
+    def __init__(self, name, shape, dtype, offset=0):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.offset = offset
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * np.dtype(self.dtype).itemsize
+
+    def as_array(self, buffer) -> np.ndarray:
+        # unlike np.ndarray(buffer=...), frombuffer keeps the buffer exported while the array
+        # lives, so its block cannot be closed under it
+        count = int(np.prod(self.shape, dtype=np.int64))
+        return np.frombuffer(buffer, dtype=self.dtype, count=count, offset=self.offset).reshape(self.shape)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name!r}, {self.shape}, {self.dtype!r}, {self.offset})'
+
+
+class SharedMemoryPool:
+    """
+    Pool of reusable shared memory blocks, sizes are rounded up to powers of two
+    so that a released block can serve any later request of the same size class.
+
+    With <name_prefix>, blocks are named <name_prefix><n> and counted in <created_count>,
+    e.g. a mp.RawValue('Q'), so that another process can unlink them with
+    unlink_pool_blocks if the process of the pool is killed before closing it.
+    """
+
+    def __init__(self, min_block_size=1 << 16, max_free_blocks=8, name_prefix=None, created_count=None):
+        self.min_block_size = min_block_size
+        self.max_free_blocks = max_free_blocks
+        self.name_prefix = name_prefix
+        self._created_count = created_count
+        self._free_blocks = {}
+        self._leased_blocks = {}
+        self._lock = threading.Lock()
+
+    def _size_class(self, nbytes):
+        return max(self.min_block_size, 1 << max(nbytes - 1, 0).bit_length())
+
+    def lease(self, nbytes) -> shared_memory.SharedMemory:
+        size = self._size_class(nbytes)
+        with self._lock:
+            free_blocks = self._free_blocks.get(size)
+            block = free_blocks.pop() if free_blocks else None
+            if block is None:
+                block = self._create_block(size)
+            self._leased_blocks[block.name] = (size, block)
+        return block
+
+    def _create_block(self, size):
+        if self.name_prefix is None:
+            return shared_memory.SharedMemory(create=True, size=size)
+        # counted before being created, so that no block is ever missed by unlink_pool_blocks
+        index = self._created_count.value
+        self._created_count.value = index + 1
+        return shared_memory.SharedMemory(name=f'{self.name_prefix}{index}', create=True, size=size)
+
+    def release(self, name):
+        with self._lock:
+            size, block = self._leased_blocks.pop(name)
+            free_blocks = self._free_blocks.setdefault(size, [])
+            if len(free_blocks) < self.max_free_blocks:
+                free_blocks.append(block)
+                return
+        block.close()
+        block.unlink()
+
+    def close(self):
+        with self._lock:
+            blocks = [block for free_blocks in self._free_blocks.values() for block in free_blocks]
+            blocks.extend(block for _, block in self._leased_blocks.values())
+            self._free_blocks.clear()
+            self._leased_blocks.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def unlink_pool_blocks(name_prefix, created_count):
+    """
+    Unlink the blocks left by a pool created with <name_prefix> and <created_count>,
+    once its process has exited without closing it
+    """
+    for index in range(created_count.value):
+        try:
+            block = shared_memory.SharedMemory(name=f'{name_prefix}{index}')
+        except FileNotFoundError:
+            # released and unlinked by the pool, or never created
+            continue
+        block.close()
+        block.unlink()
+
+
+class SharedMemoryAttachments:
+    """
+    Cache of shared memory blocks opened by name in the receiving process, pool blocks
+    are reused so each one is usually attached once. The least recently used blocks
+    beyond <max_blocks> are closed: the sending pool may have unlinked them, and their
+    memory is only freed once every process has closed them.
+    """
+
+    def __init__(self, max_blocks=32):
+        self.max_blocks = max_blocks
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def array(self, shared_array: SharedArray) -> np.ndarray:
+        """
+        View of <shared_array>, its block stays attached as long as the view is alive
+        """
+        with self._lock:
+            block = self._blocks.get(shared_array.name)
+            if block is None:
+                self._evict(self.max_blocks - 1)
+                block = self._blocks[shared_array.name] = shared_memory.SharedMemory(name=shared_array.name)
+            else:
+                self._blocks.move_to_end(shared_array.name)
+            # made under the lock, so that the block cannot be closed before the view exists
+            return shared_array.as_array(block.buf)
+
+    def _evict(self, max_blocks):
+        excess = len(self._blocks) - max_blocks
+        for name in list(self._blocks):
+            if excess <= 0:
+                break
+            try:
+                self._blocks[name].close()
+            except BufferError:
+                # arrays still view the block, it is closed by a later eviction
+                continue
+            del self._blocks[name]
+            excess -= 1
+
+    def close(self, name_prefix=''):
+        """
+        Close the blocks whose name starts with <name_prefix>, every block by default,
+        except those still viewed by arrays
+        """
+        with self._lock:
+            for name in [name for name in self._blocks if name.startswith(name_prefix)]:
+                try:
+                    self._blocks[name].close()
+                except BufferError:
+                    continue
+                del self._blocks[name]
+
+    def __len__(self):
+        return len(self._blocks)
+
+
+def share_arrays(pool: SharedMemoryPool, containers, threshold=0):
+    """
+    Move the ndarrays of the given lists or dicts into one leased block, replacing
+    them in place with SharedArray descriptors. Returns the block name or None.
+    """
+    slots = [(container, k) for container in containers for k, v in _items(container)
+             if isinstance(v, np.ndarray) and not v.dtype.hasobject and v.nbytes >= threshold]
+    if not len(slots):
+        return None
+    offsets = []
+    total_nbytes = 0
+    for container, k in slots:
+        offsets.append(total_nbytes)
+        total_nbytes += _align(container[k].nbytes)
+    block = pool.lease(total_nbytes)
+    for (container, k), offset in zip(slots, offsets):
+        array = container[k]
+        shared_array = SharedArray(block.name, array.shape, array.dtype.str, offset)
+        np.copyto(shared_array.as_array(block.buf), array, casting='no')
+        container[k] = shared_array
+    return block.name
+
+
+def resolve_shared_arrays(attachments: SharedMemoryAttachments, containers, copy=False):
+    """
+    Replace the SharedArray descriptors of the given lists or dicts in place with
+    arrays, views on the shared memory unless <copy> is set.
+    """
+    for container in containers:
+        for k, v in _items(container):
+            if isinstance(v, SharedArray):
+                array = attachments.array(v)
+                container[k] = array.copy() if copy else array
+
+
+class SharedFrameRing:
+    """
+    Ring of fixed-shape uint8 frames laid out in a shared buffer, written by a single
+    process and read without lock from any other. Each slot has a sequence number made
+    odd while the frame is written, a reader copying a frame checks it before and after
+    the copy and skips the frames overwritten meanwhile (torn frames).
+
+    A single lossless reader can consume the frames in order with read_next, the writer
+    then waits with writing(block=True) instead of overwriting frames not read yet.
+    """
+
+    # capacity, height, width, channels, write count, fps (float64), read count, closed
+    _HEADER_NBYTES = _ALIGNMENT
+
+    def __init__(self, buffer):
+        self._header = np.ndarray((8,), dtype=np.uint64, buffer=buffer)
+        self.capacity = int(self._header[0])
+        self.shape = tuple(int(v) for v in self._header[1:4])
+        self._fps = np.ndarray((1,), dtype=np.float64, buffer=buffer, offset=5 * 8)
+        offset = self._HEADER_NBYTES
+        self._sequences = np.ndarray((self.capacity,), dtype=np.uint64, buffer=buffer, offset=offset)
+        offset += self.capacity * 8
+        self._timestamps = np.ndarray((self.capacity,), dtype=np.float64, buffer=buffer, offset=offset)
+        offset = _align(offset + self.capacity * 8)
+        self._frames = np.ndarray((self.capacity, *self.shape), dtype=np.uint8, buffer=buffer, offset=offset)
+
+    @classmethod
+    def _nbytes(cls, shape, capacity):
+        return _align(cls._HEADER_NBYTES + capacity * 16) + capacity * int(np.prod(shape))
+
+    @classmethod
+    def create(cls, buffer, shape, fps=0., capacity=None):
+        """
+        Lay out a ring of frames of <shape> in <buffer>, holding <capacity> frames
+        or as many as the buffer can hold if not given
+        """
+        frame_nbytes = int(np.prod(shape))
+        max_capacity = (len(buffer) - _align(cls._HEADER_NBYTES) - _ALIGNMENT) // (frame_nbytes + 16)
+        capacity = min(capacity, max_capacity) if capacity is not None else max_capacity
+        if capacity < 1 or cls._nbytes(shape, capacity) > len(buffer):
+            raise ValueError(f'a buffer of {len(buffer)} bytes cannot hold a frame of shape {tuple(shape)}')
+        header = np.ndarray((8,), dtype=np.uint64, buffer=buffer)
+        header[:] = 0
+        header[0] = capacity
+        header[1:4] = (tuple(shape) + (1,))[:3]
+        np.ndarray((1,), dtype=np.float64, buffer=buffer, offset=5 * 8)[0] = fps
+        ring = cls(buffer)
+        ring._sequences[:] = 0
+        return ring
+
+    @property
+    def fps(self):
+        return float(self._fps[0])
+
+    @property
+    def write_count(self):
+        return int(self._header[4])
+
+    @property
+    def read_count(self):
+        return int(self._header[6])
+
+    @property
+    def closed(self):
+        return bool(self._header[7])
+
+    def close(self):
+        """
+        Tell the readers that no frame will be written anymore
+        """
+        self._header[7] = 1
+
+    @contextlib.contextmanager
+    def writing(self, timestamp=None, block=False, cancelled=None):
+        """
+        Context manager giving the slot of the next frame to fill in,
+        the frame is committed with <timestamp> (time.perf_counter() by default) on exit.
+        With <block>, wait for the lossless reader to free a slot or for <cancelled>() to be true.
+        """
+        index = int(self._header[4])
+        if block:
+            while index - int(self._header[6]) >= self.capacity and not (cancelled is not None and cancelled()):
+                time.sleep(_POLL_INTERVAL)
+        slot = index % self.capacity
+        self._sequences[slot] = 2 * index + 1
+        yield self._frames[slot]
+        self._timestamps[slot] = timestamp if timestamp is not None else time.perf_counter()
+        self._sequences[slot] = 2 * index + 2
+        self._header[4] = index + 1
+
+    def write(self, frame, timestamp=None):
+        with self.writing(timestamp) as slot:
+            np.copyto(slot, frame, casting='no')
+
+    def _wait_for_frame(self, index, timeout=None, cancelled=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.write_count <= index:
+            if (self.closed or (deadline is not None and time.monotonic() >= deadline)
+                    or (cancelled is not None and cancelled())):
+                return False
+            time.sleep(_POLL_INTERVAL)
+        return True
+
+    def read_next(self, timeout=None, cancelled=None):
+        """
+        Lossless read: return (timestamp, frame copy) of the oldest frame not read yet,
+        waiting up to <timeout> seconds for it. Returns None on timeout, once <cancelled>()
+        is true, or once the ring is closed and every frame read.
+        """
+        index = self.read_count
+        if not self._wait_for_frame(index, timeout, cancelled):
+            return None
+        slot = index % self.capacity
+        timestamp, frame = float(self._timestamps[slot]), self._frames[slot].copy()
+        self._header[6] = index + 1
+        return timestamp, frame
+
+    def read_latest(self, after_index=-1, timeout=None, cancelled=None):
+        """
+        Latest-only read: return (index, timestamp, frame copy) of the newest frame whose
+        index is greater than <after_index>, waiting up to <timeout> seconds for one.
+        Returns None on timeout, once <cancelled>() is true, or once the ring is closed
+        without newer frame.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            if not self._wait_for_frame(after_index + 1,
+                                        max(0., deadline - time.monotonic()) if deadline is not None else None,
+                                        cancelled):
+                return None
+            index = self.write_count - 1
+            slot = index % self.capacity
+            sequence = self._sequences[slot]
+            timestamp, frame = float(self._timestamps[slot]), self._frames[slot].copy()
+            # a torn frame was overwritten by a newer one, which is read instead
+            if sequence == 2 * index + 2 and self._sequences[slot] == sequence:
+                return index, timestamp, frame
+
+    def read_last(self, seconds=None):
+        """
+        Yield (timestamp, frame copy) of the frames of the last <seconds>, or of the
+        whole ring, from the oldest. Frames overwritten while being read are skipped.
+        """
+        write_count = self.write_count
+        if write_count == 0:
+            return
+        last_timestamp = self._timestamps[(write_count - 1) % self.capacity]
+        for index in range(max(0, write_count - self.capacity), write_count):
+            slot = index % self.capacity
+            sequence = self._sequences[slot]
+            if sequence != 2 * index + 2:
+                continue
+            timestamp = float(self._timestamps[slot])
+            if seconds is not None and timestamp < last_timestamp - seconds:
+                continue
+            frame = self._frames[slot].copy()
+            if self._sequences[slot] != sequence:
+                continue
+            yield timestamp, frame
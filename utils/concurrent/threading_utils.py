@@ -1,16 +1,36 @@
 import ctypes
-import inspect
+import heapq
+import itertools
+import math
 import threading
 import time
+import traceback
 
-__all__ = ['sleep', 'timeit', 'execute_for',
+from ..fps_tracker import LatencyHistogram
+
+__all__ = ['sleep', 'sleep_until', 'timeit', 'execute_for',
+           'PeriodicScheduler', 'PeriodicTask',
            'TerminateableThread', 'ThreadTerminatedError']
 
+_OVERRUN_POLICIES = ('skip', 'catch_up', 'coalesce')
+
 
 def sleep(timeout):
     if timeout > 0:
-        event = threading.Event()
-        return event.wait(timeout)
+        time.sleep(timeout)
+
+
+def sleep_until(deadline, spin_threshold=1e-3):
+    """
+    Sleep until time.perf_counter() reaches <deadline>. The OS sleep stops
+    <spin_threshold> seconds early and the rest is spent spinning, which is
+    far more precise than the scheduler granularity.
+    """
+    remaining = deadline - time.perf_counter()
+    if remaining > spin_threshold:
+        time.sleep(remaining - spin_threshold)
+    while time.perf_counter() < deadline:
+        pass
 
 
 class timeit:
@@ -20,10 +40,10 @@ class timeit:
         self.elapsed_time: float = None
 
     def __enter__(self):
-        self.start = time.time()
+        self.start = time.perf_counter()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.end = time.time()
+        self.end = time.perf_counter()
         self.elapsed_time = self.end - self.start
 
 
@@ -34,17 +54,197 @@ class execute_for:
         self.elapsed_time: float = expected_time
 
     def __enter__(self):
-        self.start = time.time()
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sleep_until(self.start + self.elapsed_time)
+        self.end = time.perf_counter()
+
+
+class PeriodicTask:
+    """
+    Callback run by a PeriodicScheduler every <interval> seconds, with its lateness statistics
+    """
+
+    def __init__(self, callback, interval, args=(), kwargs=None, overrun_policy='skip'):
+        if interval <= 0:
+            raise ValueError('interval must be greater than 0')
+        if overrun_policy not in _OVERRUN_POLICIES:
+            raise ValueError(f'overrun_policy must be one of {_OVERRUN_POLICIES}, got {overrun_policy}')
+        self.callback = callback
+        self.interval = interval
+        self.args = args
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.overrun_policy = overrun_policy
+        self.cancelled = False
+        # perf_counter() of the first run, run i is due at start_time + i * interval
+        self.start_time = None
+        self._tick = 0
+        self.run_count = 0
+        self.skipped_count = 0
+        self.coalesced_count = 0
+        self.error_count = 0
+        # delays of the runs after their deadline, in nanoseconds
+        self.lateness = LatencyHistogram()
+
+    def _next_deadline(self, now):
+        self._tick += 1
+        deadline = self.start_time + self._tick * self.interval
+        if deadline > now or self.overrun_policy == 'catch_up':
+            # on time, or every missed run is made up back to back
+            return deadline
+        # the ticks from self._tick to the last one passed are missed
+        last_tick = math.floor((now - self.start_time) / self.interval)
+        missed_count = last_tick - self._tick + 1
+        if self.overrun_policy == 'skip':
+            self.skipped_count += missed_count
+            self._tick = last_tick + 1
+            return self.start_time + self._tick * self.interval
+        # coalesce: a single run at once stands for the missed ones, late from the last of them
+        self.coalesced_count += missed_count - 1
+        self._tick = last_tick
+        return self.start_time + last_tick * self.interval
+
+    def stats(self):
+        """
+        Number of runs, skipped and coalesced runs and errors, and the lateness
+        of the runs after their deadline in seconds: lateness_mean, _p50, _p99 and _max
+        """
+        lateness = self.lateness
+        return {
+            'runs': self.run_count,
+            'skipped': self.skipped_count,
+            'coalesced': self.coalesced_count,
+            'errors': self.error_count,
+            # None before the first run
+            **{f'lateness_{k}': v / 1e9 if v is not None else None
+               for k, v in (('mean', lateness.mean),
+                            ('p50', lateness.percentile(50)),
+                            ('p99', lateness.percentile(99)),
+                            ('max', lateness.max))},
+        }
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class PeriodicScheduler:
+    """
+    Run many periodic callbacks from a single timer thread. Deadlines are absolute
+    time.perf_counter() times kept in a heap, so timing errors never accumulate, and
+    each one is waited for by sleeping until <spin_threshold> seconds before it then spinning.
+
+    Callbacks run one after the other in the timer thread, a slow one delays the others.
+    When a task overruns its next deadlines, its <overrun_policy> 'skip' drops the missed
+    runs and waits for the next tick, 'catch_up' runs them all back to back and 'coalesce'
+    runs a single late run at once, then goes on at the next tick.
+    """
+
+    def __init__(self, spin_threshold=1e-3, name='PeriodicScheduler'):
+        self.spin_threshold = spin_threshold
+        self.name = name
+        # (deadline, sequence number, task), the sequence number orders equal deadlines
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def add(self, callback, interval, args=(), kwargs=None, overrun_policy='skip', delay=0.) -> PeriodicTask:
+        """
+        Run <callback>(*<args>, **<kwargs>) every <interval> seconds, the first time in <delay> seconds
+        """
+        task = PeriodicTask(callback, interval, args, kwargs, overrun_policy)
+        task.start_time = time.perf_counter() + delay
+        self._push(task.start_time, task)
+        return task
+
+    def remove(self, task: PeriodicTask):
+        task.cancel()
+        with self._condition:
+            self._condition.notify_all()
+
+    @property
+    def tasks(self):
+        with self._condition:
+            return [task for _, _, task in self._heap if not task.cancelled]
+
+    def _push(self, deadline, task):
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), task))
+            # the new deadline may be earlier than the one waited for
+            self._condition.notify_all()
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _next_due(self):
+        """
+        Wait until the earliest deadline is less than <spin_threshold> away,
+        returns (deadline, task) or None once stopped
+        """
+        with self._condition:
+            while not self._stopped:
+                if not len(self._heap):
+                    self._condition.wait()
+                    continue
+                deadline, _, task = self._heap[0]
+                if task.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                remaining = deadline - time.perf_counter() - self.spin_threshold
+                if remaining > 0:
+                    # woken up early when tasks are added or removed
+                    self._condition.wait(remaining)
+                    continue
+                heapq.heappop(self._heap)
+                return deadline, task
+            return None
+
+    def _run(self):
+        while (due := self._next_due()) is not None:
+            deadline, task = due
+            sleep_until(deadline, self.spin_threshold)
+            start = time.perf_counter()
+            task.lateness.record((start - deadline) * 1e9)
+            try:
+                task.callback(*task.args, **task.kwargs)
+            except Exception:
+                task.error_count += 1
+                traceback.print_exc()
+            task.run_count += 1
+            if not task.cancelled:
+                self._push(task._next_deadline(time.perf_counter()), task)
+
+    def stats(self):
+        """
+        Statistics of every task, see PeriodicTask.stats
+        """
+        return {task: task.stats() for task in self.tasks}
+
+    def __enter__(self):
+        return self.start()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.end = time.time()
-        expected_time = self.end - self.start
-        sleep(self.elapsed_time - expected_time)
+        self.stop()
 
 
 def _async_raise(tid, exception_type):
     """Raises an exception in the threads with id tid"""
-    if not inspect.isclass(exception_type):
+    if not isinstance(exception_type, type):
         raise TypeError("Only types can be raised (not instances)")
     res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(tid),
                                                      ctypes.py_object(exception_type))
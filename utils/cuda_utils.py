@@ -1,16 +1,267 @@
+import collections
+import ctypes
+import ctypes.util
+import os
 import subprocess
 import re
+import threading
+import time
 
-__all__ = ['get_gpu_usage']
+__all__ = ['get_gpu_usage', 'GPUReading', 'GPUSampler', 'parse_nvidia_smi', 'parse_gpu_query_csv']
 
+# fields of the structured query, in the order of GPUReading after its timestamp
+_QUERY_FIELDS = ('index', 'memory.used', 'memory.total', 'utilization.gpu', 'utilization.memory',
+                 'temperature.gpu', 'power.draw')
+_QUERY_COMMAND = ['nvidia-smi', f'--query-gpu={",".join(_QUERY_FIELDS)}', '--format=csv,noheader,nounits']
 
-def get_gpu_usage(gpu_id=None):
-    p = subprocess.check_output('nvidia-smi')
-    rams_using = [int(_[:-5]) for _ in re.findall(r'\b\d+MiB+ /', str(p))]
-    rams_total = [int(_[1:-3].lstrip()) for _ in re.findall(r'/ +\b\d+MiB', str(p))]
-    if gpu_id is not None:
-        return rams_using[gpu_id], rams_total[gpu_id]
+# Memory in MiB, utilizations in percent, temperature in Celsius and power in watts,
+# None when the GPU does not report it
+GPUReading = collections.namedtuple('GPUReading', ['gpu_id', 'timestamp', 'memory_used', 'memory_total',
+                                                   'utilization_gpu', 'utilization_memory',
+                                                   'temperature', 'power_draw'])
+
+
+def parse_nvidia_smi(output):
+    """
+    Parse the memory table of the plain nvidia-smi output into {gpu_id: (used MiB, total MiB)}
+    """
+    output = output.decode() if isinstance(output, bytes) else output
+    rams_using = [int(_[:-5]) for _ in re.findall(r'\b\d+MiB+ /', output)]
+    rams_total = [int(_[1:-3].lstrip()) for _ in re.findall(r'/ +\b\d+MiB', output)]
     return {
         gpu_id: (rams_using[gpu_id], rams_total[gpu_id])
         for gpu_id in range(len(rams_using))
     }
+
+
+def _parse_number(value):
+    value = value.strip()
+    # '[N/A]', '[Not Supported]'...
+    if not value or value.startswith('['):
+        return None
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def parse_gpu_query_csv(output, timestamp=None):
+    """
+    Parse the output of nvidia-smi --query-gpu=<_QUERY_FIELDS> --format=csv,noheader,nounits
+    into a list of GPUReading
+    """
+    output = output.decode() if isinstance(output, bytes) else output
+    timestamp = timestamp if timestamp is not None else time.monotonic()
+    readings = []
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        values = [_parse_number(v) for v in line.split(',')]
+        if len(values) != len(_QUERY_FIELDS):
+            raise ValueError(f'expected {len(_QUERY_FIELDS)} fields, got {line!r}')
+        readings.append(GPUReading(values[0], timestamp, *values[1:]))
+    return readings
+
+
+class _NvidiaSmiSource:
+    """
+    Readings of a structured nvidia-smi query, one process per sample
+    """
+
+    def read(self):
+        return parse_gpu_query_csv(subprocess.check_output(_QUERY_COMMAND))
+
+    def close(self):
+        pass
+
+
+class _NvmlMemory(ctypes.Structure):
+    _fields_ = [('total', ctypes.c_ulonglong), ('free', ctypes.c_ulonglong), ('used', ctypes.c_ulonglong)]
+
+
+class _NvmlUtilization(ctypes.Structure):
+    _fields_ = [('gpu', ctypes.c_uint), ('memory', ctypes.c_uint)]
+
+
+class _NvmlSource:
+    """
+    Readings of the NVML library loaded with ctypes, no process is spawned
+    """
+
+    _NVML_SUCCESS = 0
+    _NVML_TEMPERATURE_GPU = 0
+
+    def __init__(self):
+        name = 'nvml.dll' if os.name == 'nt' else 'libnvidia-ml.so.1'
+        try:
+            self._nvml = ctypes.CDLL(name)
+        except OSError:
+            path = ctypes.util.find_library('nvidia-ml')
+            if path is None:
+                raise
+            self._nvml = ctypes.CDLL(path)
+        self._check(self._nvml.nvmlInit_v2())
+        count = ctypes.c_uint()
+        self._check(self._nvml.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+        self._handles = []
+        for i in range(count.value):
+            handle = ctypes.c_void_p()
+            self._check(self._nvml.nvmlDeviceGetHandleByIndex_v2(i, ctypes.byref(handle)))
+            self._handles.append(handle)
+
+    def _check(self, status):
+        if status != self._NVML_SUCCESS:
+            raise RuntimeError(f'NVML call failed with status {status}')
+
+    def _optional(self, fn, *args):
+        # readings the GPU does not support are None
+        value = ctypes.c_uint()
+        return value.value if fn(*args, ctypes.byref(value)) == self._NVML_SUCCESS else None
+
+    def read(self):
+        timestamp = time.monotonic()
+        readings = []
+        for gpu_id, handle in enumerate(self._handles):
+            memory = _NvmlMemory()
+            self._check(self._nvml.nvmlDeviceGetMemoryInfo(handle, ctypes.byref(memory)))
+            utilization = _NvmlUtilization()
+            has_utilization = self._nvml.nvmlDeviceGetUtilizationRates(handle, ctypes.byref(utilization)) \
+                == self._NVML_SUCCESS
+            power = self._optional(self._nvml.nvmlDeviceGetPowerUsage, handle)
+            readings.append(GPUReading(gpu_id,
+                                       timestamp,
+                                       memory.used >> 20,
+                                       memory.total >> 20,
+                                       utilization.gpu if has_utilization else None,
+                                       utilization.memory if has_utilization else None,
+                                       self._optional(self._nvml.nvmlDeviceGetTemperature, handle,
+                                                      self._NVML_TEMPERATURE_GPU),
+                                       power / 1e3 if power is not None else None))
+        return readings
+
+    def close(self):
+        self._nvml.nvmlShutdown()
+
+
+def _open_source(source):
+    if source in ('auto', 'nvml'):
+        try:
+            return _NvmlSource()
+        except (OSError, AttributeError, RuntimeError):
+            if source == 'nvml':
+                raise
+    if source in ('auto', 'nvidia-smi'):
+        return _NvidiaSmiSource()
+    raise ValueError(f"source must be one of ('auto', 'nvml', 'nvidia-smi'), got {source}")
+
+
+class GPUSampler:
+    """
+    Sample the memory, utilization, temperature and power of every GPU each <interval> seconds
+    in a background thread, keeping the last <capacity> readings of each GPU. Reads return the
+    readings already taken without waiting.
+
+    <source> 'nvml' reads NVML through ctypes, 'nvidia-smi' runs a structured CSV query,
+    'auto' uses NVML if its library can be loaded.
+    """
+
+    def __init__(self, interval=1., capacity=600, source='auto'):
+        self.interval = interval
+        self.capacity = capacity
+        self.source = source
+        # error of the last failed sample, None once a sample succeeds again
+        self.last_error = None
+        self._readings = {}
+        self._stop_event = threading.Event()
+        self._sampled_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='GPUSampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            source = _open_source(self.source)
+        except Exception as e:
+            self.last_error = e
+            self._sampled_event.set()
+            return
+        try:
+            deadline = time.monotonic()
+            while not self._stop_event.is_set():
+                try:
+                    for reading in source.read():
+                        readings = self._readings.get(reading.gpu_id)
+                        if readings is None:
+                            readings = self._readings[reading.gpu_id] = collections.deque(maxlen=self.capacity)
+                        # appends and reads of a deque are atomic, readers take no lock
+                        readings.append(reading)
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = e
+                self._sampled_event.set()
+                # absolute deadlines, a slow query does not shift the next samples
+                deadline = max(deadline + self.interval, time.monotonic())
+                self._stop_event.wait(deadline - time.monotonic())
+        finally:
+            source.close()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wait_for_first_sample(self, timeout=None):
+        return self._sampled_event.wait(timeout)
+
+    @property
+    def gpu_ids(self):
+        return sorted(self._readings)
+
+    def latest(self, gpu_id=None):
+        """
+        Latest GPUReading of <gpu_id>, or {gpu_id: reading} of every GPU. None or {} before the first sample.
+        """
+        if gpu_id is not None:
+            readings = self._readings.get(gpu_id)
+            return readings[-1] if readings else None
+        return {gpu_id: readings[-1] for gpu_id, readings in list(self._readings.items()) if readings}
+
+    def history(self, gpu_id, seconds=None):
+        """
+        Readings of <gpu_id> of the last <seconds>, or all the kept ones, from the oldest
+        """
+        readings = list(self._readings.get(gpu_id, ()))
+        if seconds is not None and len(readings):
+            readings = [r for r in readings if r.timestamp >= readings[-1].timestamp - seconds]
+        return readings
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def get_gpu_usage(gpu_id=None, sampler: GPUSampler = None):
+    """
+    Memory (used MiB, total MiB) of <gpu_id>, or {gpu_id: (used, total)} of every GPU.
+    With a started <sampler>, its latest readings are returned without running nvidia-smi.
+    """
+    if sampler is not None and len(sampler.latest()):
+        usage = {i: (r.memory_used, r.memory_total) for i, r in sampler.latest().items()}
+    else:
+        try:
+            usage = {r.gpu_id: (r.memory_used, r.memory_total)
+                     for r in parse_gpu_query_csv(subprocess.check_output(_QUERY_COMMAND))}
+        except (subprocess.CalledProcessError, ValueError):
+            # drivers too old for structured queries
+            usage = parse_nvidia_smi(subprocess.check_output('nvidia-smi'))
+    if gpu_id is not None:
+        return usage[gpu_id]
+    return usage
+
@@ -1,8 +1,10 @@
+import math
 import time
+from array import array
 
 # It means when use: <from fps_tracker import *>, it will import all in <__all__> variable.
 # If this module has many classes or functions, we need to add more code to import
-__all__ = ['FPSTracker']
+__all__ = ['FPSTracker', 'LatencyHistogram', 'LatencyTracker']
 
 
 class FPSTracker:
@@ -18,18 +20,18 @@ class FPSTracker:
 
     # Using in <With> block to record time for a code block
     def __enter__(self):
-        self._start = time.time()
+        self._start = time.perf_counter()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._end = time.time()
+        self._end = time.perf_counter()
         self.update(self._end - self._start)
 
     # Using to record time from <tick> to <tock>
     def tick(self):
-        self._start = time.time()
+        self._start = time.perf_counter()
 
     def tock(self):
-        self._end = time.time()
+        self._end = time.perf_counter()
         self.update(self._end - self._start)
 
     # Calculating average time, if <count number> > 30, avg Time is of the last 30 times
@@ -55,3 +57,288 @@ class FPSTracker:
 
         return 1. / self.average_elapsed_time if self.average_elapsed_time is not None else float('nan')
 
+
+class LatencyHistogram:
+    """
+    Fixed-memory log-linear histogram of nanosecond values. Values below 2 ** <precision_bits>
+    are counted exactly, larger ones in buckets 2 ** (1 - <precision_bits>) wide relative
+    to their value, up to <max_value> nanoseconds (larger values are counted in the last bucket).
+    Histograms with the same parameters can be merged, and pickled or sent as bytes.
+    """
+
+    def __init__(self, precision_bits=7, max_value=1 << 36):
+        self.precision_bits = precision_bits
+        self.max_value = max_value
+        self._sub_bucket_count = 1 << precision_bits
+        self._half_sub_bucket_count = self._sub_bucket_count >> 1
+        self._counts = array('Q', bytes(8 * (self.bucket_index(max_value) + 1)))
+        self.count = 0
+        self.total = 0
+        self.total_squares = 0
+        self.min = None
+        self.max = None
+
+    @property
+    def bucket_count(self):
+        return len(self._counts)
+
+    def bucket_index(self, value):
+        """
+        Index of the bucket counting <value>, clamped to the recordable range
+        """
+        value = min(max(int(value), 0), self.max_value)
+        exponent = value.bit_length() - self.precision_bits
+        if exponent <= 0:
+            return value
+        # the top <precision_bits> bits of the value select the sub-bucket of its power of two
+        return self._sub_bucket_count + (exponent - 1) * self._half_sub_bucket_count \
+            + (value >> exponent) - self._half_sub_bucket_count
+
+    def _value(self, index):
+        """
+        Midpoint of the values counted in bucket <index>
+        """
+        if index < self._sub_bucket_count:
+            return index
+        exponent, sub_index = divmod(index - self._sub_bucket_count, self._half_sub_bucket_count)
+        exponent += 1
+        return ((sub_index + self._half_sub_bucket_count) << exponent) + (1 << (exponent - 1))
+
+    def record(self, value, count=1):
+        value = int(value)
+        self._counts[self.bucket_index(value)] += count
+        self.count += count
+        self.total += value * count
+        self.total_squares += value * value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Value at <percent> (0-100) of the recorded values, None if there is none
+        """
+        if not self.count:
+            return None
+        rank = max(math.ceil(percent / 100. * self.count), 1)
+        if rank >= self.count:
+            return self.max
+        cumulated = 0
+        for index, count in enumerate(self._counts):
+            cumulated += count
+            if cumulated >= rank:
+                # bucket midpoints never go beyond the recorded extremes
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def stddev(self):
+        if not self.count:
+            return None
+        mean = self.total / self.count
+        return math.sqrt(max(self.total_squares / self.count - mean * mean, 0.))
+
+    def add_counts(self, counts, total=0, total_squares=0, min=None, max=None):
+        """
+        Add the bucket <counts> and the sums of values of an histogram kept elsewhere,
+        e.g. in shared memory, with the same parameters
+        """
+        for index, count in enumerate(counts):
+            if count:
+                self._counts[index] += count
+                self.count += count
+        self.total += total
+        self.total_squares += total_squares
+        if min is not None and (self.min is None or min < self.min):
+            self.min = min
+        if max is not None and (self.max is None or max > self.max):
+            self.max = max
+        return self
+
+    def merge(self, other: 'LatencyHistogram'):
+        if (other.precision_bits, other.max_value) != (self.precision_bits, self.max_value):
+            raise ValueError('histograms with different parameters cannot be merged')
+        for index, count in enumerate(other._counts):
+            if count:
+                self._counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+        for name, better in [('min', min), ('max', max)]:
+            values = [v for v in (getattr(self, name), getattr(other, name)) if v is not None]
+            setattr(self, name, better(values) if len(values) else None)
+        return self
+
+    def reset(self):
+        self._counts = array('Q', bytes(len(self._counts) * 8))
+        self.count = self.total = self.total_squares = 0
+        self.min = self.max = None
+
+
+class _EventRate:
+    """
+    Number of events over sliding windows up to <max_window> seconds, counted in
+    slots of <resolution> seconds
+    """
+
+    def __init__(self, max_window=60., resolution=0.1):
+        self.resolution_ns = int(resolution * 1e9)
+        self._slot_counts = [0] * (math.ceil(max_window / resolution) + 1)
+        self._last_slot = None
+        self._first_ns = None
+
+    def _advance(self, now_ns):
+        slot = now_ns // self.resolution_ns
+        if self._last_slot is None:
+            self._last_slot = slot
+        # slots skipped since the last event are cleared, at most one lap of the ring
+        for s in range(self._last_slot + 1, min(slot, self._last_slot + len(self._slot_counts)) + 1):
+            self._slot_counts[s % len(self._slot_counts)] = 0
+        self._last_slot = max(self._last_slot, slot)
+        return slot
+
+    def copy(self):
+        rate = _EventRate.__new__(_EventRate)
+        rate.__dict__.update(self.__dict__)
+        rate._slot_counts = list(self._slot_counts)
+        return rate
+
+    def record(self, now_ns, count=1):
+        if self._first_ns is None:
+            self._first_ns = now_ns
+        self._slot_counts[self._advance(now_ns) % len(self._slot_counts)] += count
+
+    def rate(self, window, now_ns):
+        """
+        Events per second over the last <window> seconds
+        """
+        if self._first_ns is None:
+            return 0.
+        slot = self._advance(now_ns)
+        slot_count = min(math.ceil(window * 1e9 / self.resolution_ns), len(self._slot_counts) - 1)
+        count = sum(self._slot_counts[s % len(self._slot_counts)] for s in range(slot - slot_count + 1, slot + 1))
+        # the window covers the current, partial slot and never starts before the first event
+        elapsed_ns = min((slot_count - 1) * self.resolution_ns + now_ns % self.resolution_ns, now_ns - self._first_ns)
+        return count * 1e9 / elapsed_ns if elapsed_ns > 0 else 0.
+
+
+class LatencyTracker:
+    """
+    Per-frame timing tracker based on time.perf_counter_ns, cheap enough to be called
+    every frame. Durations measured with the <with> block or tick/tock, or intervals
+    between successive calls of mark, are recorded in a LatencyHistogram, and their
+    events counted to report the fps over the sliding <windows> (in seconds).
+    Trackers of different threads or processes (they are picklable) can be merged.
+    """
+
+    def __init__(self, windows=(1., 5., 60.), precision_bits=7):
+        self.windows = tuple(windows)
+        self.histogram = LatencyHistogram(precision_bits)
+        self._rate = _EventRate(max(self.windows))
+        self._start = None
+        self._last_mark = None
+
+    # Using in <With> block to record time for a code block
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.tock()
+
+    def tick(self):
+        self._start = time.perf_counter_ns()
+
+    def tock(self):
+        end = time.perf_counter_ns()
+        self.update(end - self._start, end)
+
+    def mark(self):
+        """
+        Record the interval since the previous mark, call it once per frame
+        """
+        now = time.perf_counter_ns()
+        if self._last_mark is not None:
+            self.update(now - self._last_mark, now)
+        self._last_mark = now
+
+    def update(self, elapsed_ns, now_ns=None):
+        self.histogram.record(elapsed_ns)
+        self._rate.record(now_ns if now_ns is not None else time.perf_counter_ns())
+
+    def percentile(self, percent):
+        """
+        Recorded duration at <percent> in seconds
+        """
+        value = self.histogram.percentile(percent)
+        return value / 1e9 if value is not None else float('nan')
+
+    @property
+    def p50(self):
+        return self.percentile(50)
+
+    @property
+    def p95(self):
+        return self.percentile(95)
+
+    @property
+    def p99(self):
+        return self.percentile(99)
+
+    @property
+    def max(self):
+        return self.histogram.max / 1e9 if self.histogram.max is not None else float('nan')
+
+    @property
+    def jitter(self):
+        """
+        Standard deviation of the recorded durations in seconds
+        """
+        stddev = self.histogram.stddev
+        return stddev / 1e9 if stddev is not None else float('nan')
+
+    def fps(self, window=None):
+        """
+        Events per second over the last <window> seconds, the first of <windows> if not given
+        """
+        return self._rate.rate(window if window is not None else self.windows[0], time.perf_counter_ns())
+
+    def merge(self, other: 'LatencyTracker'):
+        """
+        Add the durations and events of <other>, its sliding window slots are aligned
+        on the same clock since perf_counter_ns is system-wide
+        """
+        if len(other._rate._slot_counts) != len(self._rate._slot_counts):
+            raise ValueError('trackers with different windows cannot be merged')
+        self.histogram.merge(other.histogram)
+        # the slots of <other> are aligned on a copy, <other> is left as it is
+        now_ns = time.perf_counter_ns()
+        other_rate = other._rate.copy()
+        other_rate._advance(now_ns)
+        self._rate._advance(now_ns)
+        for i, count in enumerate(other_rate._slot_counts):
+            self._rate._slot_counts[i] += count
+        if other._rate._first_ns is not None:
+            self._rate._first_ns = min(self._rate._first_ns or other._rate._first_ns, other._rate._first_ns)
+        return self
+
+    def summary(self):
+        """
+        Dict of the count, mean, p50, p95, p99, max and jitter of the durations in seconds,
+        and of the fps over each window
+        """
+        mean = self.histogram.mean
+        summary = {'count': self.histogram.count,
+                   'mean': mean / 1e9 if mean is not None else float('nan'),
+                   'p50': self.p50,
+                   'p95': self.p95,
+                   'p99': self.p99,
+                   'max': self.max,
+                   'jitter': self.jitter}
+        summary.update({f'fps_{window:g}s': self.fps(window) for window in self.windows})
+        return summary
@@ -1,6 +1,10 @@
+import atexit
 import logging
 import os
+import queue
 import sys
+import threading
+import time
 from datetime import datetime
 
 
@@ -8,9 +12,22 @@ from datetime import datetime
 # If this module has many classes or functions, we need to add more code to import
 __all__ = [
     'get_current_time_format',
-    'get_logger'
+    'get_logger',
+    'get_log_queue',
+    'attach_log_queue',
+    'stop_async_logging',
+    'AsyncLogHandler',
+    'AsyncLogListener',
+    'RateLimitFilter',
+    'log_every_n',
+    'log_at_most'
 ]
 
+_OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'block')
+# listeners of the async loggers, keyed by logger name
+_listeners = {}
+_listeners_lock = threading.Lock()
+
 
 def get_current_time_format(fmt='%d_%m_%Y_%H_%M_%S'):
     """
@@ -35,19 +52,278 @@ class _ColorizedLogFormatter(logging.Formatter):
     def __init__(self, color=False, *args, **kwargs):
         super(_ColorizedLogFormatter, self).__init__(*args, **kwargs)
         self.color = color
+        # the color codes are baked into a template per level instead of being set on each record
+        fmt = self._style._fmt
+        self._level_styles = {levelno: self._make_style(fmt, color_on, self.RESET_CODE)
+                              for levelno, color_on in self.COLOR_CODES.items()} if color else {}
+        self._plain_style = self._make_style(fmt, '', '')
+        self._uses_time = self._plain_style.usesTime()
+        # (second, formatted time) of the last record, time formatting is done once per second
+        self._cached_time = (None, None)
+
+    def _make_style(self, fmt, color_on, color_off):
+        return type(self._style)(fmt.replace('%(color_on)s', color_on).replace('%(color_off)s', color_off))
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        cached_second, formatted_time = self._cached_time
+        if cached_second != second:
+            formatted_time = time.strftime(datefmt if datefmt else self.default_time_format,
+                                           self.converter(record.created))
+            self._cached_time = (second, formatted_time)
+        if datefmt:
+            return formatted_time
+        return self.default_msec_format % (formatted_time, record.msecs)
 
     def format(self, record, *args, **kwargs):
-        if self.color and record.levelno in self.COLOR_CODES:
-            record.color_on = self.COLOR_CODES[record.levelno]
-            record.color_off = self.RESET_CODE
-        else:
-            record.color_on = record.color_off = ''
-        return super(_ColorizedLogFormatter, self).format(record, *args, **kwargs)
+        record.message = record.getMessage()
+        if self._uses_time:
+            record.asctime = self.formatTime(record, self.datefmt)
+        s = self._level_styles.get(record.levelno, self._plain_style).format(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            s = s + ('' if s[-1:] == '\n' else '\n') + record.exc_text
+        if record.stack_info:
+            s = s + ('' if s[-1:] == '\n' else '\n') + self.formatStack(record.stack_info)
+        return s
+
+
+class _CallSiteLimiter:
+    """
+    Let through 1 in <every_n> events and at most <max_per_second> per second of each key.
+    Keys are checked without lock, concurrent threads may let an extra event through.
+    """
+
+    def __init__(self, every_n=None, max_per_second=None):
+        self.every_n = every_n
+        self.max_per_second = max_per_second
+        # key -> [event count, current second, events let through in that second]
+        self._states = {}
+
+    def allow(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = [0, None, 0]
+        count = state[0]
+        state[0] = count + 1
+        if self.every_n is not None and count % self.every_n:
+            return False
+        if self.max_per_second is not None:
+            second = int(time.monotonic())
+            if state[1] != second:
+                state[1] = second
+                state[2] = 0
+            if state[2] >= self.max_per_second:
+                return False
+            state[2] += 1
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Filter sampling the records of each call site: 1 in <every_n> and at most <max_per_second> per second
+    """
+
+    def __init__(self, every_n=None, max_per_second=None):
+        super(RateLimitFilter, self).__init__()
+        self._limiter = _CallSiteLimiter(every_n, max_per_second)
+
+    def filter(self, record):
+        return self._limiter.allow((record.pathname, record.lineno))
+
+
+# limiters of the log_every_n and log_at_most call sites, keyed by their parameter
+_every_n_limiters = {}
+_at_most_limiters = {}
+
+
+def _log_sampled(limiters, limiter_kwargs, logger, level, msg, args, kwargs):
+    if not logger.isEnabledFor(level):
+        return
+    # the call site is told by the caller's frame, before any record is made
+    frame = sys._getframe(2)
+    key = tuple(limiter_kwargs.values())
+    limiter = limiters.get(key)
+    if limiter is None:
+        limiter = limiters.setdefault(key, _CallSiteLimiter(**limiter_kwargs))
+    if limiter.allow((frame.f_code, frame.f_lineno)):
+        kwargs.setdefault('stacklevel', 3)
+        logger.log(level, msg, *args, **kwargs)
 
 
-def get_logger(name, console_stream='stdout', log_dir=None):
+def log_every_n(logger, level, n, msg, *args, **kwargs):
+    """
+    Log from this call site once every <n> calls, cheap to call at full frame rate
+    """
+    _log_sampled(_every_n_limiters, {'every_n': n}, logger, level, msg, args, kwargs)
+
+
+def log_at_most(logger, level, max_per_second, msg, *args, **kwargs):
+    """
+    Log from this call site at most <max_per_second> times per second
+    """
+    _log_sampled(_at_most_limiters, {'max_per_second': max_per_second}, logger, level, msg, args, kwargs)
+
+
+class _BatchHandlerMixin:
+    """
+    Stream handler writing a batch of records at once, with a single flush
+    """
+
+    def handle_batch(self, records):
+        records = [record for record in records if record.levelno >= self.level and self.filter(record)]
+        if not len(records):
+            return
+        with self.lock:
+            try:
+                self.stream.write(''.join(self.format(record) + self.terminator for record in records))
+                self.flush()
+            except Exception:
+                self.handleError(records[-1])
+
+
+class _BatchStreamHandler(_BatchHandlerMixin, logging.StreamHandler):
+    pass
+
+
+class _BatchFileHandler(_BatchHandlerMixin, logging.FileHandler):
+    pass
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Handler putting the records onto a bounded queue drained by an AsyncLogListener,
+    so that logging never does I/O in the calling thread. When the queue is full,
+    <overflow_policy> 'drop_newest' drops the record, 'drop_oldest' drops the oldest
+    queued one and 'block' waits for room. The number of dropped records is logged
+    after the next record queued, as soon as there is room left for it.
+    """
+
+    def __init__(self, log_queue, overflow_policy='drop_newest'):
+        if overflow_policy not in _OVERFLOW_POLICIES:
+            raise ValueError(f'overflow_policy must be one of {_OVERFLOW_POLICIES}, got {overflow_policy}')
+        super(AsyncLogHandler, self).__init__()
+        self.log_queue = log_queue
+        self.overflow_policy = overflow_policy
+        self.dropped_count = 0
+        self._reported_dropped_count = 0
+
+    @staticmethod
+    def prepare(record):
+        """
+        Merge the arguments into the message and the exception into its text, so that
+        the record neither keeps mutable arguments nor unpicklable tracebacks
+        """
+        # a shallow copy for the other handlers of the record, without running LogRecord.__init__
+        prepared = logging.LogRecord.__new__(logging.LogRecord)
+        prepared.__dict__.update(record.__dict__)
+        record = prepared
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _put(self, record):
+        if self.overflow_policy == 'block':
+            self.log_queue.put(record)
+            return True
+        try:
+            self.log_queue.put_nowait(record)
+            return True
+        except queue.Full:
+            pass
+        if self.overflow_policy == 'drop_oldest':
+            try:
+                self.log_queue.get_nowait()
+                self.dropped_count += 1
+                self.log_queue.put_nowait(record)
+                return True
+            except (queue.Empty, queue.Full):
+                pass
+        self.dropped_count += 1
+        return False
+
+    def emit(self, record):
+        try:
+            if self._put(self.prepare(record)) and self.dropped_count > self._reported_dropped_count:
+                dropped_count = self.dropped_count
+                # only put if there is room, a report evicting a record would itself need reporting
+                try:
+                    self.log_queue.put_nowait(logging.makeLogRecord({
+                        'name': record.name,
+                        'levelno': logging.WARNING,
+                        'levelname': logging.getLevelName(logging.WARNING),
+                        'msg': f'{dropped_count - self._reported_dropped_count} log records dropped, '
+                               f'the log queue was full',
+                        'processName': record.processName,
+                        'threadName': record.threadName}))
+                    self._reported_dropped_count = dropped_count
+                except queue.Full:
+                    pass
+        except Exception:
+            self.handleError(record)
+
+
+class AsyncLogListener:
+    """
+    Background thread draining <log_queue> into <handlers> in batches of up to <batch_size> records,
+    handlers with handle_batch write each batch at once
+    """
+
+    def __init__(self, log_queue, handlers, batch_size=256):
+        self.log_queue = log_queue
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='LogListener', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            records = [self.log_queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is the stop sentinel, the records queued before it are still written
+            if None in records:
+                stopped = True
+                records = records[:records.index(None)]
+            for handler in self.handlers:
+                if hasattr(handler, 'handle_batch'):
+                    handler.handle_batch(records)
+                else:
+                    [handler.handle(record) for record in records if record.levelno >= handler.level]
+
+    def stop(self, timeout=None):
+        """
+        Write the queued records and stop the thread
+        """
+        if self._thread is None:
+            return
+        self.log_queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+        [handler.close() for handler in self.handlers]
+
+
+def get_logger(name, console_stream='stdout', log_dir=None, async_mode=False, queue_size=10000,
+               overflow_policy='drop_newest', multiprocess=False, batch_size=256):
     """
     Logging according to the setting format
+
+    With <async_mode>, log calls only put their record onto a queue of <queue_size> records,
+    formatting and I/O are done in batches by a background AsyncLogListener. See AsyncLogHandler
+    for <overflow_policy>. With <multiprocess>, the queue is a multiprocessing queue, forked
+    child processes log through the logger they inherit and spawned ones attach it with
+    attach_log_queue(name, get_log_queue(name)).
     """
 
     logger = logging.getLogger(name)
@@ -56,20 +332,84 @@ def get_logger(name, console_stream='stdout', log_dir=None):
     log_format = '%(color_on)s%(asctime)s.%(msecs)03d ' \
                  '[%(threadName)s] [%(name)s] [%(levelname)s] %(message)s%(color_off)s'
     date_format = '%m/%d/%Y %H:%M:%S'
+    handlers = []
     if log_dir is not None:
         os.makedirs(log_dir, exist_ok=True)
         logfile = os.path.join(log_dir, get_current_time_format()) + '.log'
-        logfile_handler = logging.FileHandler(logfile, mode='w')
+        logfile_handler = (_BatchFileHandler if async_mode else logging.FileHandler)(logfile, mode='w')
         logfile_handler.setFormatter(_ColorizedLogFormatter(fmt=log_format, datefmt=date_format, color=False))
-        logger.addHandler(logfile_handler)
+        handlers.append(logfile_handler)
     if console_stream:
         stream = getattr(sys, console_stream) if isinstance(console_stream, str) else console_stream
-        console_handler = logging.StreamHandler(stream)
+        console_handler = (_BatchStreamHandler if async_mode else logging.StreamHandler)(stream)
         console_handler.setFormatter(_ColorizedLogFormatter(fmt=log_format, datefmt=date_format, color=True))
-        logger.addHandler(console_handler)
+        handlers.append(console_handler)
+    if not async_mode:
+        [logger.addHandler(handler) for handler in handlers]
+        return logger
+
+    if multiprocess:
+        import multiprocessing as mp
+
+        log_queue = mp.Queue(queue_size)
+    else:
+        log_queue = queue.Queue(queue_size)
+    listener = AsyncLogListener(log_queue, handlers, batch_size)
+    with _listeners_lock:
+        previous_listener = _listeners.get(name)
+        _listeners[name] = listener
+    if previous_listener is not None:
+        _stop_listener(name, previous_listener)
+    listener.start()
+    logger.addHandler(AsyncLogHandler(log_queue, overflow_policy))
     return logger
 
 
+def get_log_queue(name):
+    """
+    Queue of the async logger <name>, to pass to the child processes
+    """
+    with _listeners_lock:
+        listener = _listeners.get(name)
+    return listener.log_queue if listener is not None else None
+
+
+def attach_log_queue(name, log_queue, overflow_policy='drop_newest'):
+    """
+    In a child process, send the records of logger <name> to the listener of the parent through <log_queue>
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    # handlers inherited from a forked parent would log twice
+    [logger.removeHandler(handler) for handler in list(logger.handlers) if isinstance(handler, AsyncLogHandler)]
+    logger.addHandler(AsyncLogHandler(log_queue, overflow_policy))
+    return logger
+
+
+def stop_async_logging(name=None, timeout=5.):
+    """
+    Write the queued records of the async logger <name>, or of every one, and stop their listeners
+    """
+    with _listeners_lock:
+        names = list(_listeners) if name is None else [name]
+        listeners = [(n, _listeners.pop(n, None)) for n in names]
+    for n, listener in listeners:
+        if listener is not None:
+            _stop_listener(n, listener, timeout)
+
+
+def _stop_listener(name, listener, timeout=5.):
+    logger = logging.getLogger(name)
+    # later records would only fill the queue of the stopped listener
+    [logger.removeHandler(handler) for handler in list(logger.handlers)
+     if isinstance(handler, AsyncLogHandler) and handler.log_queue is listener.log_queue]
+    listener.stop(timeout)
+
+
+# records still queued at exit are written before the streams close
+atexit.register(stop_async_logging)
+
+
 if __name__ == '__main__':
     logger = get_logger(__file__)
     logger.warning('yo!')
@@ -1,50 +1,292 @@
-import matplotlib.colors
-import numpy as np
-from matplotlib.cm import get_cmap as mpl_get_cmap, _colormaps
+import collections
+import threading
+import weakref
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+    # ColorMap subclasses it, the class is defined when first used, see _LAZY_ATTRIBUTES
+    from matplotlib.colors import ListedColormap as ColorMap
 
 # It means when use: <from mpl_color_utils import *>, it will import all in <__all__> variable.
 # If this module has many classes or functions, we need to add more code to import
 __all__ = ['COLOR_MAPS', 'BASE_COLORS', 'TABLEAU_COLORS', 'XKCD_COLORS', 'CSS4_COLORS',
            'ColorMap', 'get_cmap', 'to_rgb']
 
-COLOR_MAPS = _colormaps()
-BASE_COLORS = list(matplotlib.colors.BASE_COLORS.keys())
-TABLEAU_COLORS = list(matplotlib.colors.TABLEAU_COLORS.keys())
-XKCD_COLORS = list(matplotlib.colors.XKCD_COLORS.keys())
-CSS4_COLORS = list(matplotlib.colors.CSS4_COLORS.keys())
+# colormaps returned by get_cmap, shared by the callers, least recently used first
+_CMAP_CACHE_SIZE = 32
+_cmap_cache = collections.OrderedDict()
+_cmap_cache_lock = threading.Lock()
+# alignment of the tables in the shared memory block of a colormap
+_SHARED_TABLE_ALIGNMENT = 64
+
+_lazy_attributes_lock = threading.RLock()
+
+
+def _color_maps():
+    from matplotlib.cm import _colormaps
+
+    return _colormaps()
+
+
+def _color_names(name):
+    import matplotlib.colors
+
+    return list(getattr(matplotlib.colors, name).keys())
+
+
+# matplotlib is only imported when one of these is used
+_LAZY_ATTRIBUTES = {
+    'COLOR_MAPS': _color_maps,
+    'BASE_COLORS': lambda: _color_names('BASE_COLORS'),
+    'TABLEAU_COLORS': lambda: _color_names('TABLEAU_COLORS'),
+    'XKCD_COLORS': lambda: _color_names('XKCD_COLORS'),
+    'CSS4_COLORS': lambda: _color_names('CSS4_COLORS'),
+    'ColorMap': lambda: _define_color_map_class(),
+}
 
 
-# noinspection PyMethodOverriding
-class ColorMap(matplotlib.colors.ListedColormap):
-    def __init__(self, colors, name='from_list', N=None, scale=1.0):
-        super(ColorMap, self).__init__(colors[:, :3], name, N)
-        self.scale = scale
+def __getattr__(name):
+    factory = _LAZY_ATTRIBUTES.get(name)
+    if factory is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    with _lazy_attributes_lock:
+        # built once, then found in the module globals without calling __getattr__
+        if name not in globals():
+            globals()[name] = factory()
+        return globals()[name]
 
-    @staticmethod
-    def from_cmap(cmap, scale=1.0):
-        if isinstance(cmap, matplotlib.colors.Colormap):
-            if hasattr(cmap, 'colors'):
-                colors = cmap.colors
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+
+def _define_color_map_class():
+    import matplotlib.colors
+    import numpy as np
+
+    # noinspection PyMethodOverriding
+    class ColorMap(matplotlib.colors.ListedColormap):
+        def __init__(self, colors, name='from_list', N=None, scale=1.0):
+            super(ColorMap, self).__init__(np.asarray(colors)[:, :3], name, N)
+            self.scale = scale
+            # lookup tables of the scaled colors, keyed by dtype, built for the parameters they depend on
+            self._scaled_luts = {}
+            self._scaled_lut_params = None
+            # (name, lut, scale) of the colormaps cached by get_cmap
+            self._cache_key = None
+            # ((table params, table keys), finalizer of the block, SharedArray of each table) once pickled
+            self._shared_tables = None
+            # blocks holding the tables received from another process, viewed by _scaled_luts
+            self._attached_blocks = {}
+
+        @staticmethod
+        def from_cmap(cmap, scale=1.0):
+            if isinstance(cmap, matplotlib.colors.Colormap):
+                if hasattr(cmap, 'colors'):
+                    colors = cmap.colors
+                else:
+                    colors = np.array([cmap(i) for i in range(cmap.N)])
+                return ColorMap(colors, cmap.name, scale=scale)
+            return ColorMap(np.array(cmap), scale=scale)
+
+        def lut(self, dtype=np.float64):
+            """
+            Cached (N + 3, 3) lookup table of the colors multiplied by <scale>, followed by the
+            under, over and bad colors. Integer tables are rounded and clipped to their range.
+            """
+            dtype = np.dtype(dtype)
+            extra_colors = (self.get_under(), self.get_over(), self.get_bad())
+            params = self._table_params()
+            if params != self._scaled_lut_params:
+                # scale or extra colors changed, every table is stale
+                self._scaled_luts = {}
+                self._scaled_lut_params = params
+            lut = self._scaled_luts.get(dtype)
+            if lut is None:
+                lut = np.concatenate([np.asarray(super(ColorMap, self).__call__(np.arange(self.N)))[:, :3],
+                                      np.array(extra_colors)[:, :3]]) * self.scale
+                if dtype.kind in 'ui':
+                    info = np.iinfo(dtype)
+                    lut = np.clip(np.rint(lut), info.min, info.max)
+                lut = self._scaled_luts[dtype] = lut.astype(dtype)
+                lut.flags.writeable = False
+            return lut
+
+        def _table_params(self):
+            return self.scale, tuple(tuple(c) for c in (self.get_under(), self.get_over(), self.get_bad()))
+
+        def _indices(self, values):
+            """
+            Rows of the lookup table for <values> as matplotlib maps them: floats in [0, 1]
+            along the colormap, integers as indices, out of range and nan to under, over and bad
+            """
+            n = self.N
+            if values.dtype.kind == 'b':
+                return values.astype(np.intp)
+            if values.dtype.kind == 'f':
+                x = values * n
+                x[x == n] = n - 1
             else:
-                colors = np.array([cmap(i) for i in range(cmap.N)])
-            return ColorMap(colors, cmap.name, scale=scale)
-        return ColorMap(np.array(cmap), scale=scale)
+                x = values
+            with np.errstate(invalid='ignore'):
+                indices = x.astype(np.intp)
+            indices[x < 0] = n
+            indices[x >= n] = n + 1
+            if values.dtype.kind == 'f':
+                indices[np.isnan(x)] = n + 2
+            return indices
+
+        def _expanded_lut(self, ids_dtype, dtype):
+            """
+            Table of every 8 or 16-bit id, indexed by the unsigned view of the ids
+            """
+            self.lut(dtype)
+            key = (ids_dtype, dtype)
+            expanded_lut = self._scaled_luts.get(key)
+            if expanded_lut is None:
+                ids = np.arange(1 << (8 * ids_dtype.itemsize), dtype=f'u{ids_dtype.itemsize}').view(ids_dtype)
+                expanded_lut = self._scaled_luts[key] = self.lut(dtype)[self._indices(ids)]
+                expanded_lut.flags.writeable = False
+            return expanded_lut
 
-    def __call__(self, item):
-        color = super(ColorMap, self).__call__(item)
-        return np.array(color[:3]) * self.scale
+        def map(self, values, dtype=None, out=None) -> np.ndarray:
+            """
+            Colorize an array of scalars or class ids of any shape into a (..., 3) array of
+            <dtype>, the dtype of <out> if given else float64, through the cached lookup tables.
+            Use scale=255 with uint8 to draw 8-bit images.
+            """
+            values = np.asarray(values)
+            dtype = out.dtype if out is not None else np.dtype(dtype if dtype is not None else np.float64)
+            if values.ndim == 0:
+                return self.map(values[None], dtype)[0] if out is None else self.map(values[None], out=out[None])[0]
+            if values.dtype.kind in 'ui' and values.dtype.itemsize <= 2:
+                # 8 and 16-bit ids, the label maps, are colored by a single take
+                return np.take(self._expanded_lut(values.dtype, dtype),
+                               values.view(f'u{values.dtype.itemsize}'), axis=0, out=out)
+            return np.take(self.lut(dtype), self._indices(values), axis=0, out=out)
 
-    def __getitem__(self, item):
-        return self(item)
+        def __call__(self, item):
+            return self.map(item)
 
+        def __copy__(self):
+            cmap = super(ColorMap, self).__copy__()
+            # a copy may be modified, it is no longer the cached colormap of its key
+            cmap._cache_key = None
+            cmap._scaled_luts = dict(self._scaled_luts)
+            cmap._shared_tables = None
+            return cmap
 
-def get_cmap(name=None, lut=None, scale=1.0) -> ColorMap:
+        def _share_tables(self):
+            """
+            Copy the tables built so far into a shared memory block, created again only
+            when other tables were built since, and return their SharedArray by key
+            """
+            from multiprocessing import shared_memory
+
+            from .concurrent.shared_memory_utils import SharedArray
+
+            version = (self._scaled_lut_params, tuple(self._scaled_luts))
+            if self._shared_tables is not None and self._shared_tables[0] == version:
+                return self._shared_tables[2]
+            if self._shared_tables is not None:
+                # the processes which attached the previous block keep their mapping
+                self._shared_tables[1]()
+            offsets, size = [], 0
+            for table in self._scaled_luts.values():
+                offsets.append(size)
+                size += -(-table.nbytes // _SHARED_TABLE_ALIGNMENT) * _SHARED_TABLE_ALIGNMENT
+            block = shared_memory.SharedMemory(create=True, size=size)
+            shared_tables = {}
+            for offset, (key, table) in zip(offsets, self._scaled_luts.items()):
+                shared_tables[key] = SharedArray(block.name, table.shape, table.dtype.str, offset)
+                np.copyto(shared_tables[key].as_array(block.buf), table)
+            # unlinked with the colormap, evicted from the cache, or at exit
+            self._shared_tables = (version, weakref.finalize(self, _close_shared_block, block), shared_tables)
+            return shared_tables
+
+        def _attach_tables(self, params, shared_tables):
+            """
+            View the tables of another process, <shared_tables> built with <params>,
+            instead of building them
+            """
+            from multiprocessing import shared_memory
+
+            if params != self._table_params():
+                return
+            if params != self._scaled_lut_params:
+                self._scaled_luts = {}
+                self._scaled_lut_params = params
+            for key, shared_table in shared_tables.items():
+                if key in self._scaled_luts:
+                    continue
+                block = self._attached_blocks.get(shared_table.name)
+                if block is None:
+                    block = self._attached_blocks[shared_table.name] = \
+                        shared_memory.SharedMemory(name=shared_table.name)
+                table = self._scaled_luts[key] = shared_table.as_array(block.buf)
+                table.flags.writeable = False
+
+        def __reduce_ex__(self, protocol):
+            # cached colormaps are sent to worker processes by key, with their tables in shared memory
+            if self._cache_key is not None:
+                if not len(self._scaled_luts):
+                    return get_cmap, self._cache_key
+                return _get_cmap_with_tables, (self._cache_key, self._scaled_lut_params, self._share_tables())
+            return super(ColorMap, self).__reduce_ex__(protocol)
+
+        def __getitem__(self, item):
+            return self(item)
+
+    # pickled by reference to the module attribute
+    ColorMap.__module__ = __name__
+    ColorMap.__qualname__ = 'ColorMap'
+    return ColorMap
+
+
+def get_cmap(name=None, lut=None, scale=1.0) -> 'ColorMap':
     """
     Create a list of class - color
+
+    Colormaps are cached by (<name>, <lut>, <scale>) and shared by the callers,
+    copy() one before modifying it. Pickled to worker processes, a cached colormap
+    brings the lookup tables built so far in read-only shared memory.
     """
 
-    return ColorMap.from_cmap(mpl_get_cmap(name, lut), scale=scale)
+    key = (name, lut, scale)
+    with _cmap_cache_lock:
+        cmap = _cmap_cache.get(key)
+        if cmap is not None:
+            _cmap_cache.move_to_end(key)
+            return cmap
+    from matplotlib.cm import get_cmap as mpl_get_cmap
+
+    cmap = __getattr__('ColorMap').from_cmap(mpl_get_cmap(name, lut), scale=scale)
+    cmap._cache_key = key
+    with _cmap_cache_lock:
+        cmap = _cmap_cache.setdefault(key, cmap)
+        _cmap_cache.move_to_end(key)
+        while len(_cmap_cache) > _CMAP_CACHE_SIZE:
+            _cmap_cache.popitem(last=False)
+    return cmap
+
+
+def _get_cmap_with_tables(cache_key, params, shared_tables):
+    """
+    Unpickle a cached colormap: get_cmap(*<cache_key>) viewing the <shared_tables> of the sending process
+    """
+    cmap = get_cmap(*cache_key)
+    cmap._attach_tables(params, shared_tables)
+    return cmap
+
+
+def _close_shared_block(block):
+    block.close()
+    block.unlink()
+
 
+def to_rgb(c=None, scale=1.0) -> 'np.ndarray':
+    import matplotlib.colors
+    import numpy as np
 
-def to_rgb(c=None, scale=1.0) -> np.ndarray:
     return np.array(matplotlib.colors.to_rgb(c)) * scale
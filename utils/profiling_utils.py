@@ -0,0 +1,211 @@
+import functools
+import os
+import threading
+import time
+
+from .fps_tracker import LatencyTracker
+
+# It means when use: <from profiling_utils import *>, it will import all in <__all__> variable.
+# If this module has many classes or functions, we need to add more code to import
+__all__ = ['profile_scope', 'enable_profiling', 'disable_profiling', 'is_profiling_enabled',
+           'start_trace', 'stop_trace', 'export_chrome_trace',
+           'profile_stats', 'profile_report', 'reset_profiling']
+
+_enabled = False
+_tracing = False
+_max_trace_events = 1 << 20
+
+_local = threading.local()
+# per-thread state registered for the reports, threads only write their own
+_thread_states = []
+_thread_states_lock = threading.Lock()
+# trackers merged and trace events of the threads which exited, see _retire_exited_thread_states
+_exited_trackers = {}
+_exited_trace_events = []
+
+
+class _ThreadState:
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        # paths of the open scopes, the innermost last
+        self.stack = []
+        self.trackers = {}
+        self.trace_events = []
+
+
+def _merge_trackers(stats, trackers):
+    for path, tracker in list(trackers.items()):
+        merged = stats.get(path)
+        if merged is None:
+            merged = stats[path] = LatencyTracker()
+        merged.merge(tracker)
+
+
+def _retire_exited_thread_states():
+    """
+    Move the statistics of the exited threads out of their states, so that threads
+    started and stopped over and over do not pile up states. Called with the lock held.
+    """
+    alive_states = []
+    for state in _thread_states:
+        if state.thread.is_alive():
+            alive_states.append(state)
+            continue
+        _merge_trackers(_exited_trackers, state.trackers)
+        if len(state.trace_events):
+            _exited_trace_events.append((state.thread_id, state.thread_name, state.trace_events))
+    _thread_states[:] = alive_states
+
+
+def _thread_state():
+    state = getattr(_local, 'state', None)
+    if state is None:
+        state = _local.state = _ThreadState()
+        with _thread_states_lock:
+            _retire_exited_thread_states()
+            _thread_states.append(state)
+    return state
+
+
+def enable_profiling(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def disable_profiling():
+    enable_profiling(False)
+
+
+def is_profiling_enabled():
+    return _enabled
+
+
+def start_trace(max_events=1 << 20):
+    """
+    Keep the scopes as Chrome trace events, at most <max_events> of them, until stop_trace
+    """
+    global _tracing, _max_trace_events
+    _max_trace_events = max_events
+    _tracing = True
+
+
+def stop_trace():
+    global _tracing
+    _tracing = False
+
+
+class profile_scope:
+    """
+    Named profiling scope, used as a context manager or a decorator. Scopes opened
+    inside another one in the same thread are recorded under its path, e.g.
+    frame/capture, so that each frame builds a timing tree. Each path aggregates its
+    durations in a LatencyTracker. When profiling is disabled, a scope only checks a flag.
+    """
+
+    __slots__ = ('name', '_state', '_start')
+
+    def __init__(self, name):
+        self.name = name
+        self._state = None
+        self._start = None
+
+    def __enter__(self):
+        if not _enabled:
+            self._state = None
+            return self
+        state = self._state = _thread_state()
+        state.stack.append(f'{state.stack[-1]}/{self.name}' if len(state.stack) else self.name)
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        state = self._state
+        if state is None:
+            return
+        end = time.perf_counter_ns()
+        path = state.stack.pop()
+        tracker = state.trackers.get(path)
+        if tracker is None:
+            tracker = state.trackers[path] = LatencyTracker()
+        tracker.update(end - self._start, end)
+        if _tracing and len(state.trace_events) < _max_trace_events:
+            state.trace_events.append((path, self._start, end - self._start))
+
+    def __call__(self, fn):
+        name = self.name
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            # a scope per call, the decorated function may be reentrant or called from several threads
+            with profile_scope(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+
+def profile_stats():
+    """
+    Merge the trackers of every thread, returns a dict mapping each scope path to its LatencyTracker
+    """
+    stats = {}
+    with _thread_states_lock:
+        states = list(_thread_states)
+        _merge_trackers(stats, _exited_trackers)
+    for state in states:
+        _merge_trackers(stats, state.trackers)
+    return stats
+
+
+def profile_report():
+    """
+    Text tree of the scopes with their count and duration statistics in milliseconds
+    """
+    lines = [f'{"scope":<40} {"count":>8} {"mean":>9} {"p50":>9} {"p95":>9} {"p99":>9} {"max":>9}']
+    for path, tracker in sorted(profile_stats().items()):
+        summary = tracker.summary()
+        names = path.split('/')
+        lines.append(f'{"  " * (len(names) - 1) + names[-1]:<40} {summary["count"]:>8}'
+                     + ''.join(f' {summary[k] * 1e3:>9.3f}' for k in ('mean', 'p50', 'p95', 'p99', 'max')))
+    return '\n'.join(lines)
+
+
+def export_chrome_trace(path):
+    """
+    Write the traced scopes in the Chrome trace event format, to open in chrome://tracing or Perfetto
+    """
+    import json
+
+    with _thread_states_lock:
+        threads = list(_exited_trace_events) + [(state.thread_id, state.thread_name, state.trace_events)
+                                                for state in _thread_states]
+    pid = os.getpid()
+    events = []
+    for thread_id, thread_name, trace_events in threads:
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id,
+                       'args': {'name': thread_name}})
+        events.extend({'name': scope_path.rsplit('/', 1)[-1],
+                       'cat': scope_path,
+                       'ph': 'X',
+                       'ts': start / 1e3,
+                       'dur': duration / 1e3,
+                       'pid': pid,
+                       'tid': thread_id}
+                      for scope_path, start, duration in list(trace_events))
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def reset_profiling():
+    """
+    Clear the statistics and trace events of every thread
+    """
+    with _thread_states_lock:
+        for state in _thread_states:
+            state.trackers = {}
+            state.trace_events = []
+        _exited_trackers.clear()
+        _exited_trace_events.clear()
@@ -1,21 +1,39 @@
+import collections
+import ctypes
+import functools
+import itertools
+import math
 import multiprocessing as mp
+import os
+import subprocess
+import threading
+import time
 from collections.abc import Sequence
+from multiprocessing import resource_tracker, shared_memory
 
-import cv2
 import numpy as np
-from PIL import Image
-from mss import mss
 
-from .concurrent.threading_utils import execute_for
+from .concurrent.metrics_utils import MetricsLayout, MetricsWriter, SharedMetrics
+from .concurrent.shared_memory_utils import SharedFrameRing
+from .concurrent.threading_utils import sleep_until
 
 # It means when use: <from recording_utils import *>, it will import all in <__all__> variable.
 # If this module has many classes or functions, we need to add more code to import
-__all__ = ['ScreenRecorder']
+__all__ = ['ScreenRecorder', 'RecordSession', 'FrameTap', 'VideoEncoder', 'OpenCVEncoder', 'FFmpegEncoder', 'RawEncoder']
+
+_FRAME_POLICIES = ('duplicate', 'skip')
+_CHANGE_BLOCK_SIZE = 32
+_SPIN_THRESHOLD = 1e-3
+_TAP_POLICIES = ('latest', 'lossless')
+_TAP_POLL_INTERVAL = 1e-3
+_FFMPEG_STDERR_LINES = 20
 
 
 def _get_fourcc(fourcc):
     if isinstance(fourcc, int):
         return fourcc
+    import cv2
+
     return cv2.VideoWriter_fourcc(*fourcc)
 
 
@@ -32,81 +50,1058 @@ def _get_bbox(monitor):
     return monitor
 
 
+class VideoEncoder:
+    """
+    Backend writing the BGR frames of a recording. Encoders are configured in the
+    calling process and opened in the recording process, so they must be picklable
+    until open is called.
+    """
+
+    def open(self, record_file, fps, width, height):
+        raise NotImplementedError
+
+    def write(self, img: np.ndarray):
+        raise NotImplementedError
+
+    def write_frame(self, img: np.ndarray, timestamp: float, dirty_rects=None):
+        """
+        Write <img> captured at <timestamp>, a time.perf_counter() value. With change detection,
+        <dirty_rects> lists the rectangles (x, y, width, height) changed since the previous frame,
+        empty for a repeated frame, it is None otherwise. Encoders writing every pixel at a fixed
+        frame rate ignore both.
+        """
+        self.write(img)
+
+    def close(self):
+        raise NotImplementedError
+
+
+class OpenCVEncoder(VideoEncoder):
+    def __init__(self, fourcc='DIVX'):
+        # converted by open, in the recording process, so that cv2 is not imported by the caller
+        self.fourcc = fourcc
+        self._video_writer = None
+
+    def open(self, record_file, fps, width, height):
+        import cv2
+
+        self._video_writer = cv2.VideoWriter(record_file, _get_fourcc(self.fourcc), fps, (width, height))
+
+    def write(self, img):
+        self._video_writer.write(img)
+
+    def close(self):
+        self._video_writer.release()
+
+
+class FFmpegEncoder(VideoEncoder):
+    """
+    Stream the raw frames to the stdin of an ffmpeg subprocess encoding them with <codec>.
+    <preset> and <threads> are passed as is to ffmpeg (threads=0 lets it choose),
+    the quality is set by <crf> or <bitrate> (e.g. '4M'), otherwise the codec default is used.
+    """
+
+    def __init__(self, codec='libx264', preset='ultrafast', threads=0, crf=None, bitrate=None,
+                 pix_fmt='yuv420p', ffmpeg='ffmpeg', extra_args=()):
+        self.codec = codec
+        self.preset = preset
+        self.threads = threads
+        self.crf = crf
+        self.bitrate = bitrate
+        self.pix_fmt = pix_fmt
+        self.ffmpeg = ffmpeg
+        self.extra_args = list(extra_args)
+        self._proc = None
+        self._stderr_thread = None
+        self._stderr_tail = None
+
+    def command(self, record_file, fps, width, height):
+        command = [self.ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+                   '-c:v', self.codec, '-threads', str(self.threads)]
+        if self.preset is not None:
+            command.extend(['-preset', self.preset])
+        if self.crf is not None:
+            command.extend(['-crf', str(self.crf)])
+        if self.bitrate is not None:
+            command.extend(['-b:v', str(self.bitrate)])
+        if self.pix_fmt is not None:
+            command.extend(['-pix_fmt', self.pix_fmt])
+        return command + self.extra_args + [record_file]
+
+    def open(self, record_file, fps, width, height):
+        self._proc = subprocess.Popen(self.command(record_file, fps, width, height),
+                                      stdin=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+        # stderr is drained so that a verbose ffmpeg never blocks on a full pipe, its tail is kept for errors
+        self._stderr_tail = collections.deque(maxlen=_FFMPEG_STDERR_LINES)
+        self._stderr_thread = threading.Thread(target=self._stderr_tail.extend, args=(self._proc.stderr,),
+                                               daemon=True)
+        self._stderr_thread.start()
+
+    def write(self, img):
+        # frames are contiguous, their buffer is written without copy
+        self._proc.stdin.write(img.data)
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._proc.wait()
+        self._stderr_thread.join()
+        self._proc.stderr.close()
+        if self._proc.returncode != 0:
+            stderr = b''.join(self._stderr_tail).decode(errors='replace')
+            raise RuntimeError(f'ffmpeg exited with code {self._proc.returncode}: {stderr}')
+
+
+class RawEncoder(VideoEncoder):
+    """
+    Write the uncompressed bgr24 frames one after the other, e.g. to measure the
+    pipeline without encoding cost. The file is readable by ffmpeg with
+    -f rawvideo -pix_fmt bgr24 -s <width>x<height>.
+    """
+
+    def __init__(self, buffering=1 << 20):
+        self.buffering = buffering
+        self._file = None
+
+    def open(self, record_file, fps, width, height):
+        self._file = open(record_file, 'wb', buffering=self.buffering)
+
+    def write(self, img):
+        self._file.write(img.data)
+
+    def close(self):
+        self._file.close()
+
+
+def _close_ring_block(owner, unlink=False):
+    """
+    Close the shared memory block of <owner>, a replay encoder or a frame tap, holding
+    its SharedFrameRing, and unlink it with <unlink>
+    """
+    # the arrays of the ring view the mapping of the block, they are dropped so that none outlives it
+    owner._ring = None
+    owner._block.close()
+    if unlink:
+        owner._block.unlink()
+
+
+class _ReplayEncoder(VideoEncoder):
+    """
+    Keep the frames in a SharedFrameRing laid out in the shared memory block
+    <block_name>, downscaled by <scale>, instead of writing them to disk
+    """
+
+    def __init__(self, block_name, scale=1., capacity=None):
+        self.block_name = block_name
+        self.scale = scale
+        self.capacity = capacity
+        self._block = None
+        self._ring = None
+
+    def open(self, record_file, fps, width, height):
+        self._block = shared_memory.SharedMemory(name=self.block_name)
+        shape = (max(round(height * self.scale), 1), max(round(width * self.scale), 1), 3)
+        self._ring = SharedFrameRing.create(self._block.buf, shape, fps, self.capacity)
+
+    def write(self, img):
+        self.write_frame(img, None)
+
+    def write_frame(self, img, timestamp, dirty_rects=None):
+        with self._ring.writing(timestamp) as slot:
+            if slot.shape == img.shape:
+                np.copyto(slot, img)
+            else:
+                import cv2
+
+                cv2.resize(img, (slot.shape[1], slot.shape[0]), dst=slot, interpolation=cv2.INTER_AREA)
+
+    def close(self):
+        _close_ring_block(self)
+
+
 class _RecordTask:
     def __init__(self,
                  record_file,
                  monitor=0,
                  bbox=None,
                  fps=30,
-                 fourcc='DIVX',
+                 encoder=None,
+                 buffer_size=64,
+                 frame_policy='duplicate',
+                 detect_changes=False,
                  ):
-        print(record_file, monitor, bbox, fps, fourcc)
         self.record_file = record_file
         self.monitor = monitor
         self.bbox = _get_bbox(bbox)
         self.fps = fps
-        self.fourcc = _get_fourcc(fourcc)
+        self.encoder = encoder if encoder is not None else OpenCVEncoder()
+        self.buffer_size = buffer_size
+        self.frame_policy = frame_policy
+        self.detect_changes = detect_changes
+        # slot of the session counters in the shared stats array
+        self.stats_index = None
+
+
+class _RecordStats(ctypes.Structure):
+    """
+    Counters of a recording session, kept in an array shared with the recording
+    process, each field is only written by a single thread of that process.
+    """
+
+    _fields_ = [('start_time', ctypes.c_double),
+                ('end_time', ctypes.c_double),
+                ('captured_count', ctypes.c_uint64),
+                ('written_count', ctypes.c_uint64),
+                ('dropped_count', ctypes.c_uint64),
+                ('duplicated_count', ctypes.c_uint64),
+                ('unchanged_count', ctypes.c_uint64)]
+
+    def reset(self, start_time):
+        self.end_time = 0.
+        self.captured_count = self.written_count = 0
+        self.dropped_count = self.duplicated_count = self.unchanged_count = 0
+        self.start_time = start_time
+
+    def as_dict(self):
+        end_time = self.end_time or time.perf_counter()
+        elapsed_time = end_time - self.start_time if self.start_time else 0.
+        return {'fps': self.captured_count / elapsed_time if elapsed_time > 0 else 0.,
+                'elapsed_time': elapsed_time,
+                'captured': self.captured_count,
+                'written': self.written_count,
+                'dropped': self.dropped_count,
+                'duplicated': self.duplicated_count,
+                'unchanged': self.unchanged_count}
+
+
+class _FrameRing:
+    """
+    Bounded buffer between two stages of the recording pipeline. A non-blocking put
+    overwrites the oldest frame when the ring is full so that the producer never waits.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.dropped_count = 0
+        self._frames = collections.deque()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, frame, block=False):
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._frames) >= self.capacity:
+                if block:
+                    self._condition.wait_for(lambda: len(self._frames) < self.capacity or self._closed)
+                else:
+                    self._frames.popleft()
+                    self.dropped_count += 1
+            self._frames.append(frame)
+            self._condition.notify_all()
+
+    def get(self):
+        """
+        Return the oldest frame, or None once the ring is closed and empty
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._frames) or self._closed)
+            frame = self._frames.popleft() if len(self._frames) else None
+            self._condition.notify_all()
+            return frame
+
+    def __len__(self):
+        return len(self._frames)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+def _bgra_view(raw, width, height):
+    """
+    View of a raw BGRA screenshot buffer as a (height, width, 4) array, without copy
+    """
+    return np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 4)
+
+
+def _bgra_to_bgr(bgra, out):
+    """
+    Convert a BGRA screenshot view into the preallocated BGR array <out>
+    """
+    import cv2
+
+    return cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=out)
+
+
+class _ChangeDetector:
+    """
+    Compare each screenshot with the previous one to find the blocks of <block_size>
+    pixels that changed, merged along block rows into dirty rectangles (x, y, width, height)
+    """
+
+    def __init__(self, width, height, block_size=_CHANGE_BLOCK_SIZE):
+        self.width = width
+        self.height = height
+        self.block_size = block_size
+        self._col_starts = np.arange(0, width, block_size)
+        self._previous = None
+
+    def dirty_rects(self, bgra):
+        """
+        Return the dirty rectangles of the BGRA view <bgra> since the previous call,
+        an empty list if it is unchanged
+        """
+        import cv2
+
+        previous, self._previous = self._previous, bgra
+        if previous is None:
+            return [(0, 0, self.width, self.height)]
+        # unchanged frames, the common case on idle screens, only cost one vectorized pass
+        # which also works on the strided crops of a larger screenshot
+        if cv2.norm(bgra, previous, cv2.NORM_INF) == 0:
+            return []
+        # BGRA pixels compared as 32-bit words
+        changed = bgra.view(np.uint32)[..., 0] != previous.view(np.uint32)[..., 0]
+        changed_rows = changed.any(axis=1)
+        rects = []
+        for y in range(0, self.height, self.block_size):
+            if not changed_rows[y:y + self.block_size].any():
+                continue
+            height = min(self.block_size, self.height - y)
+            changed_blocks = np.logical_or.reduceat(changed[y:y + height].any(axis=0), self._col_starts)
+            # runs of changed blocks in the block row
+            edges = np.flatnonzero(np.diff(np.concatenate(([False], changed_blocks, [False])).view(np.int8)))
+            for start, end in zip(edges[::2], edges[1::2]):
+                x = int(start) * self.block_size
+                rects.append((x, y, min(int(end) * self.block_size, self.width) - x, height))
+        return rects
+
+
+def _recorder_metrics_layout(max_sessions):
+    # writer 0 is the capture thread, then each session slot has a writer for its captures,
+    # one for its convert stage and one for its encode stage
+    return (MetricsLayout(1 + 3 * max_sessions)
+            .counter('screenshots')
+            .histogram('grab_latency_ns')
+            .counter('frames_captured')
+            .gauge('capture_queue_depth')
+            .counter('frames_converted')
+            .histogram('convert_latency_ns')
+            .counter('frames_encoded')
+            .histogram('encode_latency_ns'))
+
+
+def _convert_stage(in_ring: _FrameRing,
+                   out_ring: _FrameRing,
+                   free_ring: _FrameRing,
+                   change_detector: _ChangeDetector,
+                   stats: _RecordStats,
+                   metrics_writer: MetricsWriter):
+    try:
+        while (frame := in_ring.get()) is not None:
+            start = time.perf_counter_ns()
+            bgra, repeat, timestamp = frame
+            dirty_rects = None
+            if change_detector is not None:
+                dirty_rects = change_detector.dirty_rects(bgra)
+                if not len(dirty_rects):
+                    # unchanged frames skip the conversion, the encoder repeats its last frame
+                    stats.unchanged_count += repeat
+                    out_ring.put((None, repeat, dirty_rects, timestamp), block=True)
+                    continue
+            # waiting for a free frame buffer is the back pressure of the encoder,
+            # it stops at the capture ring
+            if (img := free_ring.get()) is None:
+                break
+            img = _bgra_to_bgr(bgra, img)
+            metrics_writer.observe('convert_latency_ns', time.perf_counter_ns() - start)
+            metrics_writer.inc('frames_converted')
+            out_ring.put((img, repeat, dirty_rects, timestamp), block=True)
+    finally:
+        out_ring.close()
+
+
+class _TapCommand:
+    """
+    Subscribe tap <tap_id> to the frames of a session, or unsubscribe it if <block_name> is None
+    """
+
+    def __init__(self, tap_id, block_name=None, lossless=False, capacity=None):
+        self.tap_id = tap_id
+        self.block_name = block_name
+        self.lossless = lossless
+        self.capacity = capacity
+
+
+class _FrameTapWriter:
+    """
+    Copy the frames of a session into the SharedFrameRing of a subscriber, laid out
+    in its shared memory block when the first frame gives the shape
+    """
+
+    def __init__(self, command: _TapCommand, fps):
+        self.lossless = command.lossless
+        self.capacity = command.capacity
+        self.fps = fps
+        self.cancelled = False
+        self._block = shared_memory.SharedMemory(name=command.block_name)
+        self._ring = None
+
+    def write(self, img, timestamp=None):
+        if self._ring is None:
+            self._ring = SharedFrameRing.create(self._block.buf, img.shape, self.fps, self.capacity)
+        # a lossless tap blocks the encode stage, the back pressure stops at the capture ring
+        with self._ring.writing(timestamp, block=self.lossless, cancelled=lambda: self.cancelled) as slot:
+            np.copyto(slot, img)
+
+    def close(self):
+        # the subscriber reads the closed flag of the ring and stops, the block stays mapped on its side until then
+        (self._ring if self._ring is not None else SharedFrameRing(self._block.buf)).close()
+        _close_ring_block(self)
+
+
+def _encode_stage(in_ring: _FrameRing,
+                  free_ring: _FrameRing,
+                  encoder: VideoEncoder,
+                  stats: _RecordStats,
+                  taps,
+                  metrics_writer: MetricsWriter,
+                  report_result):
+    last_img = None
+    errors = []
+    try:
+        while (frame := in_ring.get()) is not None:
+            img, repeat, dirty_rects, timestamp = frame
+            if img is None:
+                img = last_img
+            elif last_img is not None:
+                # the last frame is kept out of the free ring while unchanged frames may repeat it
+                free_ring.put(last_img)
+            last_img = img
+            # subscribers get each captured frame once, the encoder once per frame slot
+            for tap_id, tap in list(taps.items()):
+                if tap.cancelled:
+                    taps.pop(tap_id).close()
+                else:
+                    tap.write(img, timestamp)
+            start = time.perf_counter_ns()
+            for i in range(repeat):
+                # the duplicates of a frame change nothing
+                encoder.write_frame(img, timestamp, dirty_rects if i == 0 or dirty_rects is None else [])
+            metrics_writer.observe('encode_latency_ns', time.perf_counter_ns() - start)
+            metrics_writer.inc('frames_encoded', repeat)
+            stats.written_count += repeat
+    except Exception as e:
+        errors.append(f'{type(e).__name__}: {e}')
+    finally:
+        # unblocks the convert stage if the writer failed
+        in_ring.close()
+        free_ring.close()
+        try:
+            encoder.close()
+        except Exception as e:
+            errors.append(f'{type(e).__name__}: {e}')
+        [tap.close() for tap in list(taps.values())]
+        taps.clear()
+        report_result('\n'.join(errors) if len(errors) else None)
+
+
+class _RecordSession:
+    """
+    Recording session in the recording process. The shared capture thread hands it
+    crops of its screenshots, conversion and encoding run in the session's own threads.
+    """
+
+    def __init__(self, task, bbox, stats: _RecordStats, metrics: SharedMetrics, report_result):
+        self.task = task
+        self.bbox = bbox
+        self.stats = stats
+        self.metrics_writer = metrics.writer(1 + 3 * task.stats_index)
+        self.interval = 1 / task.fps
+        width, height = bbox['width'], bbox['height']
+        self.captured_ring = _FrameRing(task.buffer_size)
+        converted_ring = _FrameRing(task.buffer_size)
+        # converted frames are written into preallocated buffers recycled by the encoder
+        free_ring = _FrameRing(task.buffer_size)
+        [free_ring.put(np.empty((height, width, 3), dtype=np.uint8)) for _ in range(task.buffer_size)]
+        change_detector = _ChangeDetector(width, height) if task.detect_changes else None
+        # frame tap writers of the subscribers, shared with the encode stage
+        self.taps = {}
+        # conversion and encoding release the GIL in cv2 and the writer,
+        # so a slow encoder only fills the rings instead of delaying captures
+        self.stages = [threading.Thread(target=_convert_stage,
+                                        name='ConvertStage',
+                                        args=(self.captured_ring, converted_ring, free_ring, change_detector, stats,
+                                              metrics.writer(2 + 3 * task.stats_index)),
+                                        daemon=True),
+                       threading.Thread(target=_encode_stage,
+                                        name='EncodeStage',
+                                        args=(converted_ring, free_ring, task.encoder, stats, self.taps,
+                                              metrics.writer(3 + 3 * task.stats_index), report_result),
+                                        daemon=True)]
+        self.start_time = None
+        self.frame_index = 0
+        self.skipped_count = 0
+        self.stopped = False
+
+    def start(self, epoch):
+        self.task.encoder.open(self.task.record_file, self.task.fps, self.bbox['width'], self.bbox['height'])
+        [stage.start() for stage in self.stages]
+        # frames are due at absolute deadlines, so timing errors never accumulate. They are aligned
+        # on the ticks of <epoch>, so that sessions of commensurate fps share their screenshots
+        self.start_time = epoch + math.ceil((time.perf_counter() - epoch) / self.interval) * self.interval
+        self.stats.reset(self.start_time)
+
+    @property
+    def next_deadline(self):
+        return self.start_time + self.frame_index * self.interval
 
+    def capture(self, bgra, now):
+        if self.stopped:
+            # stopped while the screenshot was grabbed
+            return
+        self.stats.captured_count += 1
+        # frame slots whose deadline already passed while this frame was grabbed
+        missed_count = max(int((now - self.start_time) / self.interval) - self.frame_index, 0)
+        if self.task.frame_policy == 'duplicate':
+            # the frame fills the missed slots so that the video keeps the wall-clock timeline
+            self.stats.duplicated_count += missed_count
+            self.captured_ring.put((bgra, 1 + missed_count, now))
+        else:
+            self.skipped_count += missed_count
+            self.captured_ring.put((bgra, 1, now))
+        self.stats.dropped_count = self.skipped_count + self.captured_ring.dropped_count
+        self.frame_index += 1 + missed_count
+        self.metrics_writer.inc('frames_captured')
+        self.metrics_writer.set('capture_queue_depth', len(self.captured_ring))
 
-def _record_worker(record_task_queue: mp.SimpleQueue,
-                   start_record_event: mp.Event,
-                   started_event: mp.Event):
+    def subscribe(self, command: _TapCommand):
+        self.taps[command.tap_id] = _FrameTapWriter(command, self.task.fps)
+
+    def unsubscribe(self, tap_id):
+        tap = self.taps.get(tap_id)
+        if tap is not None:
+            # the encode stage may be writing to the tap, it closes it itself,
+            # the flag also unblocks it if it waits for a lossless subscriber
+            tap.cancelled = True
+
+    def stop(self):
+        self.stopped = True
+        self.stats.end_time = time.perf_counter()
+        self.captured_ring.close()
+        # the gauges of a stopped session are summed with the others, the capture thread skips it now
+        self.metrics_writer.set('capture_queue_depth', 0)
+
+
+def _union_bbox(bboxes):
+    left = min(bbox['left'] for bbox in bboxes)
+    top = min(bbox['top'] for bbox in bboxes)
+    right = max(bbox['left'] + bbox['width'] for bbox in bboxes)
+    bottom = max(bbox['top'] + bbox['height'] for bbox in bboxes)
+    return {'left': left, 'top': top, 'width': right - left, 'height': bottom - top}
+
+
+def _capture_worker(sessions, sessions_condition: threading.Condition, metrics_writer: MetricsWriter):
+    from mss import mss
+
+    with mss() as sct:
+        while True:
+            with sessions_condition:
+                if not len(sessions):
+                    sessions_condition.wait()
+                    continue
+                next_deadline = min(session.next_deadline for session in sessions.values())
+                remaining = next_deadline - time.perf_counter() - _SPIN_THRESHOLD
+                if remaining > 0:
+                    # woken up early when sessions are started or stopped
+                    sessions_condition.wait(remaining)
+                    continue
+            sleep_until(next_deadline)
+            now = time.perf_counter()
+            with sessions_condition:
+                due_sessions = [session for session in sessions.values()
+                                if session.next_deadline <= now + _SPIN_THRESHOLD]
+            if not len(due_sessions):
+                continue
+            # a single grab of the union of the due regions, each session gets its crop as a view
+            bbox = _union_bbox([session.bbox for session in due_sessions])
+            grab_start = time.perf_counter_ns()
+            shot = sct.grab(bbox)
+            bgra = _bgra_view(shot.raw, bbox['width'], bbox['height'])
+            metrics_writer.observe('grab_latency_ns', time.perf_counter_ns() - grab_start)
+            metrics_writer.inc('screenshots')
+            now = time.perf_counter()
+            for session in due_sessions:
+                left = session.bbox['left'] - bbox['left']
+                top = session.bbox['top'] - bbox['top']
+                session.capture(bgra[top:top + session.bbox['height'], left:left + session.bbox['width']], now)
+
+
+def _put_session_result(result_queue: mp.SimpleQueue, session_id, error):
+    result_queue.put((session_id, error))
+
+
+def _record_worker(command_queue: mp.SimpleQueue,
+                   result_queue: mp.SimpleQueue,
+                   started_event: mp.Event,
+                   stats_array,
+                   metrics: SharedMetrics):
+    sessions = {}
+    sessions_condition = threading.Condition()
+    epoch = time.perf_counter()
+    threading.Thread(target=_capture_worker,
+                     name='CaptureWorker',
+                     args=(sessions, sessions_condition, metrics.writer(0)),
+                     daemon=True).start()
     started_event.set()
-    while True:
-        with mss() as sct:
-            task = record_task_queue.get()
+    from mss import mss
+
+    with mss() as sct:
+        while True:
+            session_id, task = command_queue.get()
+            if task is None:
+                # stop command
+                with sessions_condition:
+                    session = sessions.pop(session_id, None)
+                    sessions_condition.notify_all()
+                if session is not None:
+                    session.stop()
+                continue
+            elif isinstance(task, _TapCommand):
+                session = sessions.get(session_id)
+                if task.block_name is None:
+                    if session is not None:
+                        session.unsubscribe(task.tap_id)
+                elif session is not None and not session.stopped:
+                    session.subscribe(task)
+                else:
+                    # the readers of a tap of a session not recording stop at once
+                    tap = _FrameTapWriter(task, 0.)
+                    tap.close()
+                continue
             screen_bbox = sct.monitors[task.monitor + 1]
             if task.bbox is not None:
-                bbox = task.bbox
+                bbox = dict(task.bbox)
                 bbox['left'] += screen_bbox['left']
                 bbox['top'] += screen_bbox['top']
-                width, height = task.bbox['width'], task.bbox['height']
             else:
-                bbox = screen_bbox
-                width, height = screen_bbox['width'], screen_bbox['height']
-            bbox['mon'] = task.monitor + 1
-            out_video = cv2.VideoWriter(task.record_file,
-                                        task.fourcc,
-                                        task.fps,
-                                        (width, height))
-            interval = 1 / task.fps
-            start_record_event.wait()
-            while start_record_event.is_set():
-                with execute_for(interval):
-                    img = sct.grab(bbox)
-                    img = Image.frombytes('RGB', img.size, img.bgra, 'raw', 'BGRX')
-                    img = np.asarray(img, dtype=np.uint8)
-                    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-                    out_video.write(img)
-            out_video.release()
+                bbox = dict(screen_bbox)
+            # each session reports once, when its encoder is closed, the error that ended it if any
+            report_result = functools.partial(_put_session_result, result_queue, session_id)
+            try:
+                session = _RecordSession(task, bbox, stats_array[task.stats_index], metrics, report_result)
+                session.start(epoch)
+            except Exception as e:
+                report_result(f'{type(e).__name__}: {e}')
+                continue
+            with sessions_condition:
+                sessions[session_id] = session
+                sessions_condition.notify_all()
+
+
+class FrameTap:
+    """
+    Subscription to the frames of a recording session. The recording process copies
+    each converted BGR frame into a SharedFrameRing in the shared memory of the tap,
+    so the screen is captured and converted once for the encoder and every subscriber.
+
+    With the 'latest' policy a read returns the newest frame and the frames produced
+    in between are skipped. With the 'lossless' policy frames are read in order, the
+    encoding of the session waits for the subscriber when it lags behind by the ring
+    capacity, so captures are dropped instead.
+
+    Iterate over the tap to get (timestamp, frame) pairs until the session stops,
+    or give a callback to subscribe, called from a thread of the tap. Timestamps are
+    the time.perf_counter() of the captures.
+    """
+
+    def __init__(self, session, tap_id, block, policy, callback=None):
+        self._session = session
+        self.tap_id = tap_id
+        self.policy = policy
+        self._block = block
+        self._ring = None
+        self._last_index = -1
+        self._closed = False
+        # held by the readers while they touch the ring, so that close never unmaps it under them
+        self._reading_lock = threading.Lock()
+        self._callback_thread = None
+        if callback is not None:
+            self._callback_thread = threading.Thread(target=self._run_callback,
+                                                     name='FrameTapCallback',
+                                                     args=(callback,),
+                                                     daemon=True)
+            self._callback_thread.start()
+
+    def _get_ring(self):
+        if self._ring is None:
+            ring = SharedFrameRing(self._block.buf)
+            # the ring is laid out by the recording process when the first frame arrives,
+            # its layout is complete once that frame is committed
+            if ring.write_count == 0 and not ring.closed:
+                return None
+            self._ring = ring
+        return self._ring
+
+    def _cancelled(self):
+        # the recording process closes the ring when the session stops, unless it was killed
+        return self._closed or not self._session._recorder._record_process.is_alive()
+
+    def get(self, timeout=None):
+        """
+        Return the next (timestamp, frame) according to the policy, waiting up to <timeout>
+        seconds for it. Returns None on timeout or once the session has stopped.
+        """
+        with self._reading_lock:
+            return self._get(timeout)
+
+    def _get(self, timeout):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        ring = None
+        while not self._cancelled() and (ring := self._get_ring()) is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(_TAP_POLL_INTERVAL)
+        if self._closed or ring is None or ring.capacity == 0:
+            return None
+        timeout = max(0., deadline - time.monotonic()) if deadline is not None else None
+        if self.policy == 'lossless':
+            return ring.read_next(timeout, self._cancelled)
+        item = ring.read_latest(self._last_index, timeout, self._cancelled)
+        if item is None:
+            return None
+        self._last_index, timestamp, frame = item
+        return timestamp, frame
+
+    def __iter__(self):
+        while (item := self.get()) is not None:
+            yield item
+
+    def _run_callback(self, callback):
+        for timestamp, frame in self:
+            callback(timestamp, frame)
+
+    def close(self):
+        """
+        Unsubscribe and free the shared memory of the tap
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._session._unsubscribe(self)
+        # readers waiting for a frame stop at once, even if the recording process was killed before closing it
+        (self._ring if self._ring is not None else SharedFrameRing(self._block.buf)).close()
+        if self._callback_thread is not None and self._callback_thread is not threading.current_thread():
+            self._callback_thread.join()
+        with self._reading_lock:
+            _close_ring_block(self, unlink=True)
+
+
+class RecordSession:
+    """
+    Handle of a recording session started by a ScreenRecorder
+    """
+
+    def __init__(self, recorder, session_id, stats_index, replay_block=None):
+        self._recorder = recorder
+        self.session_id = session_id
+        self.stats_index = stats_index
+        self._replay_block = replay_block
+        self._taps = {}
+        self.stopped = False
+
+    @property
+    def stats(self):
+        """
+        Statistics of the session: achieved capture fps, elapsed time,
+        and the numbers of captured, written, dropped, duplicated and unchanged frames.
+        They are kept until the slot of the session is reused by a later session.
+        'error' is the error that ended the session, see error.
+        """
+        stats = self._recorder._stats_array[self.stats_index].as_dict()
+        stats['error'] = self.error
+        return stats
+
+    @property
+    def error(self):
+        """
+        Message of the error that ended the session in the recording process, such as an
+        encoder failing to open or to close, None if there was none or it is still running
+        """
+        return self._recorder._session_result(self.session_id)[1]
+
+    def stop(self, wait=False, timeout=None):
+        """
+        Stop the session. With <wait>, wait up to <timeout> seconds for its encoder
+        to be closed and raise RuntimeError if the session failed.
+        """
+        if not self.stopped:
+            self.stopped = True
+            self._recorder._command_queue.put((self.session_id, None))
+        if not wait:
+            return
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not (result := self._recorder._session_result(self.session_id))[0]:
+            if not self._recorder._record_process.is_alive() or (deadline is not None
+                                                                  and time.monotonic() >= deadline):
+                return
+            time.sleep(_TAP_POLL_INTERVAL)
+        if result[1] is not None:
+            raise RuntimeError(f'recording session {self.session_id} failed: {result[1]}')
+
+    def close(self):
+        """
+        Stop the session and free the memory of its replay ring
+        """
+        self.stop()
+        self._close()
+        self._recorder._sessions.pop(self.session_id, None)
+
+    def subscribe(self, policy='latest', callback=None, capacity=4, memory_cap=64 << 20) -> FrameTap:
+        """
+        Subscribe to the frames of the session with the 'latest' or 'lossless' <policy>,
+        see FrameTap. The ring of the tap holds up to <capacity> frames, fewer if they
+        do not fit in <memory_cap> bytes.
+        """
+        if policy not in _TAP_POLICIES:
+            raise ValueError(f'policy must be one of {_TAP_POLICIES}, got {policy}')
+        block = shared_memory.SharedMemory(create=True, size=memory_cap)
+        tap = FrameTap(self, next(self._recorder._tap_ids), block, policy, callback)
+        self._taps[tap.tap_id] = tap
+        self._recorder._command_queue.put((self.session_id,
+                                           _TapCommand(tap.tap_id, block.name, policy == 'lossless', capacity)))
+        return tap
+
+    def _unsubscribe(self, tap: FrameTap):
+        if self._taps.pop(tap.tap_id, None) is not None and not self.stopped:
+            self._recorder._command_queue.put((self.session_id, _TapCommand(tap.tap_id)))
+
+    def save_last(self, seconds, path, encoder: VideoEncoder = None):
+        """
+        Write the frames of the last <seconds> of a replay session into <path> with
+        <encoder>, an OpenCVEncoder() if not given. The replay recording goes on.
+        Returns the number of frames written.
+        """
+        if self._replay_block is None:
+            raise RuntimeError('not a replay session, start it with start_replay')
+        encoder = encoder if encoder is not None else OpenCVEncoder()
+        ring = SharedFrameRing(self._replay_block.buf)
+        count = 0
+        try:
+            for timestamp, frame in ring.read_last(seconds):
+                if count == 0:
+                    encoder.open(path, ring.fps, frame.shape[1], frame.shape[0])
+                encoder.write_frame(frame, timestamp)
+                count += 1
+        finally:
+            if count > 0:
+                encoder.close()
+            del ring
+        return count
+
+    def _close(self):
+        [tap.close() for tap in list(self._taps.values())]
+        if self._replay_block is not None:
+            self._replay_block.close()
+            self._replay_block.unlink()
+            self._replay_block = None
+
 
 # This class used for recording the screen by making a video.
 class ScreenRecorder:
-    def __init__(self):
-        self._record_task_queue = mp.SimpleQueue()
-        self._start_record_event = mp.Event()
+    def __init__(self, max_sessions=8):
+        """
+        Record up to <max_sessions> concurrent sessions, each with its own region,
+        fps and output, from a single recording process. At each tick the union of the
+        regions of the due sessions is grabbed once and cropped for each of them.
+        """
+        self._command_queue = mp.SimpleQueue()
+        # (session id, error or None) put by the recording process when a session ends
+        self._result_queue = mp.SimpleQueue()
+        self._session_results = {}
+        self._session_results_lock = threading.Lock()
         self._subprocess_started_event = mp.Event()
+        self._stats_array = mp.RawArray(_RecordStats, max_sessions)
+        self._metrics = SharedMetrics(_recorder_metrics_layout(max_sessions))
+        self._session_ids = itertools.count()
+        self._tap_ids = itertools.count()
+        self._sessions = {}
+        self._last_session = None
+        self._next_stats_index = 0
+        if os.name == 'posix':
+            # the recording process attaches the replay and metrics blocks, it must share the tracker of this process
+            resource_tracker.ensure_running()
         self._record_process = mp.Process(target=_record_worker,
                                           name='RecordProcess',
-                                          args=(self._record_task_queue,
-                                                self._start_record_event,
-                                                self._subprocess_started_event),
+                                          args=(self._command_queue,
+                                                self._result_queue,
+                                                self._subprocess_started_event,
+                                                self._stats_array,
+                                                self._metrics),
                                           daemon=True)
         self._record_process.start()
 
+    @property
+    def max_sessions(self):
+        return len(self._stats_array)
+
+    def _session_result(self, session_id):
+        """
+        Return (ended, error) of session <session_id>
+        """
+        with self._session_results_lock:
+            while not self._result_queue.empty():
+                result_session_id, error = self._result_queue.get()
+                self._session_results[result_session_id] = error
+            if session_id in self._session_results:
+                return True, self._session_results[session_id]
+        return False, None
+
+    @property
+    def sessions(self):
+        """Sessions not stopped yet"""
+        return [session for session in self._sessions.values() if not session.stopped]
+
+    def _start_session(self, task, replay_block=None) -> RecordSession:
+        if task.frame_policy not in _FRAME_POLICIES:
+            raise ValueError(f'frame_policy must be one of {_FRAME_POLICIES}, got {task.frame_policy}')
+        # stopped replay sessions are kept until closed, their ring can still be saved,
+        # and so are the sessions with subscribers still reading their last frames
+        self._sessions = {session_id: session for session_id, session in self._sessions.items()
+                          if not session.stopped or session._replay_block is not None or len(session._taps)}
+        used_indices = {session.stats_index for session in self.sessions}
+        if len(used_indices) >= self.max_sessions:
+            raise RuntimeError(f'{self.max_sessions} sessions are already recording')
+        # stats slots are taken round-robin so that the slot of a stopped session,
+        # whose encoder may still be flushing, is reused as late as possible
+        task.stats_index = min(set(range(self.max_sessions)) - used_indices,
+                               key=lambda i: (i - self._next_stats_index) % self.max_sessions)
+        self._next_stats_index = (task.stats_index + 1) % self.max_sessions
+        session = RecordSession(self, next(self._session_ids), task.stats_index, replay_block)
+        self._sessions[session.session_id] = self._last_session = session
+        self._command_queue.put((session.session_id, task))
+        return session
+
     def start_record(self,
                      record_file,
                      monitor=0,
                      bbox=None,
                      fps=30,
                      fourcc='DIVX',
-                     ):
-        task = _RecordTask(record_file, monitor, bbox, fps, fourcc)
-        self._record_task_queue.put(task)
-        self._start_record_event.set()
+                     buffer_size=64,
+                     frame_policy='duplicate',
+                     detect_changes=False,
+                     encoder: VideoEncoder = None,
+                     ) -> RecordSession:
+        """
+        Start a session recording the screen into <record_file> with <encoder>, an
+        OpenCVEncoder(<fourcc>) if not given, see FFmpegEncoder and RawEncoder for the
+        other backends. Sessions run concurrently until stopped by their handle.
+
+        Frames are buffered between the capture, conversion and encoding stages in rings
+        of <buffer_size> frames, when the encoder cannot keep up the oldest captured
+        frames are dropped instead of delaying captures.
+
+        Frames are captured at absolute deadlines. When a capture is late, <frame_policy>
+        'duplicate' writes the frame again for each missed deadline so that the video
+        stays in sync with wall-clock time, 'skip' leaves the missed frames out.
+
+        With <detect_changes>, each frame is compared with the previous one: unchanged
+        frames are not converted and the encoder writes its last frame again, changed
+        frames carry their dirty rectangles down to VideoEncoder.write_frame.
+        """
+        return self._start_session(_RecordTask(record_file,
+                                               monitor,
+                                               bbox,
+                                               fps,
+                                               encoder if encoder is not None else OpenCVEncoder(fourcc),
+                                               buffer_size,
+                                               frame_policy,
+                                               detect_changes))
 
-    def stop_record(self):
-        self._start_record_event.clear()
+    def start_replay(self,
+                     seconds=30,
+                     monitor=0,
+                     bbox=None,
+                     fps=30,
+                     scale=1.,
+                     memory_cap=256 << 20,
+                     buffer_size=64,
+                     frame_policy='duplicate',
+                     detect_changes=False,
+                     ) -> RecordSession:
+        """
+        Start a session recording the screen in memory only, keeping the frames of the
+        last <seconds> in a ring preallocated in shared memory, until save_last writes
+        them to a file. Frames are downscaled by <scale> and the ring is cut down to fit
+        in <memory_cap> bytes, so fewer seconds may be kept at high resolution.
+        """
+        replay_block = shared_memory.SharedMemory(create=True, size=memory_cap)
+        try:
+            return self._start_session(_RecordTask(None,
+                                                   monitor,
+                                                   bbox,
+                                                   fps,
+                                                   _ReplayEncoder(replay_block.name, scale, round(seconds * fps)),
+                                                   buffer_size,
+                                                   frame_policy,
+                                                   detect_changes),
+                                       replay_block)
+        except Exception as e:
+            replay_block.close()
+            replay_block.unlink()
+            raise e
+
+    def subscribe(self, session: RecordSession = None, policy='latest', callback=None, capacity=4,
+                  memory_cap=64 << 20) -> FrameTap:
+        """
+        Subscribe to the frames of <session>, or of the last session started, see RecordSession.subscribe
+        """
+        session = session if session is not None else self._last_session
+        if session is None:
+            raise RuntimeError('no recording session, call start_record first')
+        return session.subscribe(policy, callback, capacity, memory_cap)
+
+    def save_last(self, seconds, path, encoder: VideoEncoder = None):
+        """
+        save_last of the last replay session started
+        """
+        replay_sessions = [session for session in self._sessions.values() if session._replay_block is not None]
+        if not len(replay_sessions):
+            raise RuntimeError('no replay recording, call start_replay first')
+        return replay_sessions[-1].save_last(seconds, path, encoder)
+
+    def stop_record(self, session: RecordSession = None):
+        """
+        Stop <session>, or every session if not given
+        """
+        [s.stop() for s in ([session] if session is not None else self.sessions)]
+
+    @property
+    def stats(self):
+        """
+        Statistics of the last session started, see RecordSession.stats
+        """
+        if self._last_session is None:
+            return {**_RecordStats().as_dict(), 'error': None}
+        return self._last_session.stats
+
+    def metrics(self):
+        """
+        Snapshot of the metrics published by the recording process since it started, over all the sessions:
+        screenshots grabbed and their grab_latency_ns, frames_captured, frames_converted and frames_encoded
+        with the convert_latency_ns and encode_latency_ns histograms, and capture_queue_depth,
+        the frames waiting for conversion. Latencies are LatencyHistogram of nanoseconds.
+        """
+        if self._metrics is None:
+            return None
+        return self._metrics.snapshot()
 
     def terminate(self):
         """
@@ -115,6 +1110,11 @@ class ScreenRecorder:
         
         self.stop_record()
         self._record_process.terminate()
+        [session._close() for session in self._sessions.values()]
+        self._sessions.clear()
+        if self._metrics is not None:
+            self._metrics.close()
+            self._metrics = None
 
     def join(self, timeout=None):
         """